@@ -1,7 +1,21 @@
 import os
+import re
+import time
+import asyncio
+import datetime
+import functools
+import hashlib
 import logging
-from typing import Optional
+import threading
+import contextvars
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Tuple, Any
 from flask import current_app
+from semantic_cache import semantic_cache, is_enabled_for_bot as is_semantic_cache_enabled
+
+logger = logging.getLogger(__name__)
 
 try:
     import google.generativeai as genai
@@ -10,235 +24,790 @@ try:
     GEMINI_AVAILABLE = True
 except ImportError:
     GEMINI_AVAILABLE = False
-    logging.warning("Google Generative AI library not available. Install with: pip install google-generativeai")
+    logger.warning("Google Generative AI library not available. Install with: pip install google-generativeai")
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+# Async client (google-genai) - bir nechta so'rovlarni event loop'da parallel bajarish uchun
+try:
+    from google import genai as genai_sdk
+    from google.genai import types as genai_types
+    GENAI_ASYNC_AVAILABLE = True
+except ImportError:
+    GENAI_ASYNC_AVAILABLE = False
+
+GEMINI_MODEL = 'gemini-flash-lite-latest'
+MAX_CONCURRENT_AI_REQUESTS = int(os.environ.get('MAX_CONCURRENT_AI_REQUESTS', '50'))  # Gemini kvotasi ichida qolish
+_async_state = weakref.WeakKeyDictionary()  # event loop -> (client, semaphore)
+# Sinxron SDK chaqiruvlari uchun alohida pool: standart executor'ni Gemini kutishlari bilan to'ldirmaslik
+_AI_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('AI_EXECUTOR_WORKERS', '32')),
+    thread_name_prefix='gemini'
+)
+KB_CHAR_LIMIT = 10000  # Default; overridden by app.config['KB_CHAR_LIMIT']
+
+# Exact-match javob keshi: bir xil (til, bot, savol, bilim bazasi, tarix) uchun
+# Gemini'ga qayta so'rov yubormaslik. Jarayon ichida LRU, REDIS_URL bo'lsa Redis ham.
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_CACHE_TTL = 3600  # 1 soat
+_response_cache: "OrderedDict[str, str]" = OrderedDict()
+_response_cache_lock = threading.Lock()
+_response_cache_stats = {'hits': 0, 'misses': 0}
+
+def _response_cache_key(message: str, bot_name: str, user_language: str, knowledge_base: str, chat_history: str) -> str:
+    """SHA1 cache key for an AI request (stable across processes, unlike hash())"""
+    digest = hashlib.sha1()
+    for part in (user_language, bot_name, message.strip().lower(), knowledge_base, chat_history):
+        digest.update((part or '').encode('utf-8', errors='ignore'))
+        digest.update(b'\x1f')
+    return digest.hexdigest()
+
+def _shared_response_cache():
+    """Return redis_cache module when Redis is configured and reachable, else None"""
+    if not os.environ.get('REDIS_URL'):
+        return None
+    try:
+        import redis_cache
+    except ImportError:
+        return None
+    return redis_cache if redis_cache.redis_client else None
+
+def get_cached_response(key: str) -> Optional[str]:
+    """Look up a cached AI response (in-process LRU first, then Redis)"""
+    with _response_cache_lock:
+        cached = _response_cache.get(key)
+        if cached is not None:
+            _response_cache.move_to_end(key)
+            return cached
+    shared = _shared_response_cache()
+    if shared:
+        cached = shared.get_cached_ai_response(key)
+        if cached:
+            _store_local_response(key, cached)
+            return cached
+    return None
+
+def _store_local_response(key: str, response: str) -> None:
+    with _response_cache_lock:
+        _response_cache[key] = response
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
+def cache_response(key: str, response: str) -> None:
+    """Store an AI response in the in-process LRU and (if configured) Redis"""
+    _store_local_response(key, response)
+    shared = _shared_response_cache()
+    if shared:
+        shared.cache_ai_response(key, response, ttl=RESPONSE_CACHE_TTL)
 
-def get_ai_response(message: str, bot_name: str = "Chatbot Factory AI", user_language: str = "uz", knowledge_base: str = "", chat_history: str = "") -> Optional[str]:
+def _lookup_cached_response(message: str, bot_name: str, user_language: str, knowledge_base: str, chat_history: str, bot_id: Optional[int]):
     """
-    Generate AI response using Google Gemini with chat history context
+    Check exact and semantic caches
+    Returns (cached_response, cache_key, semantic_namespace, semantic_embedding)
     """
-    try:
-        # Language-specific system prompts - STRICT RAG MODE
-        language_prompts = {
-            'uz': f"Siz {bot_name} - savdo platformasi virtual yordamchisisiz. \nQAT'IY QOIDALAR:\n1. Faqat va faqat quyida keltirilgan BILIMLAR BAZASI (Knowledge Base) asosida javob bering.\n2. O'zingizdan hech qanday tashqi ma'lumot qo'shmang.\n3. Agar savolga javob bazada bo'lmasa, aniq ayting: 'Uzr, bu haqida ma'lumot menda yo'q. Iltimos, operatorga murojaat qiling.'\n4. Ortiqcha iltifot va uzun kirish so'zlaridan saqlaning. Javobingiz aniq va lo'nda bo'lsin.\n5. Narxlar haqida so'ralsa, faqat bazadagi aniq raqamlarni ayting.\n6. Markdown (**, *, `) belgilarini ishlatmang.",
-            'ru': f"Вы {bot_name} - виртуальный помощник торговой платформы. \nСТРОГИЕ ПРАВИЛА:\n1. Отвечайте ТОЛЬКО на основе предоставленной БАЗЫ ЗНАНИЙ.\n2. НЕ добавляйте информацию от себя.\n3. Если ответа нет в базе, скажите: 'Извините, у меня нет информации об этом. Пожалуйста, обратитесь к оператору.'\n4. Избегайте лишних слов и длинных вступлений. Ответ должен быть кратким и точным.\n5. НИКОГДА не используйте markdown (**).",
-            'en': f"You are {bot_name}, a virtual assistant. \nSTRICT RULES:\n1. Answer ONLY based on the provided KNOWLEDGE BASE.\n2. Do NOT add external information.\n3. If the answer is not in the base, say: 'Sorry, I don't have information about this. Please contact the operator.'\n4. Keep answers concise and direct.\n5. NEVER use markdown (**)."
-        }
-        
-        system_prompt = language_prompts.get(user_language, language_prompts['uz'])
+    # Takroriy savollar uchun keshdan javob qaytarish (tarmoq so'rovisiz)
+    cache_key = _response_cache_key(message, bot_name, user_language, knowledge_base, chat_history)
+    cached = get_cached_response(cache_key)
+    if cached is not None:
+        _response_cache_stats['hits'] += 1
+        logger.debug("AI response cache_hit=1 (hits=%d, misses=%d)",
+                     _response_cache_stats['hits'], _response_cache_stats['misses'])
+        return cached, cache_key, None, None
+    _response_cache_stats['misses'] += 1
+    logger.debug("AI response cache_hit=0 (hits=%d, misses=%d)",
+                 _response_cache_stats['hits'], _response_cache_stats['misses'])
 
-        # Inject platform contact info so bot can answer contact-related questions precisely
+    # Semantik kesh: qayta ifodalangan savollar uchun (faqat yoqilgan botlarda)
+    if is_semantic_cache_enabled(bot_id):
         try:
-            support_phone = (current_app.config.get('SUPPORT_PHONE') or '').strip()
-            support_tg = (current_app.config.get('SUPPORT_TELEGRAM') or '').strip()
-            contact_block = []
-            if support_phone:
-                contact_block.append(f"Admin telefon raqami: {support_phone}")
-            if support_tg:
-                contact_block.append(f"Telegram aloqa: {support_tg}")
-            if contact_block:
-                system_prompt += "\n\nQO'SHIMCHA ALOQA MA'LUMOTLARI:\n" + "\n".join(contact_block) + "\n" 
-        except Exception:
-            pass
-        
-        # Add knowledge base context if available
-        if knowledge_base:
-            # Increased limit for Gemini Flash (it handles large context well)
-            kb_limit = 10000 
-            limited_kb = knowledge_base[:kb_limit]
-            system_prompt += f"\n\nSizda quyidagi bilim bazasi mavjud:\n{limited_kb}\n\nAgar foydalanuvchi yuqoridagi ma'lumotlar haqida so'rasa, aniq va to'liq javob bering."
+            kb_digest = hashlib.sha1((knowledge_base or '').encode('utf-8', errors='ignore')).hexdigest()
+            semantic_namespace = (bot_id, user_language, kb_digest)
+            semantic_hit, semantic_embedding = semantic_cache.lookup(semantic_namespace, message)
+            if semantic_hit is not None:
+                cache_response(cache_key, semantic_hit)
+                return semantic_hit, cache_key, None, None
+            return None, cache_key, semantic_namespace, semantic_embedding
+        except Exception as semantic_error:
+            logger.warning("Semantic cache lookup failed: %s", semantic_error)
+    return None, cache_key, None, None
+
+def _remember_response(cache_key: str, semantic_namespace, semantic_embedding, text: str) -> None:
+    """Store a fresh Gemini response in the exact and semantic caches"""
+    cache_response(cache_key, text)
+    if semantic_namespace is not None and semantic_embedding is not None:
+        semantic_cache.store(semantic_namespace, semantic_embedding, text)
+
+# Language-specific system prompts - STRICT RAG MODE
+_PROMPT_TEMPLATES = {
+    'uz': "Siz {bot_name} - savdo platformasi virtual yordamchisisiz. \nQAT'IY QOIDALAR:\n1. Faqat va faqat quyida keltirilgan BILIMLAR BAZASI (Knowledge Base) asosida javob bering.\n2. O'zingizdan hech qanday tashqi ma'lumot qo'shmang.\n3. Agar savolga javob bazada bo'lmasa, aniq ayting: 'Uzr, bu haqida ma'lumot menda yo'q. Iltimos, operatorga murojaat qiling.'\n4. Ortiqcha iltifot va uzun kirish so'zlaridan saqlaning. Javobingiz aniq va lo'nda bo'lsin.\n5. Narxlar haqida so'ralsa, faqat bazadagi aniq raqamlarni ayting.\n6. Markdown (**, *, `) belgilarini ishlatmang.",
+    'ru': "Вы {bot_name} - виртуальный помощник торговой платформы. \nСТРОГИЕ ПРАВИЛА:\n1. Отвечайте ТОЛЬКО на основе предоставленной БАЗЫ ЗНАНИЙ.\n2. НЕ добавляйте информацию от себя.\n3. Если ответа нет в базе, скажите: 'Извините, у меня нет информации об этом. Пожалуйста, обратитесь к оператору.'\n4. Избегайте лишних слов и длинных вступлений. Ответ должен быть кратким и точным.\n5. НИКОГДА не используйте markdown (**).",
+    'en': "You are {bot_name}, a virtual assistant. \nSTRICT RULES:\n1. Answer ONLY based on the provided KNOWLEDGE BASE.\n2. Do NOT add external information.\n3. If the answer is not in the base, say: 'Sorry, I don't have information about this. Please contact the operator.'\n4. Keep answers concise and direct.\n5. NEVER use markdown (**)."
+}
+
+@functools.lru_cache(maxsize=256)
+def _base_prompt(bot_name: str, user_language: str) -> str:
+    """
+    Language-specific system prompt for a bot (formatted once per bot name/language)
+    """
+    return _PROMPT_TEMPLATES.get(user_language, _PROMPT_TEMPLATES['uz']).format(bot_name=bot_name)
+
+@functools.lru_cache(maxsize=8)
+def _format_contact_suffix(support_phone: str, support_tg: str) -> str:
+    contact_block = []
+    if support_phone:
+        contact_block.append(f"Admin telefon raqami: {support_phone}")
+    if support_tg:
+        contact_block.append(f"Telegram aloqa: {support_tg}")
+    if not contact_block:
+        return ""
+    return "\n\nQO'SHIMCHA ALOQA MA'LUMOTLARI:\n" + "\n".join(contact_block) + "\n"
+
+def _contact_suffix() -> str:
+    """
+    Platform contact info block, cached per (SUPPORT_PHONE, SUPPORT_TELEGRAM) config snapshot
+    """
+    try:
+        support_phone = (current_app.config.get('SUPPORT_PHONE') or '').strip()
+        support_tg = (current_app.config.get('SUPPORT_TELEGRAM') or '').strip()
+    except Exception:
+        return ""
+    return _format_contact_suffix(support_phone, support_tg)
+
+@functools.lru_cache(maxsize=64)
+def _knowledge_chunks(knowledge_base: str) -> Tuple[Tuple[str, str], ...]:
+    """
+    Split a combined knowledge base into (chunk, lowercased chunk) pairs
+    Keyed by the KB string itself, so the split runs once per KB version.
+    """
+    chunks = [chunk.strip() for chunk in knowledge_base.split("\n\n")]
+    return tuple((chunk, chunk.lower()) for chunk in chunks if chunk)
+
+def _select_relevant_knowledge(knowledge_base: str, message: str, limit: int) -> str:
+    """
+    Fit the knowledge base into `limit` characters, most relevant chunks first
+    Chunks are ranked by how many words of the user message they contain, so the
+    product the user asked about is not dropped by a blind knowledge_base[:limit].
+    """
+    if len(knowledge_base) <= limit:
+        return knowledge_base
+    
+    words = _tokenize(message)
+    chunks = _knowledge_chunks(knowledge_base)
+    scored = []
+    for index, (chunk, lowered) in enumerate(chunks):
+        score = sum(1 for w in words if w in lowered)
+        scored.append((-score, index, chunk))
+    scored.sort()
+    
+    selected = []
+    used = 0
+    for _, _, chunk in scored:
+        size = len(chunk) + 2
+        if used + size > limit:
+            continue
+        selected.append(chunk)
+        used += size
+    if not selected:
+        return knowledge_base[:limit]
+    return "\n\n".join(selected)
+
+def _kb_char_limit() -> int:
+    """Knowledge base character budget (Gemini Flash handles large context well)"""
+    try:
+        return int(current_app.config.get('KB_CHAR_LIMIT', KB_CHAR_LIMIT))
+    except Exception:
+        return KB_CHAR_LIMIT
+
+def _knowledge_block(knowledge_base: str) -> str:
+    return f"\n\nSizda quyidagi bilim bazasi mavjud:\n{knowledge_base}\n\nAgar foydalanuvchi yuqoridagi ma'lumotlar haqida so'rasa, aniq va to'liq javob bering."
+
+def _history_block(chat_history: str) -> str:
+    return f"Oldingi suhbatlar:\n{chat_history}\n\nYuqoridagi suhbatlarni eslab qoling va kontekst asosida javob bering."
+
+SYSTEM_PROMPT_LIMIT = 3000  # Instructions, history and contact info - on top of the KB_CHAR_LIMIT knowledge base
+# Faqat salomlashish/minnatdorchilik xabarlari: bilim bazasi kerak emas
+_SMALL_TALK_RE = re.compile(
+    r"^\s*(salom|assalomu alaykum|hello|hi|hey|привет|здравствуйте|rahmat|raxmat|katta rahmat|thanks|thank you|спасибо)[\s!.,)]*$",
+    re.IGNORECASE
+)
+
+def _build_full_prompt(message: str, bot_name: str, user_language: str, knowledge_base: str, chat_history: str) -> str:
+    """
+    Assemble system prompt, contact info, knowledge base, history and the user question
+    Sections share KB_CHAR_LIMIT + SYSTEM_PROMPT_LIMIT by priority: knowledge base (up to
+    KB_CHAR_LIMIT, as on the context-cache path), then the most recent history, then
+    contact info - instead of cutting whatever comes last.
+    """
+    base = _base_prompt(bot_name, user_language)
+    kb_limit = _kb_char_limit()
+    budget = kb_limit + SYSTEM_PROMPT_LIMIT - len(base)
+    
+    # Add knowledge base context if available (skipped for plain greetings/thanks)
+    kb_part = ""
+    if knowledge_base and not _SMALL_TALK_RE.match(message):
+        kb_budget = min(kb_limit, budget - len(_knowledge_block("")))
+        if kb_budget > 0:
+            limited_kb = _select_relevant_knowledge(knowledge_base, message, kb_budget)
+            kb_part = _knowledge_block(limited_kb)
+            budget -= len(kb_part)
             
             # Debug: log knowledge base uzunligi
-            logging.info(f"DEBUG: Knowledge base length: {len(knowledge_base)}, Limited to: {len(limited_kb)}")
-        
-        # Add chat history context if available
-        if chat_history:
-            system_prompt += f"\n\nOldingi suhbatlar:\n{chat_history}\n\nYuqoridagi suhbatlarni eslab qoling va kontekst asosida javob bering."
-        
-        # Create the prompt (optimize for shorter context)
-        if len(system_prompt) > 3000:  # Limit system prompt length for speed
-            system_prompt = system_prompt[:3000] + "..."
-        
-        full_prompt = f"{system_prompt}\n\nFoydalanuvchi savoli: {message}"
+            logger.debug("DEBUG: Knowledge base length: %d, Limited to: %d", len(knowledge_base), len(limited_kb))
+    
+    # Add chat history context if available, keeping the latest turns
+    history_part = ""
+    if chat_history:
+        history_budget = budget - len("\n\n" + _history_block(""))
+        if history_budget > 0:
+            history_part = "\n\n" + _history_block(chat_history[-history_budget:])
+            budget -= len(history_part)
+    
+    # Inject platform contact info so bot can answer contact-related questions precisely
+    contact_part = _contact_suffix()
+    if len(contact_part) > budget:
+        contact_part = ""
+    
+    system_prompt = "".join([base, contact_part, kb_part, history_part])
+    return f"{system_prompt}\n\nFoydalanuvchi savoli: {message}"
+
+# Gemini explicit context caching: statik prefiks (system prompt + bilim bazasi) serverga
+# bir marta yuklanadi, keyingi so'rovlar faqat tarix va savolni yuboradi.
+CONTEXT_CACHE_ENABLED = os.environ.get('GEMINI_CONTEXT_CACHE', '').lower() in ('1', 'true', 'yes')
+CONTEXT_CACHE_MODEL = os.environ.get('GEMINI_CONTEXT_CACHE_MODEL', f'models/{GEMINI_MODEL}')
+CONTEXT_CACHE_TTL = 3600  # 1 soat
+CONTEXT_CACHE_MIN_CHARS = 4000  # Gemini minimal token talabidan kichik prefikslarni yubormaslik
+_context_caches: Dict[Tuple[int, str, str], Tuple[str, Any, float]] = {}  # (bot_id, bot_name, til) -> (digest, CachedContent|None, expires_at)
+_context_cache_lock = threading.Lock()
+
+def _static_prompt_prefix(bot_name: str, user_language: str, knowledge_base: str) -> str:
+    """System prompt, contact info and knowledge base - identical on every turn"""
+    return "".join([
+        _base_prompt(bot_name, user_language),
+        _contact_suffix(),
+        _knowledge_block(knowledge_base[:_kb_char_limit()]),
+    ])
+
+def _build_prompt_tail(message: str, chat_history: str) -> str:
+    """Per-turn part of the prompt sent alongside a context cache"""
+    if chat_history:
+        return f"{_history_block(chat_history)}\n\nFoydalanuvchi savoli: {message}"
+    return f"Foydalanuvchi savoli: {message}"
+
+def _delete_context_cache(cached_content) -> None:
+    try:
+        cached_content.delete()
+    except Exception as e:
+        logger.debug("Gemini context cache delete failed: %s", e)
+
+def _get_context_cache(bot_id: Optional[int], bot_name: str, user_language: str, knowledge_base: str):
+    """
+    Return a live CachedContent for the bot's static prompt prefix, or None
+    Creation failures (unsupported model, prefix below the minimum token count) are
+    remembered for the TTL so they are not retried on every message.
+    """
+    if not (CONTEXT_CACHE_ENABLED and GEMINI_AVAILABLE and bot_id is not None and knowledge_base):
+        return None
+    prefix = _static_prompt_prefix(bot_name, user_language, knowledge_base)
+    if len(prefix) < CONTEXT_CACHE_MIN_CHARS:
+        return None
+    
+    digest = hashlib.sha1(prefix.encode('utf-8')).hexdigest()
+    key = (bot_id, bot_name, user_language)
+    now = time.monotonic()
+    with _context_cache_lock:
+        entry = _context_caches.get(key)
+    if entry and entry[0] == digest and entry[2] > now:
+        return entry[1]
+    
+    try:
+        cached_content = genai.caching.CachedContent.create(
+            model=CONTEXT_CACHE_MODEL,
+            display_name=f"bot-{bot_id}-{user_language}",
+            system_instruction=prefix,
+            ttl=datetime.timedelta(seconds=CONTEXT_CACHE_TTL)
+        )
+        logger.info("Gemini context cache created for bot %s (%s): %s", bot_id, user_language, cached_content.name)
+    except Exception as e:
+        logger.warning("Gemini context cache unavailable for bot %s: %s", bot_id, e)
+        cached_content = None
+    
+    with _context_cache_lock:
+        # Server TTL tugashidan biroz oldin yangilash
+        _context_caches[key] = (digest, cached_content, now + CONTEXT_CACHE_TTL - 60)
+    if entry and entry[1] is not None and entry[0] != digest:
+        _delete_context_cache(entry[1])
+    return cached_content
+
+def context_cache_bump(bot_id: int) -> None:
+    """Drop (and delete server-side) context caches of a bot after a knowledge base change"""
+    with _context_cache_lock:
+        stale = [_context_caches.pop(key) for key in [k for k in _context_caches if k[0] == bot_id]]
+    for _, cached_content, _ in stale:
+        if cached_content is not None:
+            _delete_context_cache(cached_content)
+
+_ERR_TABLE = str.maketrans({
+    '\u2019': "'", '\u2018': "'", '\u201c': '"', '\u201d': '"',
+    '\u2013': '-', '\u2014': '-', '\u2026': '...', '\u00a0': ' ',
+    '\u2010': '-', '\u2011': '-', '\u2012': '-', '\u2015': '-'
+})
+
+def _log_ai_error(e: Exception) -> None:
+    """Safe error logging to prevent encoding issues"""
+    try:
+        error_msg = str(e).translate(_ERR_TABLE).encode('ascii', errors='ignore').decode('ascii')
+        logger.error("AI response error: %s", error_msg)
+    except:
+        logger.error("AI response error: Unicode encoding issue")
+
+def _generation_config():
+    # Use faster model configuration for quicker responses
+    return genai.types.GenerationConfig(
+        temperature=0.7,  # Slightly lower for faster generation
+        max_output_tokens=500,  # Limit output for speed
+        top_p=0.9,
+        top_k=40
+    )
+
+# Bitta model obyekti qayta ishlatiladi (SDK gRPC kanali jarayon bo'yi saqlanadi).
+# generation_config o'zgarsa, yangi GenerativeModel kerak bo'ladi.
+_MODEL = genai.GenerativeModel(GEMINI_MODEL, generation_config=_generation_config()) if GEMINI_AVAILABLE else None
+
+def get_ai_response(message: str, bot_name: str = "Chatbot Factory AI", user_language: str = "uz", knowledge_base: str = "", chat_history: str = "", bot_id: Optional[int] = None) -> Optional[str]:
+    """
+    Generate AI response using Google Gemini with chat history context
+    bot_id enables the per-bot semantic cache (see semantic_cache.py)
+    """
+    try:
+        cached, cache_key, semantic_namespace, semantic_embedding = _lookup_cached_response(
+            message, bot_name, user_language, knowledge_base, chat_history, bot_id
+        )
+        if cached is not None:
+            return cached
         
         # Generate response using Gemini with optimization settings
         if not GEMINI_AVAILABLE:
             return get_fallback_response(user_language)
-            
-        # Use faster model configuration for quicker responses
-        generation_config = genai.types.GenerationConfig(
-            temperature=0.7,  # Slightly lower for faster generation
-            max_output_tokens=500,  # Limit output for speed
-            top_p=0.9,
-            top_k=40
-        )
         
-        # Use gemini-flash-lite-latest as requested by user
-        model = genai.GenerativeModel(
-            'gemini-flash-lite-latest',
-            generation_config=generation_config
-        )
-        response = model.generate_content(full_prompt)
+        cached_content = _get_context_cache(bot_id, bot_name, user_language, knowledge_base)
+        if cached_content is not None:
+            model = genai.GenerativeModel.from_cached_content(
+                cached_content=cached_content,
+                generation_config=_generation_config()
+            )
+            prompt = _build_prompt_tail(message, chat_history)
+        else:
+            # Use gemini-flash-lite-latest as requested by user
+            model = _MODEL
+            prompt = _build_full_prompt(message, bot_name, user_language, knowledge_base, chat_history)
+        response = model.generate_content(prompt)
         
         if response.text:
+            _remember_response(cache_key, semantic_namespace, semantic_embedding, response.text)
             # Return response as-is, let Telegram handler deal with encoding
             return response.text
         else:
             return get_fallback_response(user_language)
             
     except Exception as e:
-        # Safe error logging to prevent encoding issues  
-        try:
-            error_msg = str(e)
-            unicode_replacements = {
-                '\u2019': "'", '\u2018': "'", '\u201c': '"', '\u201d': '"',
-                '\u2013': '-', '\u2014': '-', '\u2026': '...', '\u00a0': ' ',
-                '\u2010': '-', '\u2011': '-', '\u2012': '-', '\u2015': '-'
-            }
-            
-            for unicode_char, replacement in unicode_replacements.items():
-                error_msg = error_msg.replace(unicode_char, replacement)
-            
-            error_msg = error_msg.encode('ascii', errors='ignore').decode('ascii')
-            logging.error(f"AI response error: {error_msg}")
-        except:
-            logging.error("AI response error: Unicode encoding issue")
+        _log_ai_error(e)
         return get_fallback_response(user_language)
 
+def _async_generation_config(cached_content: Optional[str] = None):
+    # Same settings as _generation_config() for the google-genai client
+    return genai_types.GenerateContentConfig(
+        temperature=0.7,
+        max_output_tokens=500,
+        top_p=0.9,
+        top_k=40,
+        cached_content=cached_content
+    )
+
+async def _async_request_args(message: str, bot_name: str, user_language: str, knowledge_base: str, chat_history: str, bot_id: Optional[int]):
+    """(model, contents, config) for the aio client, using the bot's context cache when available"""
+    cached_content = None
+    if CONTEXT_CACHE_ENABLED:
+        # Kesh yaratish bloklovchi chaqiruv - event loop'ni to'xtatmaslik uchun thread'da
+        cached_content = await asyncio.to_thread(_get_context_cache, bot_id, bot_name, user_language, knowledge_base)
+    if cached_content is not None:
+        return CONTEXT_CACHE_MODEL, _build_prompt_tail(message, chat_history), _async_generation_config(cached_content.name)
+    full_prompt = _build_full_prompt(message, bot_name, user_language, knowledge_base, chat_history)
+    return GEMINI_MODEL, full_prompt, _async_generation_config()
+
+async def _run_in_ai_executor(func, *args):
+    """Run a blocking call (Redis, embedding encode, sync SDK) on _AI_EXECUTOR with the caller's context"""
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(_AI_EXECUTOR, functools.partial(ctx.run, func, *args))
+
+def _get_async_state():
+    """Per-event-loop google-genai client and concurrency semaphore"""
+    loop = asyncio.get_running_loop()
+    state = _async_state.get(loop)
+    if state is None:
+        # Client har bir loop uchun: uning ulanish pooli yaratilgan event loop'ga bog'langan
+        client = genai_sdk.Client(
+            api_key=os.environ.get("GOOGLE_API_KEY", "default_key"),
+            http_options=genai_types.HttpOptions(timeout=30_000)
+        )
+        state = (client, asyncio.Semaphore(MAX_CONCURRENT_AI_REQUESTS))
+        _async_state[loop] = state
+    return state
+
+async def _generate_content_async(model: str, contents, config):
+    """generate_content on the aio client, capped by the loop's semaphore"""
+    client, semaphore = _get_async_state()
+    async with semaphore:
+        return await client.aio.models.generate_content(model=model, contents=contents, config=config)
+
+async def get_ai_response_async(message: str, bot_name: str = "Chatbot Factory AI", user_language: str = "uz", knowledge_base: str = "", chat_history: str = "", bot_id: Optional[int] = None) -> Optional[str]:
+    """
+    Async variant of get_ai_response using the google-genai aio client
+    Concurrent messages overlap on the event loop instead of blocking a worker thread.
+    """
+    if not GENAI_ASYNC_AVAILABLE:
+        # google-genai o'rnatilmagan: sinxron yo'lni thread'da bajarish (Flask konteksti bilan)
+        return await _run_in_ai_executor(
+            get_ai_response, message, bot_name, user_language, knowledge_base, chat_history, bot_id
+        )
+    
+    try:
+        # Redis GET va semantik embedding (CPU) event loop'ni to'xtatmasligi uchun thread'da
+        cached, cache_key, semantic_namespace, semantic_embedding = await _run_in_ai_executor(
+            _lookup_cached_response, message, bot_name, user_language, knowledge_base, chat_history, bot_id
+        )
+        if cached is not None:
+            return cached
+        
+        model, contents, config = await _async_request_args(
+            message, bot_name, user_language, knowledge_base, chat_history, bot_id
+        )
+        
+        response = await _generate_content_async(model, contents, config)
+        
+        if response.text:
+            await _run_in_ai_executor(_remember_response, cache_key, semantic_namespace, semantic_embedding, response.text)
+            return response.text
+        return get_fallback_response(user_language)
+    
+    except Exception as e:
+        _log_ai_error(e)
+        return get_fallback_response(user_language)
+
+async def stream_ai_response_async(message: str, bot_name: str = "Chatbot Factory AI", user_language: str = "uz", knowledge_base: str = "", chat_history: str = "", bot_id: Optional[int] = None):
+    """
+    Yield response text chunks as Gemini generates them
+    The concatenated text is cached at stream end; cache hits and fallbacks arrive as one chunk.
+    """
+    if not GENAI_ASYNC_AVAILABLE:
+        yield await get_ai_response_async(message, bot_name, user_language, knowledge_base, chat_history, bot_id)
+        return
+    
+    parts = []
+    completed = False
+    try:
+        cached, cache_key, semantic_namespace, semantic_embedding = await _run_in_ai_executor(
+            _lookup_cached_response, message, bot_name, user_language, knowledge_base, chat_history, bot_id
+        )
+        if cached is not None:
+            yield cached
+            return
+        
+        model, contents, config = await _async_request_args(
+            message, bot_name, user_language, knowledge_base, chat_history, bot_id
+        )
+        
+        client, semaphore = _get_async_state()
+        async with semaphore:
+            stream = await client.aio.models.generate_content_stream(
+                model=model,
+                contents=contents,
+                config=config
+            )
+            async for chunk in stream:
+                if chunk.text:
+                    parts.append(chunk.text)
+                    yield chunk.text
+        completed = True
+    except Exception as e:
+        _log_ai_error(e)
+    
+    if not parts:
+        yield get_fallback_response(user_language)
+    elif completed:
+        # Faqat to'liq yakunlangan javobni keshlash
+        await _run_in_ai_executor(_remember_response, cache_key, semantic_namespace, semantic_embedding, "".join(parts))
+
+_FALLBACK_RESPONSES = {
+    'uz': "Salom! Men BotFactory AI botiman. Hozir AI xizmat sozlanmoqda. Tez orada sizga yordam bera olaman! 🤖",
+    'ru': "Привет! Я BotFactory AI бот. Сейчас настраивается AI сервис. Скоро смогу помочь вам! 🤖",
+    'en': "Hello! I'm BotFactory AI bot. AI service is being configured now. I'll be able to help you soon! 🤖"
+}
+
 def get_fallback_response(language: str = "uz") -> str:
     """
     Fallback responses when AI fails
     """
-    fallback_responses = {
-        'uz': "Salom! Men BotFactory AI botiman. Hozir AI xizmat sozlanmoqda. Tez orada sizga yordam bera olaman! 🤖",
-        'ru': "Привет! Я BotFactory AI бот. Сейчас настраивается AI сервис. Скоро смогу помочь вам! 🤖",
-        'en': "Hello! I'm BotFactory AI bot. AI service is being configured now. I'll be able to help you soon! 🤖"
-    }
-    return fallback_responses.get(language, fallback_responses['uz'])
+    return _FALLBACK_RESPONSES.get(language, _FALLBACK_RESPONSES['uz'])
+
+# Yig'ilgan bilim bazasi matni keshi: bot_id -> (versiya, matn)
+# Versiya = (yozuvlar soni, eng katta id, kontent uzunliklari yig'indisi, tahrir avlodi) - qo'shish/o'chirish
+# va ko'p tahrirlar so'rovning o'zida ko'rinadi; avlod Redis'da kb_cache_bump() bilan oshiriladi,
+# Redis bo'lmasa har KB_CACHE_TTL davrda almashadi (bot manager alohida jarayonda ham eskirmasligi uchun)
+_KB_CACHE: Dict[int, Tuple[Tuple[int, Optional[int], int, int], str, float]] = {}
+KB_CACHE_TTL = float(os.environ.get('KB_CACHE_TTL', '120'))  # Shu vaqt ichida versiya so'rovi ham qilinmaydi
+
+def _knowledge_base_generation(bot_id: int) -> int:
+    """
+    Edit generation of a bot's knowledge base
+    Redis carries kb_cache_bump() across processes; without it edits made elsewhere cannot be
+    signalled, so the generation rolls over every KB_CACHE_TTL and forces a rebuild instead.
+    """
+    shared = _shared_response_cache()
+    if shared:
+        return shared.knowledge_base_generation(bot_id)
+    if KB_CACHE_TTL <= 0:
+        return time.monotonic_ns()
+    return int(time.time() // KB_CACHE_TTL)
+
+def _knowledge_base_version(bot_id: int) -> Tuple[int, Optional[int], int, int]:
+    """Cheap indexed probe that changes whenever entries are added, removed or edited"""
+    from models import KnowledgeBase
+    from app import db
+    
+    count, max_id, content_length = db.session.query(
+        db.func.count(KnowledgeBase.id),
+        db.func.max(KnowledgeBase.id),
+        db.func.sum(db.func.length(KnowledgeBase.content))
+    ).filter(KnowledgeBase.bot_id == bot_id).one()
+    return int(count or 0), max_id, int(content_length or 0), _knowledge_base_generation(bot_id)
+
+def kb_cache_bump(bot_id: int) -> None:
+    """
+    Invalidate cached knowledge base for a bot
+    Call from knowledge base write paths. Local caches are dropped here; other processes see the
+    bumped Redis generation on their next version probe (without Redis, within KB_CACHE_TTL).
+    """
+    _KB_CACHE.pop(bot_id, None)
+    _PRODUCT_INDEX.pop(bot_id, None)
+    context_cache_bump(bot_id)
+    semantic_cache.clear(bot_id)  # Eski bilim bazasi digest'i bilan yozilgan nomlar maydonlari
+    shared = _shared_response_cache()
+    if shared:
+        shared.bump_knowledge_base_generation(bot_id)
+        shared.invalidate_knowledge_base(bot_id)
 
 def process_knowledge_base(bot_id: int) -> str:
     """
     Process and combine knowledge base content for a bot
+    Result is memoized per bot: served without any query for KB_CACHE_TTL seconds,
+    then revalidated against the knowledge base version.
+    """
+    try:
+        now = time.monotonic()
+        cached = _KB_CACHE.get(bot_id)
+        if cached and now - cached[2] < KB_CACHE_TTL:
+            return cached[1]
+        version = _knowledge_base_version(bot_id)
+        if cached and cached[0] == version:
+            _KB_CACHE[bot_id] = (version, cached[1], now)
+            return cached[1]
+        combined = _build_knowledge_base(bot_id)
+        _KB_CACHE[bot_id] = (version, combined, now)
+        return combined
+    except Exception as e:
+        logger.error("Knowledge base processing error: %s", e)
+        return ""
+
+def _build_knowledge_base(bot_id: int) -> str:
+    """
+    Combine all knowledge base entries of a bot into one prompt-ready string
     """
     from models import KnowledgeBase
     
     try:
         knowledge_entries = KnowledgeBase.query.filter_by(bot_id=bot_id).all()
-        combined_knowledge = ""
+        parts = []
         
         # Debug: log bilim bazasi mavjudligi
-        logging.info(f"DEBUG: Bot {bot_id} uchun {len(knowledge_entries)} ta bilim bazasi yozuvi topildi")
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("DEBUG: Bot %s uchun %d ta bilim bazasi yozuvi topildi", bot_id, len(knowledge_entries))
         
         for entry in knowledge_entries:
-            logging.info(f"DEBUG: Processing entry - Type: {entry.content_type}, Source: {entry.source_name}")
+            if debug:
+                logger.debug("DEBUG: Processing entry - Type: %s, Source: %s", entry.content_type, entry.source_name)
             
             if entry.content_type == 'product':
                 # For products, format them clearly for AI with detailed structure
                 product_text = f"=== MAHSULOT MA'LUMOTI ===\n{entry.content}\n=== MAHSULOT OXIRI ===\n"
-                combined_knowledge += product_text + "\n"
-                logging.info(f"DEBUG: Product added to knowledge: {entry.source_name}")
+                parts.append(product_text + "\n")
+                if debug:
+                    logger.debug("DEBUG: Product added to knowledge: %s", entry.source_name)
             elif entry.content_type == 'image':
                 # For images, add description about the image
                 image_info = f"Rasm: {entry.filename or 'Yuklangan rasm'}"
                 if entry.source_name:
                     image_info += f" ({entry.source_name})"
                 image_info += f" - bu mahsulot/xizmat haqidagi vizual ma'lumot. Foydalanuvchi ushbu rasm haqida so'rasa, unga rasm haqida ma'lumot bering."
-                combined_knowledge += f"{image_info}\n\n"
-                logging.info(f"DEBUG: Image added to knowledge: {entry.source_name or entry.filename}")
+                parts.append(f"{image_info}\n\n")
+                if debug:
+                    logger.debug("DEBUG: Image added to knowledge: %s", entry.source_name or entry.filename)
             else:
                 # For text and file content
-                combined_knowledge += f"{entry.content}\n\n"
-                logging.info(f"DEBUG: File content added to knowledge: {entry.filename}")
+                parts.append(f"{entry.content}\n\n")
+                if debug:
+                    logger.debug("DEBUG: File content added to knowledge: %s", entry.filename)
         
-        logging.info(f"DEBUG: Combined knowledge length: {len(combined_knowledge)} characters")
-        if combined_knowledge:
-            logging.info(f"DEBUG: First 200 chars of knowledge: {combined_knowledge[:200]}...")
+        combined_knowledge = "".join(parts)
+        if debug:
+            logger.debug("DEBUG: Combined knowledge length: %d characters", len(combined_knowledge))
+            if combined_knowledge:
+                logger.debug("DEBUG: First 200 chars of knowledge: %s...", combined_knowledge[:200])
         
         return combined_knowledge.strip()
     except Exception as e:
-        logging.error(f"Knowledge base processing error: {str(e)}")
+        logger.error("Knowledge base processing error: %s", e)
         return ""
 
+# Rasm qidiruvi uchun mahsulot indeksi: bot_id -> (KB versiyasi, [(nom, manba, kontent tokenlari, rasm URL, nom)], postings)
+_PRODUCT_INDEX: Dict[int, Tuple[Tuple[int, Optional[int], int, int], list, Optional[dict]]] = {}
+PRODUCT_VECTOR_MIN = 200  # Shundan ko'p mahsulotli botlar uchun numpy bilan ballash
+_GENERIC_WORDS = frozenset(['mahsulot', 'narx', 'som', 'dollar', 'paket', 'zip', 'rasm', 'tavsif', 'haqida'])
+# So'zlar: harf/raqamlar, o'rtadagi o'zbekcha apostroflar bilan (o'yinchoq, g'isht)
+_TOKEN_RE = re.compile(r"\w[\w'ʻʼ‘’]*\w")
+
+_PRODUCT_FIELDS_RE = re.compile(r'^(Mahsulot|Rasm):(.*)$', re.MULTILINE)
+
+def _tokenize(text: str) -> frozenset:
+    return frozenset(w for w in _TOKEN_RE.findall(text.lower()) if len(w) > 2)
+
+def _build_product_index(bot_id: int) -> list:
+    """Tokenize image-bearing products once per knowledge base version"""
+    from models import KnowledgeBase
+    
+    # Faqat rasmli mahsulotlar: filtr DB tomonida, faqat kerakli ustunlar
+    rows = KnowledgeBase.query.filter(
+        KnowledgeBase.bot_id == bot_id,
+        KnowledgeBase.content_type == 'product',
+        KnowledgeBase.content.like('%Rasm:%http%')
+    ).with_entities(KnowledgeBase.source_name, KnowledgeBase.content).all()
+    
+    index = []
+    for source_name, content in rows:
+        actual_product_name = ""
+        image_url = ""
+        # Bitta regex o'tishi: ikkala maydon topilishi bilan to'xtaydi
+        for match in _PRODUCT_FIELDS_RE.finditer(content):
+            field, value = match.group(1), match.group(2).strip()
+            if field == 'Mahsulot':
+                actual_product_name = actual_product_name or value
+            elif not image_url and 'http' in value:
+                image_url = value
+            if actual_product_name and image_url:
+                break
+        
+        # Only consider products with images
+        if not image_url:
+            continue
+        index.append((
+            _tokenize(actual_product_name),
+            _tokenize(source_name or ""),
+            _tokenize(content),
+            image_url,
+            source_name or actual_product_name or 'Mahsulot',
+        ))
+    return index
+
+def _build_product_postings(products: list) -> dict:
+    """
+    Inverted index token -> (product rows, weights) with the 10/5/1 weights pre-summed
+    Scoring a message becomes a few vectorized scatter-adds instead of a loop over products.
+    """
+    weights: Dict[str, Dict[int, int]] = {}
+    for row, (name_tokens, source_tokens, content_tokens, _, _) in enumerate(products):
+        for tokens, weight in ((name_tokens, 10), (source_tokens, 5), (content_tokens - _GENERIC_WORDS, 1)):
+            for token in tokens:
+                rows = weights.setdefault(token, {})
+                rows[row] = rows.get(row, 0) + weight
+    return {
+        token: (np.fromiter(rows.keys(), dtype=np.int32, count=len(rows)),
+                np.fromiter(rows.values(), dtype=np.int32, count=len(rows)))
+        for token, rows in weights.items()
+    }
+
+def _product_index(bot_id: int) -> Tuple[list, Optional[dict]]:
+    version = _knowledge_base_version(bot_id)
+    cached = _PRODUCT_INDEX.get(bot_id)
+    if cached and cached[0] == version:
+        return cached[1], cached[2]
+    products = _build_product_index(bot_id)
+    postings = None
+    if NUMPY_AVAILABLE and len(products) >= PRODUCT_VECTOR_MIN:
+        postings = _build_product_postings(products)
+    _PRODUCT_INDEX[bot_id] = (version, products, postings)
+    return products, postings
+
+def _best_product_vectorized(products: list, postings: dict, user_words: frozenset) -> Tuple[Optional[int], int]:
+    scores = np.zeros(len(products), dtype=np.int32)
+    for token in user_words:
+        posting = postings.get(token)
+        if posting is not None:
+            scores[posting[0]] += posting[1]  # Har bir tokenda qatorlar takrorlanmaydi
+    best = int(scores.argmax())
+    return best, int(scores[best])
+
+def _best_product(products: list, user_words: frozenset) -> Tuple[Optional[int], int]:
+    content_words = user_words - _GENERIC_WORDS
+    best, best_score = None, 0
+    for row, (name_tokens, source_tokens, content_tokens, _, _) in enumerate(products):
+        # High score for product name match, medium for source name,
+        # low for content match (but avoid generic words)
+        score = (10 * len(user_words & name_tokens)
+                 + 5 * len(user_words & source_tokens)
+                 + len(content_words & content_tokens))
+        if score > best_score:
+            best, best_score = row, score
+    return best, best_score
+
 def find_relevant_product_images(bot_id: int, user_message: str) -> list:
     """
     Find the most relevant product image based on user's message
     Returns only the best matching product, not all products
     """
-    from models import KnowledgeBase
-    
     try:
-        # Get products that match user's message
-        products = KnowledgeBase.query.filter_by(bot_id=bot_id, content_type='product').all()
-        
+        products, postings = _product_index(bot_id)
         if not products:
             return []
         
-        user_message_lower = user_message.lower()
-        user_words = [word.strip() for word in user_message_lower.split() if len(word.strip()) > 2]
-        
-        best_match = None
-        best_score = 0
-        
-        for product in products:
-            product_content = product.content.lower()
-            product_name = (product.source_name or "").lower()
-            
-            # Calculate relevance score
-            score = 0
-            
-            # Extract product name from content
-            lines = product.content.split('\n')
-            actual_product_name = ""
-            for line in lines:
-                if line.startswith('Mahsulot:'):
-                    actual_product_name = line.replace('Mahsulot:', '').strip().lower()
-                    break
-            
-            # High score for exact product name match
-            if actual_product_name:
-                for user_word in user_words:
-                    if user_word in actual_product_name:
-                        score += 10
-                        
-            # Medium score for source name match
-            if product_name:
-                for user_word in user_words:
-                    if user_word in product_name:
-                        score += 5
-                        
-            # Low score for content match (but avoid generic words)
-            generic_words = ['mahsulot', 'narx', 'som', 'dollar', 'paket', 'zip', 'rasm', 'tavsif', 'haqida']
-            for user_word in user_words:
-                if user_word not in generic_words and user_word in product_content:
-                    score += 1
-            
-            # Only consider products with images
-            has_image = False
-            image_url = ""
-            for line in lines:
-                if line.startswith('Rasm:') and 'http' in line:
-                    image_url = line.replace('Rasm:', '').strip()
-                    has_image = True
-                    break
-            
-            # Update best match if this product scores higher and has an image
-            if has_image and score > best_score:
-                best_score = score
-                best_match = {
-                    'url': image_url,
-                    'product_name': product.source_name or actual_product_name or 'Mahsulot',
-                    'caption': f"📦 {product.source_name or actual_product_name or 'Mahsulot'}"
-                }
+        user_words = _tokenize(user_message)
+        if postings is not None:
+            best, best_score = _best_product_vectorized(products, postings, user_words)
+        else:
+            best, best_score = _best_product(products, user_words)
         
         # Return only the best match, or empty list if no good match found
-        if best_match and best_score >= 3:  # Minimum score threshold
-            return [best_match]
+        if best is not None and best_score >= 3:  # Minimum score threshold
+            _, _, _, image_url, display_name = products[best]
+            return [{
+                'url': image_url,
+                'product_name': display_name,
+                'caption': f"📦 {display_name}"
+            }]
         else:
             return []
             
     except Exception as e:
-        logging.error(f"Error finding product images: {str(e)}")
+        logger.error("Error finding product images: %s", e)
         return []
 
+_MD_TABLE = str.maketrans('', '', '*`')  # '**' ham ikkita '*' sifatida o'chadi
+
 def validate_ai_response(response: Optional[str], max_length: int = 4000) -> Optional[str]:
     """
     Validate and clean AI response
@@ -246,8 +815,8 @@ def validate_ai_response(response: Optional[str], max_length: int = 4000) -> Opt
     if not response:
         return None
     
-    # Remove markdown formatting
-    response = response.replace('**', '').replace('*', '').replace('`', '')
+    # Remove markdown formatting (single pass)
+    response = response.translate(_MD_TABLE)
     
     # Limit response length
     if len(response) > max_length:
@@ -1,33 +1,45 @@
 import os
+import json
+import time
+import hashlib
 import logging
+import importlib
+import importlib.util
+import tempfile
+import types
+import atexit
 from datetime import datetime
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 # Load .env file
 load_dotenv()
-from flask import Flask, request
+from flask import Flask, request, g
 from flask_wtf import CSRFProtect
 from flask_wtf.csrf import generate_csrf
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from sqlalchemy import event
 from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy import create_engine, text
 from werkzeug.middleware.proxy_fix import ProxyFix
+from config import web_concurrency
 
 # Professional logging tizimini ishga tushirish
-try:
-    from logging_config import setup_logging, error_tracker, ContextLogger
+if importlib.util.find_spec('logging_config') is not None:
+    from logging_config import setup_logging
     setup_logging()
     logger = logging.getLogger(__name__)
     logger.info("Chatbot Factory AI application starting with professional logging")
-except Exception as e:
-    # Fallback basic logging for any error
+else:
+    # Fallback basic logging when logging_config module is missing
     logging.basicConfig(
         level=logging.INFO,
         format='[%(asctime)s] %(levelname)s: %(message)s'
     )
     logger = logging.getLogger(__name__)
-    logger.warning(f"Using fallback logging configuration due to: {e}")
+    logger.warning("logging_config module not found - using fallback logging configuration")
 
 class Base(DeclarativeBase):
     pass
@@ -44,35 +56,116 @@ if not app.secret_key:
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 csrf = CSRFProtect(app)
 
+# Response compression (br/gzip) for HTML/JSON/CSS/JS
+try:
+    from flask_compress import Compress
+    app.config['COMPRESS_MIMETYPES'] = [
+        'text/html', 'text/css', 'text/xml', 'text/plain',
+        'application/json', 'application/javascript', 'image/svg+xml'
+    ]
+    app.config['COMPRESS_LEVEL'] = 5
+    app.config['COMPRESS_BR_LEVEL'] = 5
+    app.config['COMPRESS_MIN_SIZE'] = 500
+    app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+    Compress(app)
+except ImportError:
+    logger.warning("flask-compress not installed - responses are sent uncompressed")
+
+# orjson-backed app.json (jsonify / request.get_json on webhook hot paths)
+try:
+    import orjson
+    from flask.json.provider import DefaultJSONProvider
+
+    class OrjsonProvider(DefaultJSONProvider):
+        """DefaultJSONProvider with orjson encode/decode; unknown types still go through default()"""
+        # datetime/date default() orqali - stdlib provider kabi HTTP sana formatida (orjson ISO 8601 o'rniga)
+        OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+        def dumps(self, obj, **kwargs):
+            return orjson.dumps(obj, default=self.default, option=self.OPTIONS).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+    app.json = OrjsonProvider(app)
+except ImportError:
+    logger.warning("orjson not installed - using stdlib json provider")
+
 # Public contact configuration (used in templates)
 app.config['SUPPORT_TELEGRAM'] = os.environ.get('SUPPORT_TELEGRAM', 'https://t.me/akramjon0011')
 app.config['SUPPORT_PHONE'] = os.environ.get('SUPPORT_PHONE', '+998996448444')
 
+# Static files: max-age for send_file; USE_X_SENDFILE=1 lets a fronting nginx/Apache
+# stream file bodies (X-Sendfile) instead of Python read()/write() loops
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = int(os.environ.get('STATIC_MAX_AGE', '86400'))
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '0') == '1'
+
+# AI prompt: bilim bazasidan modelga yuboriladigan maksimal belgilar soni
+app.config['KB_CHAR_LIMIT'] = int(os.environ.get('KB_CHAR_LIMIT', '10000'))
+
 def test_database_connection(database_url, timeout=10):
     """Test database connectivity before Flask-SQLAlchemy initialization"""
     try:
         # Normalize postgres:// to postgresql:// for SQLAlchemy compatibility
         if database_url.startswith('postgres://'):
             database_url = database_url.replace('postgres://', 'postgresql://', 1)
+        if database_url.startswith('sqlite'):
+            return True, database_url
         
-        # Create a temporary engine for testing
-        test_engine = create_engine(
-            database_url,
-            pool_pre_ping=True,
-            connect_args={"connect_timeout": timeout} if "postgresql" in database_url else {}
-        )
-        
-        # Test the connection
-        with test_engine.connect() as conn:
-            conn.execute(text("SELECT 1"))
-        
-        test_engine.dispose()
+        # Raw psycopg2 ulanish: SQLAlchemy engine/pool yaratmasdan bitta SELECT 1
+        import psycopg2
+        dsn = database_url.replace('postgresql+psycopg2://', 'postgresql://', 1)
+        conn = psycopg2.connect(dsn, connect_timeout=timeout)
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+        finally:
+            conn.close()
         return True, database_url
         
     except Exception as e:
         logger.warning(f"Database connection test failed: {e}")
         return False, str(e)
 
+DB_PROBE_CACHE_FILE = os.path.join(tempfile.gettempdir(), 'botfactory_dbprobe.json')
+DB_PROBE_CACHE_TTL = 30  # soniya
+
+def cached_database_probe(database_url, timeout=10):
+    """
+    test_database_connection shared across gunicorn workers booting together
+    The first worker probes under an exclusive file lock and records the outcome;
+    the others reuse it for DB_PROBE_CACHE_TTL seconds instead of probing again.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return test_database_connection(database_url, timeout=timeout)
+    
+    url_key = hashlib.sha1(database_url.encode('utf-8')).hexdigest()
+    # Faqat natija (ok + xato matni) saqlanadi - DATABASE_URL (parol) faylga yozilmaydi; fayl 0600
+    fd = os.open(DB_PROBE_CACHE_FILE, os.O_RDWR | os.O_CREAT, 0o600)
+    with os.fdopen(fd, 'r+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            try:
+                cached = json.load(f)
+            except ValueError:
+                cached = {}
+            if cached.get('url') == url_key and time.time() - cached.get('ts', 0) < DB_PROBE_CACHE_TTL:
+                ok = cached.get('ok', False)
+                return ok, database_url if ok else cached.get('error', 'Database connection test failed')
+            
+            ok, result = test_database_connection(database_url, timeout=timeout)
+            f.seek(0)
+            f.truncate()
+            json.dump({'ts': time.time(), 'url': url_key, 'ok': ok, 'error': None if ok else result}, f)
+            f.flush()
+            return ok, result
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
 def get_fallback_sqlite_config():
     """Get SQLite database configuration for fallback"""
     base_dir = os.path.abspath(os.path.dirname(__file__))
@@ -92,53 +185,95 @@ def get_fallback_sqlite_config():
     
     return sqlite_url, sqlite_config
 
-# Cache control for different environments
+def configure_sqlite(engine):
+    """
+    WAL journal + memory-mapped reads for the SQLite database
+    WAL lets readers run while a writer commits (threads share the file via
+    check_same_thread=False); mmap serves page-cache hits without read() syscalls.
+    """
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA mmap_size=134217728")  # 128 MB
+        cursor.execute("PRAGMA cache_size=-65536")  # 64 MB
+        cursor.close()
+
+# Cache control for different environments - header sets are fixed at boot
+# Static files get "public, max-age=SEND_FILE_MAX_AGE_DEFAULT" plus ETag/Last-Modified from
+# Flask's send_file, so conditional GETs get a body-less 304. Versioned URLs (?v=...) never
+# change and are upgraded to a 1-year immutable cache.
+_PROD_VERSIONED_STATIC_HEADERS = (
+    ("Cache-Control", "public, max-age=31536000, immutable"),
+)
+_NO_CACHE_HEADERS = (
+    ("Cache-Control", "no-cache, no-store, must-revalidate"),
+    ("Pragma", "no-cache"),
+    ("Expires", "0"),
+)
+# Always disable cache in development for Replit, plus CORS headers for Replit iframe
+_DEV_HEADERS = _NO_CACHE_HEADERS + (
+    ("X-Frame-Options", "ALLOWALL"),
+    ("Access-Control-Allow-Origin", "*"),
+    ("Access-Control-Allow-Methods", "GET, POST, PUT, DELETE, OPTIONS"),
+    ("Access-Control-Allow-Headers", "Content-Type, Authorization"),
+)
+
 @app.after_request
 def after_request(response):
-    if is_production:
-        # Production cache settings for better performance
-        if request.path.startswith('/static/'):
-            response.headers["Cache-Control"] = "public, max-age=31536000"  # Cache static files for 1 year
-        else:
-            response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-            response.headers["Pragma"] = "no-cache"
-            response.headers["Expires"] = "0"
+    if not is_production:
+        headers = _DEV_HEADERS
+    elif request.path.startswith('/static/'):
+        if 'v' not in request.args:
+            return response  # Flask's own static Cache-Control
+        headers = _PROD_VERSIONED_STATIC_HEADERS
     else:
-        # Always disable cache in development for Replit
-        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response.headers["Pragma"] = "no-cache" 
-        response.headers["Expires"] = "0"
-        
-        # Add CORS headers for Replit iframe
-        response.headers["X-Frame-Options"] = "ALLOWALL"
-        response.headers["Access-Control-Allow-Origin"] = "*"
-        response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
-        response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
-    
+        headers = _NO_CACHE_HEADERS
+    # update() replaces existing values (e.g. Cache-Control set by send_file)
+    response.headers.update(headers)
     return response
 
-# Preflight Database Configuration - Test connection before initialization
-logger.info("🔍 Starting preflight database selection...")
+# Database Configuration
+logger.info("🔍 Starting database selection...")
 
 # Detect production environment (Render.com)
 is_production = os.environ.get('RENDER') or os.environ.get('DATABASE_URL', '').startswith('postgres')
 database_url = os.environ.get("DATABASE_URL")
 
-# Test PostgreSQL connection if available
+# PostgreSQL: production'da preflight probe yo'q - har bir gunicorn worker uchun ortiqcha
+# round-trip. pool_pre_ping ulanishlarni birinchi ishlatishda tekshiradi.
 if database_url and not database_url.startswith('sqlite'):
-    logger.info(f"🔌 Testing PostgreSQL connection...")
-    connection_success, result = test_database_connection(database_url, timeout=10)
+    # Normalize postgres:// to postgresql:// for SQLAlchemy compatibility
+    if database_url.startswith('postgres://'):
+        database_url = database_url.replace('postgres://', 'postgresql://', 1)
+    
+    connection_success, result = True, database_url
+    if not is_production:
+        # Development only: probe so an unreachable database can fall back to SQLite
+        logger.info(f"🔌 Testing PostgreSQL connection...")
+        if web_concurrency() > 1:
+            connection_success, result = cached_database_probe(database_url, timeout=10)
+        else:
+            connection_success, result = test_database_connection(database_url, timeout=10)
     
     if connection_success:
-        # PostgreSQL connection successful - configure for PostgreSQL
-        logger.info("✅ PostgreSQL connection test successful")
-        
         if is_production:
             # Production settings for Render.com - optimized for stability
+            # Pool budget: Postgres connection cap (minus headroom for celery/scheduler/admin)
+            # split across gunicorn workers; pool_size + max_overflow never exceeds a worker's share
+            postgres_max_conn = int(os.environ.get('POSTGRES_MAX_CONN', '97'))
+            reserved_conn = int(os.environ.get('POSTGRES_RESERVED_CONN', '20'))
+            web_workers = web_concurrency()
+            worker_threads = max(1, int(os.environ.get('GUNICORN_THREADS', '32')))
+            per_worker_conn = max(4, (postgres_max_conn - reserved_conn) // web_workers)
+            pool_size = max(2, min(worker_threads, per_worker_conn // 2))
+            logger.info(f"🐘 DB pool: pool_size={pool_size}, max_overflow={pool_size} per worker "
+                        f"({web_workers} workers x {worker_threads} threads, cap {postgres_max_conn})")
             app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-                "pool_size": 5,           # Smaller pool for production stability
-                "max_overflow": 10,       # Limited overflow to prevent resource exhaustion
-                "pool_timeout": 10,       # Shorter timeout - fail fast instead of hanging
+                "pool_size": pool_size,   # Threads per worker, capped by the connection budget
+                "max_overflow": pool_size,  # Burst headroom within the same budget
+                "pool_timeout": 5,        # Short timeout - fail fast instead of piling up waiters
                 "pool_recycle": 1800,     # Recycle connections every 30 minutes
                 "pool_pre_ping": True,    # Always verify connections
                 "echo": False,
@@ -163,13 +298,9 @@ if database_url and not database_url.startswith('sqlite'):
         app.config["SQLALCHEMY_DATABASE_URI"] = result
         
     else:
-        # PostgreSQL connection failed - fall back to SQLite
+        # PostgreSQL connection failed - fall back to SQLite (development only)
         logger.warning(f"❌ PostgreSQL connection failed: {result}")
-        if is_production:
-            logger.error("🚨 PRODUCTION: PostgreSQL unavailable - using SQLite fallback")
-            logger.error("⚠️ WARNING: SQLite in production may cause data loss on ephemeral storage")
-        else:
-            logger.info("🔄 Development: PostgreSQL unavailable - using SQLite fallback")
+        logger.info("🔄 Development: PostgreSQL unavailable - using SQLite fallback")
         
         sqlite_url, sqlite_config = get_fallback_sqlite_config()
         app.config["SQLALCHEMY_DATABASE_URI"] = sqlite_url
@@ -189,39 +320,77 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
 # Initialize extensions
 db.init_app(app)
+if app.config["SQLALCHEMY_DATABASE_URI"].startswith('sqlite'):
+    with app.app_context():
+        configure_sqlite(db.engine)
 login_manager.init_app(app)
 login_manager.login_view = 'auth.login'  # type: ignore
 login_manager.login_message = 'Iltimos, tizimga kiring.'
 login_manager.login_message_category = 'info'
 
+def create_http_session():
+    """Process-wide requests.Session - outbound bot/payment calls reuse pooled keep-alive connections"""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=64,
+        max_retries=Retry(total=3, backoff_factor=0.3)
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+app.extensions['http'] = create_http_session()
+atexit.register(app.extensions['http'].close)
+
+def _cached_csrf():
+    """CSRF token memoized on flask.g - one generate_csrf() per request however many forms a page renders"""
+    token = getattr(g, '_csrf_token', None)
+    if token is None:
+        token = g._csrf_token = generate_csrf()
+    return token
+
 # Make datetime available in templates
 app.jinja_env.globals['datetime'] = datetime
-app.jinja_env.globals['csrf_token'] = generate_csrf
-app.jinja_env.globals['config'] = app.config
+app.jinja_env.globals['csrf_token'] = _cached_csrf
 
 # Import routes after app creation to avoid circular imports
-from routes import main_bp
-from auth import auth_bp
-from payments import payment_bp
-from instagram_bot import instagram_bp
-from whatsapp_bot import whatsapp_bp
-from marketing import marketing_bp
-from bot_status import bot_status_bp
-
-app.register_blueprint(main_bp)
-app.register_blueprint(auth_bp, url_prefix='/auth')
-app.register_blueprint(payment_bp, url_prefix='/payment')
-app.register_blueprint(instagram_bp, url_prefix='/instagram')
-app.register_blueprint(whatsapp_bp, url_prefix='/whatsapp')
-app.register_blueprint(marketing_bp, url_prefix='/marketing')
-app.register_blueprint(bot_status_bp, url_prefix='/admin')
+# (module, blueprint, url_prefix, enable flag). Optional integrations are skipped when
+# their ENABLE_<NAME>=0 (no import cost at all) or when their dependencies are missing.
+BLUEPRINTS = (
+    ('routes', 'main_bp', None, None),
+    ('auth', 'auth_bp', '/auth', None),
+    ('payments', 'payment_bp', '/payment', 'ENABLE_PAYMENTS'),
+    ('instagram_bot', 'instagram_bp', '/instagram', 'ENABLE_INSTAGRAM'),
+    ('whatsapp_bot', 'whatsapp_bp', '/whatsapp', 'ENABLE_WHATSAPP'),
+    ('marketing', 'marketing_bp', '/marketing', 'ENABLE_MARKETING'),
+    ('bot_status', 'bot_status_bp', '/admin', None),
+)
+
+for module_name, blueprint_name, url_prefix, enable_flag in BLUEPRINTS:
+    if enable_flag and os.environ.get(enable_flag, '1') == '0':
+        continue
+    try:
+        blueprint = getattr(importlib.import_module(module_name), blueprint_name)
+    except ImportError as e:
+        if not enable_flag:
+            raise
+        logger.error(f"Optional blueprint {module_name} skipped: {e}")
+        continue
+    app.register_blueprint(blueprint, url_prefix=url_prefix)
 
 @login_manager.user_loader
 def load_user(user_id):
     from models import User
-    return User.query.get(int(user_id))
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None  # Buzilgan session cookie - anonim foydalanuvchi
+    # session.get identity map'ni avval tekshiradi
+    return db.session.get(User, user_id)
 
-with app.app_context():
+def init_db():
+    """Create tables and seed the admin user (run once per deploy, not per worker)"""
     # Import models to ensure tables are created
     import models
     
@@ -248,33 +417,38 @@ with app.app_context():
         
         if admin_email and admin_password:
             from models import User
-            from werkzeug.security import generate_password_hash
+            from auth import hash_password
             
-            admin = User.query.filter_by(email=admin_email).first()
-            if not admin:
-                admin = User()
-                admin.username = admin_email.split('@')[0]  # Use email prefix as username
-                admin.email = admin_email
-                admin.password_hash = generate_password_hash(admin_password)
-                admin.language = 'uz'
-                admin.subscription_type = 'admin'
-                admin.is_admin = True
-                db.session.add(admin)
-                db.session.commit()
-                logging.info(f"Admin user created successfully for {admin_email}")
+            # INSERT ... ON CONFLICT DO NOTHING: bitta so'rov, bir vaqtda ishga tushgan workerlar o'rtasida poygasiz
+            if db.engine.dialect.name == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert as dialect_insert
             else:
-                logging.info(f"Admin user already exists for {admin_email}")
+                from sqlalchemy.dialects.sqlite import insert as dialect_insert
+            result = db.session.execute(
+                dialect_insert(User).values(
+                    username=admin_email.split('@')[0],  # Use email prefix as username
+                    email=admin_email,
+                    password_hash=hash_password(admin_password),
+                    language='uz',
+                    subscription_type='admin',
+                    is_admin=True
+                ).on_conflict_do_nothing()
+            )
+            db.session.commit()
+            if result.rowcount:
+                logger.info(f"Admin user created successfully for {admin_email}")
+            else:
+                logger.info(f"Admin user already exists for {admin_email}")
         else:
-            logging.info("No admin credentials provided via ADMIN_EMAIL/ADMIN_PASSWORD - skipping admin user creation")
+            logger.info("No admin credentials provided via ADMIN_EMAIL/ADMIN_PASSWORD - skipping admin user creation")
             
     except Exception as e:
-        # Database operations failed after successful preflight test - this should be rare
-        logger.error(f"💥 Database operations failed after successful connection test: {e}")
+        logger.error(f"💥 Database operations failed: {e}")
         
         if is_production:
-            logger.error("🚨 PRODUCTION CRITICAL: Database operations failed after preflight success")
-            logger.error("💡 Check: Table creation permissions, Storage space, Connection limits")
-            # In production, fail fast - don't attempt runtime fallback after preflight success
+            logger.error("🚨 PRODUCTION CRITICAL: Database operations failed")
+            logger.error("💡 Check: Database availability, Table creation permissions, Storage space, Connection limits")
+            # In production, fail fast - don't silently switch to ephemeral SQLite
             raise
         else:
             logger.warning("⚠️ DEVELOPMENT: Database operations failed - attempting emergency fallback")
@@ -285,8 +459,9 @@ with app.app_context():
             except Exception as retry_error:
                 logger.error(f"❌ Emergency fallback also failed: {retry_error}")
                 raise
-    
-    # Initialize Bot Manager - Start all active bots polling in background
+
+def start_bot_manager():
+    """Initialize Bot Manager - Start all active bots polling in background"""
     try:
         logger.info("🤖 Initializing BotFactory AI Bot Manager...")
         from bot_manager import initialize_bot_manager
@@ -314,3 +489,34 @@ with app.app_context():
         if is_production:
             logger.error("🔥 PRODUCTION: Bot manager failed - check Render.com logs and environment variables")
         logger.warning("⚠️ Application will continue without bot polling - bots will not respond to messages!")
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create database tables and seed the admin user"""
+    init_db()
+
+@app.cli.command("run-bots")
+def run_bots_command():
+    """Run bot polling in this process (dedicated bot service; web runs with RUN_BOT_MANAGER=0)"""
+    from bot_manager import bot_manager
+    if os.environ.get('RUN_BOT_MANAGER', '1') != '1':
+        with app.app_context():
+            start_bot_manager()
+    # SIGTERM/SIGINT -> BotManager._shutdown_handler
+    bot_manager.shutdown_event.wait()
+
+# AUTO_INIT_DB=0: sxema/admin seed har bir worker importida emas, bir marta
+# `flask --app app init-db` orqali (masalan, Render pre-deploy) bajariladi.
+# RUN_BOT_MANAGER=0: Telegram polling faqat bitta xizmatda ishlashi uchun
+# (celery worker, scheduler va qo'shimcha web nusxalarida o'chiring).
+with app.app_context():
+    if os.environ.get('AUTO_INIT_DB', '1') == '1':
+        init_db()
+    if os.environ.get('RUN_BOT_MANAGER', '1') == '1':
+        start_bot_manager()
+
+# Shablonlar faqat ochiq kontakt sozlamalarini ko'radi (SECRET_KEY, DB URI emas)
+app.jinja_env.globals['config'] = types.MappingProxyType({
+    'SUPPORT_TELEGRAM': app.config['SUPPORT_TELEGRAM'],
+    'SUPPORT_PHONE': app.config['SUPPORT_PHONE'],
+})
@@ -4,10 +4,31 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from app import db
 from models import User
 from datetime import datetime, timedelta
+import os
 import logging
+import functools
 
 auth_bp = Blueprint('auth', __name__)
 
+# Parol hash usuli, masalan "pbkdf2:sha256:260000" (bo'sh bo'lsa Werkzeug standarti).
+# Login tezligi hash tekshirish narxiga bog'liq; usul o'zgarsa eski hashlar keyingi kirishda yangilanadi.
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or None
+
+def hash_password(password):
+    """Hash a password with the configured method"""
+    if PASSWORD_HASH_METHOD:
+        return generate_password_hash(password, method=PASSWORD_HASH_METHOD, salt_length=16)
+    return generate_password_hash(password)
+
+@functools.lru_cache(maxsize=1)
+def _configured_hash_prefix():
+    """Method prefix Werkzeug actually writes for PASSWORD_HASH_METHOD ("scrypt" -> "scrypt:32768:8:1")"""
+    return hash_password('').split('$', 1)[0]
+
+def password_needs_rehash(password_hash):
+    """True when a stored hash was made with a method other than PASSWORD_HASH_METHOD"""
+    return bool(PASSWORD_HASH_METHOD) and password_hash.split('$', 1)[0] != _configured_hash_prefix()
+
 @auth_bp.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
@@ -34,6 +55,13 @@ def login():
         
         if user and check_password_hash(user.password_hash, password):
             if user.is_active:
+                if password_needs_rehash(user.password_hash):
+                    try:
+                        user.password_hash = hash_password(password)
+                        db.session.commit()
+                    except Exception as rehash_error:
+                        db.session.rollback()
+                        logging.warning(f"Password rehash failed for user {user.id}: {rehash_error}")
                 login_user(user, remember=True)
                 next_page = request.args.get('next')
                 flash(f'Xush kelibsiz, {user.username}!', 'success')
@@ -92,7 +120,7 @@ def register():
             user = User()
             user.username = username
             user.email = email
-            user.password_hash = generate_password_hash(password or '')
+            user.password_hash = hash_password(password or '')
             user.language = 'uz'
             user.subscription_type = 'free'
             user.subscription_end_date = datetime.utcnow() + timedelta(days=15)
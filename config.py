@@ -1,6 +1,14 @@
 import os
+import multiprocessing
 from datetime import timedelta
 
+def web_concurrency() -> int:
+    """Gunicorn worker count - gunicorn_config.py and the DB pool budget in app.py must agree"""
+    if os.environ.get('FLASK_ENV') == 'development':
+        return 1  # Single worker in development
+    default = min(multiprocessing.cpu_count() * 2 + 1, 8)  # Cap at 8 workers
+    return max(1, int(os.environ.get('WEB_CONCURRENCY', default)))
+
 class Config:
     # Database
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///botfactory.db')
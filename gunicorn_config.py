@@ -2,23 +2,28 @@
 Production-optimized Gunicorn configuration for high load
 Designed for Bot Factory AI performance under concurrent users
 """
-import multiprocessing
 import os
+import threading
+from config import web_concurrency
 
 # Server socket
-bind = "0.0.0.0:5000"
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
 backlog = 2048
 
 # Worker processes
-workers = min(multiprocessing.cpu_count() * 2 + 1, 8)  # Cap at 8 workers
+workers = web_concurrency()  # WEB_CONCURRENCY or min(cpu*2+1, 8); app.py splits the DB pool by the same number
 worker_class = "gthread"  # Use threads for I/O bound tasks
-threads = 8  # 8 threads per worker for concurrent request handling
+# Gemini/Telegram chaqiruvlari soniyalab kutadi - threadlar CPU emas, tarmoqni kutadi.
+# DB pool bu qiymatdan qat'i nazar app.py da Postgres limiti bo'yicha cheklanadi.
+threads = int(os.environ.get("GUNICORN_THREADS", "32"))
 worker_connections = 1000
 
 # Worker behavior
 max_requests = 2000  # Restart worker after 2000 requests (prevents memory leaks)
 max_requests_jitter = 200  # Add randomness to restart timing
-preload_app = True  # Preload Flask app for faster worker startup
+# Preload Flask app for faster worker startup - faqat bot polling boshqa jarayonda bo'lsa
+# (RUN_BOT_MANAGER=0). Aks holda start_bot_manager() master (arbiter) ichida ishlab ketadi.
+preload_app = os.environ.get("RUN_BOT_MANAGER", "1") != "1"
 timeout = 120  # 2 minute timeout for long AI processing
 keepalive = 30  # Keep connections alive for 30 seconds
 
@@ -52,6 +57,19 @@ def when_ready(server):
     server.log.info(f"Workers: {workers}, Threads per worker: {threads}")
     server.log.info(f"Total concurrent capacity: {workers * threads} requests")
 
+def post_fork(server, worker):
+    """Called in each worker after fork - drop DB connections inherited from the preloaded master"""
+    if preload_app:
+        from app import app, db
+        with app.app_context():
+            db.engine.dispose(close=False)  # Master ulanishlarini yopmasdan, pool'ni tashlab yuborish
+
+def post_worker_init(worker):
+    """Called in each worker after fork - warm up per-worker Gemini channel (MARKETING_AI_WARMUP=1)"""
+    if os.environ.get("MARKETING_AI_WARMUP") == "1":
+        from marketing import get_marketing_ai
+        threading.Thread(target=lambda: get_marketing_ai().warmup(), daemon=True).start()
+
 def worker_int(worker):
     """Called when a worker receives an INT or QUIT signal"""
     worker.log.info("Worker shutting down gracefully")
@@ -64,6 +82,5 @@ def on_exit(server):
 if os.environ.get("FLASK_ENV") == "development":
     reload = True
     loglevel = "debug"
-    workers = 1  # Single worker in development
     
 print(f"Gunicorn config loaded: {workers} workers, {threads} threads each")
\ No newline at end of file
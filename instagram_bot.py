@@ -2,23 +2,197 @@ import os
 import json
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import threading
 import time
+import sched
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional, Any, Union
 from datetime import datetime
 from flask import Blueprint, request, jsonify, url_for
+from sqlalchemy.exc import IntegrityError
 from app import db, app, csrf
 from models import User, Bot, ChatHistory, BotCustomer
-from ai import get_ai_response, process_knowledge_base
+from ai import get_ai_response, get_fallback_response, process_knowledge_base
 from audio_processor import download_and_process_audio
-from instagram_client import InstagramClient
+from instagram_client import InstagramClient, session_path_for
+
+try:
+    import orjson
+
+    def _json_body(payload: Dict[str, Any]) -> bytes:
+        return orjson.dumps(payload)
+except ImportError:
+    def _json_body(payload: Dict[str, Any]) -> bytes:
+        return json.dumps(payload).encode('utf-8')
+
+# Graph API vaqtinchalik xatolari (429/5xx) uchun qayta urinish - backoff 0.5s, 1s, 2s
+GRAPH_RETRIES = 3
+GRAPH_BACKOFF = 0.5
+GRAPH_RETRY_STATUSES = (429, 500, 502, 503, 504)
+# POST /messages 5xx'da qayta yuborilmaydi - xabar yetib borgan bo'lishi mumkin (dublikat DM)
+GRAPH_POST_RETRY_STATUSES = (429,)
+GRAPH_MAX_RETRY_DELAY = 5  # seconds - Retry-After qancha bo'lsa ham webhook thread'i shundan ortiq kutmaydi
+
+class _GraphRetry(Retry):
+    """urllib3 Retry with the same POST/delay limits as InstagramBot._with_retry"""
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method == 'POST' and status_code not in GRAPH_POST_RETRY_STATUSES:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, GRAPH_MAX_RETRY_DELAY)
+
+# HTTP/2 (httpx + h2): bitta TLS ulanishda bir nechta Graph API so'rovi
+try:
+    import httpx
+    import h2  # noqa: F401
+    HTTPX_AVAILABLE = True
+except ImportError:
+    HTTPX_AVAILABLE = False
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 instagram_bp = Blueprint('instagram', __name__)
 
+# Webhook hodisalari shu umumiy poolda qayta ishlanadi - gunicorn worker AI/Graph
+# javobini kutib bloklanmaydi, Meta'ga 200 darhol qaytadi
+WEBHOOK_WORKERS = int(os.environ.get('INSTAGRAM_WEBHOOK_WORKERS', '32'))
+_webhook_executor = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix='ig-webhook')
+
+# Meta sekin ACK bo'lsa hodisani qayta yuboradi - ko'rilgan mid'lar (LRU)
+_SEEN_MIDS_MAX = 4096
+_seen_mids = OrderedDict()
+_seen_mids_lock = threading.Lock()
+
+def _already_processed(mid: Optional[str]) -> bool:
+    """True if this message id was already queued; otherwise remember it"""
+    if not mid:
+        return False
+    with _seen_mids_lock:
+        if mid in _seen_mids:
+            _seen_mids.move_to_end(mid)
+            return True
+        _seen_mids[mid] = None
+        if len(_seen_mids) > _SEEN_MIDS_MAX:
+            _seen_mids.popitem(last=False)
+    return False
+
+# Doimiy chiquvchi xabarlar (har chaqiruvda qayta qurilmaydi)
+EXPIRED_MSG = """🔒 Obunangiz tugagan!
+
+🌐 BotFactory.uz saytiga kirib, obunangizni yangilang.
+💰 Tariflar: Basic (290,000 so'm) yoki Premium (590,000 so'm)"""
+
+MARKETING_MSG = """✨ Premium imkoniyatlar:
+
+🌍 3 tilda AI (O'zbek/Rus/Ingliz)
+🤖 5 ta bot yaratish
+📱 Barcha platformalar (Telegram/Instagram/WhatsApp)
+
+💎 Faqat 590,000 so'm/oy - BotFactory.uz"""
+
+MARKETING_QUICK_REPLIES = [
+    {'title': '💎 Premium', 'payload': 'premium'},
+    {'title': '📞 Aloqa', 'payload': 'contact'}
+]
+
+def _quick_reply_tail(message_text: str, quick_replies: List[Dict[str, str]]) -> bytes:
+    """JSON body of a quick-reply send after the recipient field: b'"message":{...}}'"""
+    return _json_body({
+        'message': {
+            'text': message_text,
+            'quick_replies': [
+                {'content_type': 'text', 'title': reply['title'], 'payload': reply['payload']}
+                for reply in quick_replies
+            ]
+        }
+    })[1:]
+
+_MARKETING_QR_TAIL = _quick_reply_tail(MARKETING_MSG, MARKETING_QUICK_REPLIES)
+
+FALLBACK_MSG = "Kechirasiz, hozir javob bera olmayapman. Keyinroq urinib ko'ring. 🤖"
+
+GET_STARTED_MSG = """🎉 Instagram botiga xush kelibsiz!
+
+🤖 Men sizga yordam berish uchun tayyor AI yordamchiman.
+💬 Menga savolingizni yozing, men javob beraman!
+
+🌐 Tilni o'zgartirish: /language
+❓ Yordam: /help"""
+
+PREMIUM_MSG = """💎 Premium tarif:
+
+✅ 5 ta bot yaratish
+✅ Barcha platformalar
+✅ 3 til qo'llab-quvvatlash
+✅ Prioritet yordam
+
+💰 Narx: 590,000 so'm/oy
+🌐 Obuna bo'lish: BotFactory.uz"""
+
+CONTACT_MSG = """📞 Biz bilan bog'lanish:
+
+🌐 Sayt: BotFactory.uz
+📧 Email: support@botfactory.uz
+📱 Telegram: @BotFactorySupport
+🕒 Ish vaqti: 9:00-18:00"""
+
+class _AIGuard:
+    """
+    Admission control around get_ai_response for webhook/poll workers
+    At most max_inflight concurrent AI calls; when over half of the calls in the last
+    WINDOW seconds failed or were slow, the breaker opens and callers get None for OPEN_FOR seconds.
+    """
+    WINDOW = 30.0
+    OPEN_FOR = 10.0
+    MIN_CALLS = 10
+    SLOW_CALL = 8.0
+    ACQUIRE_TIMEOUT = 0.5
+    
+    def __init__(self, max_inflight: int):
+        self._sem = threading.BoundedSemaphore(max_inflight)
+        self._lock = threading.Lock()
+        self._results = deque()  # (finished_at, ok)
+        self._open_until = 0.0
+    
+    def call(self, **kwargs) -> Optional[str]:
+        if time.monotonic() < self._open_until:
+            return None
+        if not self._sem.acquire(timeout=self.ACQUIRE_TIMEOUT):
+            logger.warning("Instagram AI guard: too many concurrent AI calls, sending fallback")
+            return None
+        started = time.monotonic()
+        try:
+            response = get_ai_response(**kwargs)
+        finally:
+            self._sem.release()
+        # get_ai_response xatoni o'zi ushlab, fallback matnini qaytaradi
+        ok = (response is not None
+              and response != get_fallback_response(kwargs.get('user_language', 'uz'))
+              and time.monotonic() - started < self.SLOW_CALL)
+        self._record(ok)
+        return response
+    
+    def _record(self, ok: bool) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._results.append((now, ok))
+            while self._results and self._results[0][0] < now - self.WINDOW:
+                self._results.popleft()
+            failures = sum(1 for _, result in self._results if not result)
+            if len(self._results) >= self.MIN_CALLS and failures * 2 > len(self._results):
+                self._open_until = now + self.OPEN_FOR
+                self._results.clear()
+                logger.error("Instagram AI circuit open for %.0fs (%s failures in %.0fs)", self.OPEN_FOR, failures, self.WINDOW)
+
+_ai_guard = _AIGuard(int(os.environ.get('INSTAGRAM_AI_MAX_INFLIGHT', '50')))
+
 class InstagramBot:
     """Instagram bot integratsiyasi"""
     
@@ -27,32 +201,92 @@ class InstagramBot:
         self.bot_id = bot_id
         self.base_url = "https://graph.facebook.com/v18.0"
         self.verify_token = os.environ.get('INSTAGRAM_VERIFY_TOKEN', 'botfactory_instagram_2024')
+
+        # Graph API uchun keep-alive ulanishlar (har xabarda yangi TLS handshake yo'q)
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=50,
+            max_retries=_GraphRetry(
+                total=GRAPH_RETRIES,
+                read=0,  # Javobsiz qolgan POST qayta yuborilmaydi
+                backoff_factor=GRAPH_BACKOFF,
+                status_forcelist=GRAPH_RETRY_STATUSES,
+                allowed_methods=['POST', 'GET'],
+                respect_retry_after_header=True,
+                raise_on_status=False
+            )
+        ))
+        self.session.headers.update({
+            'Authorization': f'Bearer {self.access_token}',
+            'Content-Type': 'application/json'
+        })
+        self.http = None
+        if HTTPX_AVAILABLE:
+            limits = httpx.Limits(max_keepalive_connections=20, max_connections=50)
+            self.http = httpx.Client(
+                headers={'Authorization': f'Bearer {self.access_token}', 'Content-Type': 'application/json'},
+                timeout=30.0,
+                transport=httpx.HTTPTransport(http2=True, retries=2, limits=limits)
+            )
+    
+    def _with_retry(self, send, statuses=GRAPH_RETRY_STATUSES):
+        """
+        Retry transient Graph API statuses on the httpx client (requests uses urllib3 Retry)
+        Waits are capped at GRAPH_MAX_RETRY_DELAY even when Retry-After asks for longer.
+        """
+        for attempt in range(GRAPH_RETRIES + 1):
+            response = send()
+            if response.status_code not in statuses or attempt == GRAPH_RETRIES:
+                return response
+            delay = GRAPH_BACKOFF * (2 ** attempt)
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            time.sleep(min(delay, GRAPH_MAX_RETRY_DELAY))
+    
+    def _post_body(self, url: str, body: bytes):
+        if self.http is not None:
+            # 429 - so'rov bajarilmagan; ulanish xatolarini transport (retries=2) qayta urinadi
+            return self._with_retry(lambda: self.http.post(url, content=body), GRAPH_POST_RETRY_STATUSES)
+        return self.session.post(url, data=body, timeout=30)
+    
+    def _post_json(self, url: str, payload: Dict[str, Any]):
+        return self._post_body(url, _json_body(payload))
+    
+    def _get(self, url: str, params: Dict[str, Any]):
+        if self.http is not None:
+            return self._with_retry(lambda: self.http.get(url, params=params))
+        return self.session.get(url, params=params, timeout=30)
+    
+    def close(self) -> None:
+        """Release pooled connections"""
+        if self.http is not None:
+            self.http.close()
+        self.session.close()
     
     def send_message(self, recipient_id: str, message_text: str) -> bool:
         """Instagram Direct Message yuborish"""
         try:
             url = f"{self.base_url}/me/messages"
             
-            headers = {
-                'Authorization': f'Bearer {self.access_token}',
-                'Content-Type': 'application/json'
-            }
-            
             payload = {
                 'recipient': {'id': recipient_id},
                 'message': {'text': message_text}
             }
             
-            response = requests.post(url, headers=headers, json=payload, timeout=30)
+            response = self._post_json(url, payload)
             
             if response.status_code == 200:
-                logger.info(f"Instagram message sent to {recipient_id}")
+                logger.info("Instagram message sent to %s", recipient_id)
                 return True
             else:
-                logger.error(f"Instagram send error: {response.status_code} - {response.text}")
+                logger.error("Instagram send error: %s", response.status_code)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Instagram send error body: %s", response.text)
                 return False
         except Exception as e:
-            logger.error(f"Instagram send message error: {str(e)}")
+            logger.error("Instagram send message error: %s", e)
             return False
 
     def send_media_message(self, recipient_id: str, media_url: str, media_type: str = "image", caption: str = "") -> bool:
@@ -74,22 +308,19 @@ class InstagramBot:
             if caption:
                 payload['message']['text'] = caption
             
-            headers = {
-                'Authorization': f'Bearer {self.access_token}',
-                'Content-Type': 'application/json'
-            }
-            
-            response = requests.post(url, headers=headers, json=payload, timeout=30)
+            response = self._post_json(url, payload)
             
             if response.status_code == 200:
-                logger.info(f"Instagram media sent to {recipient_id}")
+                logger.info("Instagram media sent to %s", recipient_id)
                 return True
             else:
-                logger.error(f"Instagram media error: {response.status_code} - {response.text}")
+                logger.error("Instagram media error: %s", response.status_code)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Instagram media error body: %s", response.text)
                 return False
                 
         except Exception as e:
-            logger.error(f"Instagram media send error: {str(e)}")
+            logger.error("Instagram media send error: %s", e)
             return False
     
     def get_user_profile(self, user_id: str) -> Optional[Dict[str, Any]]:
@@ -101,65 +332,50 @@ class InstagramBot:
                 'access_token': self.access_token
             }
             
-            response = requests.get(url, params=params, timeout=30)
+            response = self._get(url, params)
             
             if response.status_code == 200:
                 return response.json()
             else:
-                logger.error(f"Instagram profile error: {response.status_code}")
+                logger.error("Instagram profile error: %s", response.status_code)
                 return None
                 
         except Exception as e:
-            logger.error(f"Instagram profile fetch error: {str(e)}")
+            logger.error("Instagram profile fetch error: %s", e)
             return None
     
-    def send_quick_reply(self, recipient_id: str, message_text: str, quick_replies: List[Dict[str, str]]) -> bool:
-        """Tez javob tugmalari bilan xabar yuborish"""
+    def send_quick_reply(self, recipient_id: str, message_text: str, quick_replies: List[Dict[str, str]],
+                         encoded_tail: Optional[bytes] = None) -> bool:
+        """
+        Tez javob tugmalari bilan xabar yuborish
+        encoded_tail: precomputed _quick_reply_tail() for repeated messages (only the recipient is encoded per call)
+        """
         try:
             url = f"{self.base_url}/me/messages"
+            tail = encoded_tail or _quick_reply_tail(message_text, quick_replies)
+            body = b'{"recipient":{"id":' + _json_body(str(recipient_id)) + b'},' + tail
             
-            quick_replies_data = []
-            for reply in quick_replies:
-                quick_replies_data.append({
-                    'content_type': 'text',
-                    'title': reply['title'],
-                    'payload': reply['payload']
-                })
-            
-            payload = {
-                'recipient': {'id': recipient_id},
-                'message': {
-                    'text': message_text,
-                    'quick_replies': quick_replies_data
-                },
-
-            }
-            
-            headers = {
-                'Authorization': f'Bearer {self.access_token}',
-                'Content-Type': 'application/json'
-            }
-            
-            response = requests.post(url, headers=headers, json=payload, timeout=30)
+            response = self._post_body(url, body)
             
             if response.status_code == 200:
-                logger.info(f"Instagram quick reply sent to {recipient_id}")
+                logger.info("Instagram quick reply sent to %s", recipient_id)
                 return True
             else:
-                logger.error(f"Instagram quick reply error: {response.status_code}")
+                logger.error("Instagram quick reply error: %s", response.status_code)
                 return False
                 
         except Exception as e:
-            logger.error(f"Instagram quick reply error: {str(e)}")
+            logger.error("Instagram quick reply error: %s", e)
             return False
     
     def handle_message(self, sender_id: str, message_text: str) -> bool:
         """Instagram xabarini qayta ishlash"""
         try:
             with app.app_context():
-                # Foydalanuvchini topish yoki yaratish
-                user = User.query.filter_by(instagram_id=sender_id).first()
-                if not user:
+                # Foydalanuvchini topish (yangisi pastda, bitta tranzaksiyada saqlanadi)
+                user = _get_instagram_user(sender_id)
+                is_new_user = user is None
+                if is_new_user:
                     # Yangi Instagram foydalanuvchisi
                     user = User()
                     user.username = f"ig_{sender_id}"
@@ -168,75 +384,53 @@ class InstagramBot:
                     user.instagram_id = sender_id
                     user.language = 'uz'
                     user.subscription_type = 'free'
-                    db.session.add(user)
-                    db.session.commit()
                 
                 # Bot ma'lumotlarini olish
-                bot = Bot.query.get(self.bot_id)
-                if not bot:
+                bot_name = _cached_bot_name(self.bot_id)
+                if bot_name is None:
                     return False
                 
                 # Obunani tekshirish
                 if not user.subscription_active():
-                    welcome_message = """🔒 Obunangiz tugagan!
-                    
-🌐 BotFactory.uz saytiga kirib, obunangizni yangilang.
-💰 Tariflar: Basic (290,000 so'm) yoki Premium (590,000 so'm)"""
-                    
-                    self.send_message(sender_id, welcome_message)
+                    self.send_message(sender_id, EXPIRED_MSG)
                     return True
                 
-                # Track customer in BotCustomer for broadcasts
-                try:
-                    customer = BotCustomer.query.filter_by(
-                        bot_id=self.bot_id,
-                        platform='instagram',
-                        platform_user_id=str(sender_id)
-                    ).first()
-                    if not customer:
-                        customer = BotCustomer(
-                            bot_id=self.bot_id,
-                            platform='instagram',
-                            platform_user_id=str(sender_id),
-                            first_name='',
-                            last_name='',
-                            username=f"ig_{sender_id}",
-                            language=user.language,
-                            is_active=True,
-                            message_count=1
-                        )
-                        db.session.add(customer)
-                    else:
-                        customer.last_interaction = datetime.utcnow()
-                        customer.is_active = True
-                        customer.message_count = (customer.message_count or 0) + 1
-                    db.session.commit()
-                except Exception as _:
-                    try:
-                        db.session.rollback()
-                    except:
-                        pass
-
-                # AI javobini olish
+                # AI javobini olish (tranzaksiya ochilmasdan oldin)
                 knowledge_base = process_knowledge_base(self.bot_id)
                 
-                ai_response = get_ai_response(
+                ai_response = _ai_guard.call(
                     message=message_text,
-                    bot_name=bot.name,
+                    bot_name=bot_name,
                     user_language=user.language,
-                    knowledge_base=knowledge_base
+                    knowledge_base=knowledge_base,
+                    bot_id=self.bot_id
                 )
                 
-                # Chat tarixini saqlash
-                chat_history = ChatHistory()
-                chat_history.bot_id = self.bot_id
-                chat_history.user_instagram_id = sender_id
-                chat_history.message = message_text
-                chat_history.response = ai_response
-                chat_history.language = user.language
-                chat_history.created_at = datetime.utcnow()
-                db.session.add(chat_history)
-                db.session.commit()
+                # Foydalanuvchi, BotCustomer va chat tarixi - bitta commit
+                try:
+                    if is_new_user:
+                        # Parallel webhook bir vaqtda yaratgan bo'lsa - SAVEPOINT ichida ushlanadi
+                        try:
+                            with db.session.begin_nested():
+                                db.session.add(user)
+                        except IntegrityError:
+                            user = User.query.filter_by(instagram_id=sender_id).first()
+                    
+                    db.session.execute(_upsert_customer_stmt(self.bot_id, sender_id, user.language))
+                    
+                    chat_history = ChatHistory()
+                    chat_history.bot_id = self.bot_id
+                    chat_history.user_instagram_id = sender_id
+                    chat_history.message = message_text
+                    chat_history.response = ai_response
+                    chat_history.language = user.language
+                    chat_history.created_at = datetime.utcnow()
+                    db.session.add(chat_history)
+                    db.session.commit()
+                    _remember_instagram_user(sender_id, user.id)
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error("Instagram message save error: %s", e)
                 
                 # Javobni yuborish
                 if ai_response:
@@ -244,30 +438,19 @@ class InstagramBot:
                     
                     # Agar bepul foydalanuvchi bo'lsa, marketing xabar
                     if user.subscription_type == 'free':
-                        marketing_message = """✨ Premium imkoniyatlar:
-                        
-🌍 3 tilda AI (O'zbek/Rus/Ingliz)
-🤖 5 ta bot yaratish
-📱 Barcha platformalar (Telegram/Instagram/WhatsApp)
-                        
-💎 Faqat 590,000 so'm/oy - BotFactory.uz"""
-                        
                         self.send_quick_reply(
                             sender_id,
-                            marketing_message,
-                            [
-                                {'title': '💎 Premium', 'payload': 'premium'},
-                                {'title': '📞 Aloqa', 'payload': 'contact'}
-                            ]
+                            MARKETING_MSG,
+                            MARKETING_QUICK_REPLIES,
+                            encoded_tail=_MARKETING_QR_TAIL
                         )
                 else:
-                    fallback_message = "Kechirasiz, hozir javob bera olmayapman. Keyinroq urinib ko'ring. 🤖"
-                    self.send_message(sender_id, fallback_message)
+                    self.send_message(sender_id, FALLBACK_MSG)
                 
                 return True
                 
         except Exception as e:
-            logger.error(f"Instagram message handling error: {str(e)}")
+            logger.error("Instagram message handling error: %s", e)
             return False
     
     def handle_audio_message(self, sender_id: str, audio_attachment: Dict[str, Any]) -> bool:
@@ -290,8 +473,7 @@ class InstagramBot:
                     return False
                 
                 # Get bot info
-                bot = Bot.query.get(self.bot_id)
-                if not bot:
+                if _cached_bot_name(self.bot_id) is None:
                     self.send_message(sender_id, "❌ Bot topilmadi!")
                     return False
                 
@@ -335,11 +517,11 @@ class InstagramBot:
                 # Send response
                 self.send_message(sender_id, ai_response)
                 
-                logger.info(f"Instagram audio message processed for user {sender_id}")
+                logger.info("Instagram audio message processed for user %s", sender_id)
                 return True
                 
         except Exception as e:
-            logger.error(f"Instagram audio handling error: {str(e)}")
+            logger.error("Instagram audio handling error: %s", e)
             self.send_message(sender_id, "❌ Ovozli xabarni qayta ishlashda xatolik yuz berdi!")
             return False
     
@@ -347,53 +529,133 @@ class InstagramBot:
         """Instagram postback (tugma bosilgan) ni qayta ishlash"""
         try:
             if payload == 'GET_STARTED':
-                welcome_message = f"""🎉 Instagram botiga xush kelibsiz!
-                
-🤖 Men sizga yordam berish uchun tayyor AI yordamchiman.
-💬 Menga savolingizni yozing, men javob beraman!
-
-🌐 Tilni o'zgartirish: /language
-❓ Yordam: /help"""
-                
-                self.send_message(sender_id, welcome_message)
+                self.send_message(sender_id, GET_STARTED_MSG)
                 
             elif payload == 'premium':
-                premium_message = """💎 Premium tarif:
-                
-✅ 5 ta bot yaratish
-✅ Barcha platformalar
-✅ 3 til qo'llab-quvvatlash
-✅ Prioritet yordam
-                
-💰 Narx: 590,000 so'm/oy
-🌐 Obuna bo'lish: BotFactory.uz"""
-                
-                self.send_message(sender_id, premium_message)
+                self.send_message(sender_id, PREMIUM_MSG)
                 
             elif payload == 'contact':
-                contact_message = """📞 Biz bilan bog'lanish:
-                
-🌐 Sayt: BotFactory.uz
-📧 Email: support@botfactory.uz
-📱 Telegram: @BotFactorySupport
-🕒 Ish vaqti: 9:00-18:00"""
-                
-                self.send_message(sender_id, contact_message)
+                self.send_message(sender_id, CONTACT_MSG)
             
             return True
             
         except Exception as e:
-            logger.error(f"Instagram postback error: {str(e)}")
+            logger.error("Instagram postback error: %s", e)
             return False
 
+# sender_id -> User.id (takroriy yozuvchilar uchun instagram_id bo'yicha SELECT yo'q)
+_USER_ID_CACHE_MAX = 50000
+_user_ids = OrderedDict()
+_user_ids_lock = threading.Lock()
+
+# bot_id -> (bot.name, expires) - har xabarda Bot SELECT qilinmaydi
+BOT_CACHE_TTL = 60
+_bot_names = {}
+
+def _cached_bot_name(bot_id: int) -> Optional[str]:
+    """Bot name for a bot_id (None if the bot does not exist), cached for BOT_CACHE_TTL seconds"""
+    cached = _bot_names.get(bot_id)
+    now = time.monotonic()
+    if cached and cached[1] > now:
+        return cached[0]
+    bot = db.session.get(Bot, bot_id)
+    name = bot.name if bot else None
+    _bot_names[bot_id] = (name, now + BOT_CACHE_TTL)
+    return name
+
+def _remember_instagram_user(sender_id: str, user_id: Optional[int]) -> None:
+    if user_id is None:
+        return
+    with _user_ids_lock:
+        _user_ids[sender_id] = user_id
+        _user_ids.move_to_end(sender_id)
+        if len(_user_ids) > _USER_ID_CACHE_MAX:
+            _user_ids.popitem(last=False)
+
+def _get_instagram_user(sender_id: str) -> Optional[User]:
+    """Existing User for an Instagram sender (primary-key lookup when the id is cached)"""
+    with _user_ids_lock:
+        user_id = _user_ids.get(sender_id)
+    if user_id is not None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            return user
+    user = User.query.filter_by(instagram_id=sender_id).first()
+    if user is not None:
+        _remember_instagram_user(sender_id, user.id)
+    return user
+
+def _upsert_customer_stmt(bot_id: int, sender_id: str, language: str):
+    """INSERT ... ON CONFLICT (bot_id, platform, platform_user_id) DO UPDATE for BotCustomer"""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    now = datetime.utcnow()
+    stmt = dialect_insert(BotCustomer).values(
+        bot_id=bot_id,
+        platform='instagram',
+        platform_user_id=str(sender_id),
+        first_name='',
+        last_name='',
+        username=f"ig_{sender_id}",
+        language=language,
+        is_active=True,
+        message_count=1,
+        last_interaction=now
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=['bot_id', 'platform', 'platform_user_id'],
+        set_={
+            'last_interaction': stmt.excluded.last_interaction,
+            'is_active': True,
+            'message_count': db.func.coalesce(BotCustomer.message_count, 0) + 1
+        }
+    )
+
+# Unofficial (instagrapi) botlar uchun polling oralig'i, soniya
+POLL_MIN_INTERVAL = 5
+POLL_MAX_INTERVAL = 60
+POLL_WORKERS = int(os.environ.get('INSTAGRAM_POLL_WORKERS', '8'))
+
 # Instagram Bot Manager
+class _BotRecord:
+    """One Instagram bot: an official Graph API bot or an unofficial instagrapi client"""
+    __slots__ = ('state', 'official', 'unofficial', 'stop')
+    
+    def __init__(self, state: str = 'starting'):
+        self.state = state  # 'starting' | 'running' | 'failed'
+        self.official: Optional['InstagramBot'] = None
+        self.unofficial: Optional[InstagramClient] = None
+        self.stop: Optional[threading.Event] = None
+
 class InstagramBotManager:
     """Instagram botlarni boshqarish"""
     
     def __init__(self):
-        self.running_bots = {}
-        self.unofficial_bots = {}
-        self.polling_threads = {}
+        # Yagona manba: bot_id -> _BotRecord, o'zgartirishlar faqat _lock ostida
+        self._bots: Dict[int, _BotRecord] = {}
+        self._lock = threading.RLock()
+        # Barcha unofficial botlar uchun bitta scheduler thread + kichik umumiy pool
+        self._poll_scheduler = sched.scheduler(time.monotonic, self._poll_delay)
+        self._poll_wakeup = threading.Event()
+        self._poll_executor = ThreadPoolExecutor(max_workers=POLL_WORKERS, thread_name_prefix='ig-poll')
+        self._poll_thread = None
+        self._poll_thread_lock = threading.Lock()
+    
+    @property
+    def running_bots(self) -> Dict[int, 'InstagramBot']:
+        """Snapshot of official bots (kept for status pages)"""
+        return {bot_id: r.official for bot_id, r in list(self._bots.items()) if r.official is not None}
+    
+    @property
+    def unofficial_bots(self) -> Dict[int, InstagramClient]:
+        """Snapshot of unofficial clients"""
+        return {bot_id: r.unofficial for bot_id, r in list(self._bots.items()) if r.unofficial is not None}
+    
+    def _set_state(self, bot_id: int, state: str) -> None:
+        with self._lock:
+            self._bots.setdefault(bot_id, _BotRecord()).state = state
     
     def start_bot(self, bot_id: int, access_token: str) -> bool:
         """Instagram botni ishga tushirish"""
@@ -401,70 +663,157 @@ class InstagramBotManager:
             # Check for Unofficial (username:password)
             if ':' in access_token and len(access_token) < 100:
                 username, password = access_token.split(':', 1)
-                client = InstagramClient()
+                client = InstagramClient(session_path=session_path_for(bot_id))
+                # Login lock'dan tashqarida - bir necha soniya davom etadi
                 success, msg = client.login(username, password)
                 
                 if success:
-                    self.unofficial_bots[bot_id] = client
-                    logger.info(f"Unofficial Instagram bot {bot_id} started as {username}")
-                    
-                    # Start polling thread
                     stop_event = threading.Event()
-                    thread = threading.Thread(target=self._polling_loop, args=(bot_id, client, stop_event))
-                    thread.daemon = True
-                    thread.start()
-                    self.polling_threads[bot_id] = (thread, stop_event)
+                    with self._lock:
+                        record = self._bots.setdefault(bot_id, _BotRecord())
+                        if record.stop is not None:
+                            record.stop.set()
+                        record.unofficial = client
+                        record.stop = stop_event
+                        record.state = 'running'
+                    logger.info("Unofficial Instagram bot %s started as %s", bot_id, username)
+                    
+                    # Umumiy schedulerga polling ishini qo'shish
+                    self._schedule_poll(bot_id, client, stop_event, POLL_MIN_INTERVAL)
                     return True
                 else:
-                    logger.error(f"Unofficial login failed: {msg}")
+                    logger.error("Unofficial login failed: %s", msg)
+                    self._set_state(bot_id, 'failed')
                     return False
 
             # Official API
-            if bot_id not in self.running_bots:
-                bot = InstagramBot(access_token, bot_id)
-                self.running_bots[bot_id] = bot
-                logger.info(f"Instagram bot {bot_id} started (Official)")
-                return True
+            with self._lock:
+                record = self._bots.setdefault(bot_id, _BotRecord())
+                if record.official is None:
+                    record.official = InstagramBot(access_token, bot_id)
+                    logger.info("Instagram bot %s started (Official)", bot_id)
+                record.state = 'running'
             return True
         except Exception as e:
-            logger.error(f"Instagram bot start error: {str(e)}")
+            logger.error("Instagram bot start error: %s", e)
+            self._set_state(bot_id, 'failed')
             return False
     
+    def start_bot_background(self, bot_id: int, access_token: str) -> None:
+        """
+        Start a bot on the shared pool (instagrapi login takes several HTTPS round-trips)
+        Progress is visible through get_state(); a failed login deactivates the bot.
+        """
+        self._set_state(bot_id, 'starting')
+        
+        def _start():
+            if self.start_bot(bot_id, access_token):
+                return
+            with app.app_context():
+                bot = Bot.query.get(bot_id)
+                if bot and bot.is_active:
+                    bot.is_active = False
+                    db.session.commit()
+        
+        self._poll_executor.submit(_start)
+    
     def stop_bot(self, bot_id: int) -> bool:
         """Instagram botni to'xtatish"""
         try:
+            with self._lock:
+                record = self._bots.pop(bot_id, None)
+            if record is None:
+                return True
+            
             # Stop official
-            if bot_id in self.running_bots:
-                del self.running_bots[bot_id]
-                logger.info(f"Instagram bot {bot_id} stopped (Official)")
+            if record.official is not None:
+                record.official.close()
+                logger.info("Instagram bot %s stopped (Official)", bot_id)
             
             # Stop unofficial
-            if bot_id in self.unofficial_bots:
-                if bot_id in self.polling_threads:
-                    _, stop_event = self.polling_threads[bot_id]
-                    stop_event.set()
-                    del self.polling_threads[bot_id]
-                del self.unofficial_bots[bot_id]
-                logger.info(f"Instagram bot {bot_id} stopped (Unofficial)")
+            if record.unofficial is not None:
+                if record.stop is not None:
+                    record.stop.set()
+                logger.info("Instagram bot %s stopped (Unofficial)", bot_id)
                 
             return True
         except Exception as e:
-            logger.error(f"Instagram bot stop error: {str(e)}")
+            logger.error("Instagram bot stop error: %s", e)
             return False
     
-    def _polling_loop(self, bot_id, client, stop_event):
-        """Simple polling loop"""
-        logger.info(f"Polling started for bot {bot_id}")
-        while not stop_event.is_set():
-            try:
-                time.sleep(60) 
-            except Exception as e:
-                logger.error(f"Polling error: {e}")
-                time.sleep(60)
+    def get_state(self, bot_id: int) -> str:
+        """'starting' | 'running' | 'failed' | 'stopped'"""
+        record = self._bots.get(bot_id)
+        return record.state if record else 'stopped'
+    
+    def is_running(self, bot_id: int) -> bool:
+        record = self._bots.get(bot_id)
+        return record is not None and (record.official is not None or record.unofficial is not None)
+    
+    def _poll_delay(self, timeout):
+        """sched delayfunc that wakes early when a new poll is scheduled"""
+        self._poll_wakeup.wait(timeout)
+        self._poll_wakeup.clear()
+    
+    def _run_poll_scheduler(self):
+        while True:
+            self._poll_scheduler.run()
+            self._poll_wakeup.wait()
+            self._poll_wakeup.clear()
+    
+    def _schedule_poll(self, bot_id, client, stop_event, delay):
+        """Queue the next inbox poll of a bot on the shared scheduler"""
+        with self._poll_thread_lock:
+            if self._poll_thread is None:
+                self._poll_thread = threading.Thread(target=self._run_poll_scheduler, name='ig-poll-scheduler', daemon=True)
+                self._poll_thread.start()
+        self._poll_scheduler.enter(delay, 1, self._poll_executor.submit, (self._poll_once, bot_id, client, stop_event, delay))
+        self._poll_wakeup.set()
+    
+    def _poll_once(self, bot_id, client, stop_event, backoff):
+        """Poll unread DMs once, then reschedule with adaptive backoff (POLL_MIN_INTERVAL after activity, up to POLL_MAX_INTERVAL idle)"""
+        if stop_event.is_set():
+            return
+        try:
+            threads = client.get_unread_messages()
+            if threads:
+                self._reply_unread(bot_id, client, threads)
+                backoff = POLL_MIN_INTERVAL
+            else:
+                backoff = min(backoff * 2, POLL_MAX_INTERVAL)
+        except Exception as e:
+            logger.error("Polling error: %s", e)
+            backoff = POLL_MAX_INTERVAL
+        if not stop_event.is_set():
+            self._schedule_poll(bot_id, client, stop_event, backoff)
+    
+    def _reply_unread(self, bot_id, client, threads):
+        """Answer the newest incoming message of each unread thread"""
+        with app.app_context():
+            bot_name = _cached_bot_name(bot_id)
+            if bot_name is None:
+                return
+            knowledge_base = process_knowledge_base(bot_id)
+            own_id = str(client.client.user_id)
+            for thread in threads:
+                last = thread.messages[0] if thread.messages else None
+                # Oxirgi xabar bizniki bo'lsa - allaqachon javob berilgan
+                if not last or not last.text or str(last.user_id) == own_id:
+                    continue
+                ai_response = _ai_guard.call(
+                    message=last.text,
+                    bot_name=bot_name,
+                    user_language='uz',
+                    knowledge_base=knowledge_base,
+                    bot_id=bot_id
+                )
+                if ai_response:
+                    client.send_message(str(last.user_id), ai_response)
 
     def get_bot(self, bot_id: int) -> Optional['InstagramBot']:
         """Instagram botni olish"""
-        return self.running_bots.get(bot_id)
+        record = self._bots.get(bot_id)
+        return record.official if record else None
 
 # Global Instagram bot manager
 instagram_manager = InstagramBotManager()
@@ -487,32 +836,44 @@ def instagram_webhook(bot_id):
                 return 'Verification failed', 403
         
         elif request.method == 'POST':
-            # Message processing
-            data = request.get_json()
-            
-            if data and 'entry' in data:
-                for entry in data['entry']:
-                    if 'messaging' in entry:
-                        for messaging_event in entry['messaging']:
-                            sender_id = messaging_event['sender']['id']
-                            
-                            bot = instagram_manager.get_bot(bot_id)
-                            if not bot:
-                                continue
-                            
-                            if 'message' in messaging_event:
-                                message_text = messaging_event['message'].get('text', '')
-                                if message_text:
-                                    bot.handle_message(sender_id, message_text)
-                            
-                            elif 'postback' in messaging_event:
-                                payload = messaging_event['postback'].get('payload', '')
-                                bot.handle_postback(sender_id, payload)
+            # Message processing (app.json orjson provider orqali parse qilinadi)
+            data = request.get_json(silent=True) or {}
+            bot = instagram_manager.get_bot(bot_id)
+            if not bot:
+                return 'OK', 200
+            
+            # Meta bir POST'da bir nechta hodisa yuborishi mumkin - avval yig'ib, keyin bir o'tishda yuboramiz
+            events = [e for entry in data.get('entry', ()) for e in entry.get('messaging', ())]
+            text_events, audio_events, postback_events = [], [], []
+            for event in events:
+                sender_id = event['sender']['id']
+                if 'message' in event:
+                    message = event['message']
+                    if _already_processed(message.get('mid')):
+                        continue
+                    if message.get('text'):
+                        text_events.append((sender_id, message['text']))
+                    else:
+                        audio = next((a for a in message.get('attachments', ()) if a.get('type') == 'audio'), None)
+                        if audio:
+                            audio_events.append((sender_id, audio))
+                elif 'postback' in event:
+                    postback = event['postback']
+                    if _already_processed(postback.get('mid')):
+                        continue
+                    postback_events.append((sender_id, postback.get('payload', '')))
+            
+            for sender_id, message_text in text_events:
+                _webhook_executor.submit(bot.handle_message, sender_id, message_text)
+            for sender_id, audio in audio_events:
+                _webhook_executor.submit(bot.handle_audio_message, sender_id, audio)
+            for sender_id, payload in postback_events:
+                _webhook_executor.submit(bot.handle_postback, sender_id, payload)
             
             return 'OK', 200
     
     except Exception as e:
-        logger.error(f"Instagram webhook error: {str(e)}")
+        logger.error("Instagram webhook error: %s", e)
         return 'Internal Server Error', 500
 
 @instagram_bp.route('/start/<int:bot_id>', methods=['POST'])
@@ -520,23 +881,32 @@ def instagram_webhook(bot_id):
 def start_instagram_bot(bot_id):
     """Instagram botni ishga tushirish"""
     try:
-        with app.app_context():
-            bot = Bot.query.get_or_404(bot_id)
-            
-            if not bot.instagram_token:
-                return jsonify({'success': False, 'error': 'Instagram token topilmadi'})
-            
-            success = instagram_manager.start_bot(bot_id, bot.instagram_token)
-            
-            if success:
-                bot.is_active = True
-                db.session.commit()
-                return jsonify({'success': True, 'message': 'Instagram bot ishga tushdi'})
-            else:
-                return jsonify({'success': False, 'error': 'Botni ishga tushirishda xato'})
-    
+        bot = Bot.query.get_or_404(bot_id)
+        
+        if not bot.instagram_token:
+            return jsonify({'success': False, 'error': 'Instagram token topilmadi'})
+        
+        _bot_names.pop(bot_id, None)
+        
+        # Unofficial (username:password) login fonda - so'rov bloklanmaydi
+        token = bot.instagram_token
+        if ':' in token and len(token) < 100:
+            bot.is_active = True
+            db.session.commit()
+            instagram_manager.start_bot_background(bot_id, token)
+            return jsonify({'success': True, 'status': 'starting', 'message': 'Instagram bot ishga tushirilmoqda'})
+        
+        success = instagram_manager.start_bot(bot_id, token)
+        
+        if success:
+            bot.is_active = True
+            db.session.commit()
+            return jsonify({'success': True, 'status': 'running', 'message': 'Instagram bot ishga tushdi'})
+        else:
+            return jsonify({'success': False, 'error': 'Botni ishga tushirishda xato'})
+
     except Exception as e:
-        logger.error(f"Start Instagram bot error: {str(e)}")
+        logger.error("Start Instagram bot error: %s", e)
         return jsonify({'success': False, 'error': str(e)})
 
 @instagram_bp.route('/stop/<int:bot_id>', methods=['POST'])
@@ -544,67 +914,66 @@ def start_instagram_bot(bot_id):
 def stop_instagram_bot(bot_id):
     """Instagram botni to'xtatish"""
     try:
-        with app.app_context():
-            bot = Bot.query.get_or_404(bot_id)
-            
-            success = instagram_manager.stop_bot(bot_id)
-            
-            if success:
-                bot.is_active = False
-                db.session.commit()
-                return jsonify({'success': True, 'message': 'Instagram bot to\'xtatildi'})
-            else:
-                return jsonify({'success': False, 'error': 'Botni to\'xtatishda xato'})
-    
+        bot = Bot.query.get_or_404(bot_id)
+        
+        success = instagram_manager.stop_bot(bot_id)
+        _bot_names.pop(bot_id, None)
+        
+        if success:
+            bot.is_active = False
+            db.session.commit()
+            return jsonify({'success': True, 'message': 'Instagram bot to\'xtatildi'})
+        else:
+            return jsonify({'success': False, 'error': 'Botni to\'xtatishda xato'})
+
     except Exception as e:
-        logger.error(f"Stop Instagram bot error: {str(e)}")
+        logger.error("Stop Instagram bot error: %s", e)
         return jsonify({'success': False, 'error': str(e)})
 
 @instagram_bp.route('/status/<int:bot_id>')
 def instagram_bot_status(bot_id):
     """Instagram bot holatini tekshirish"""
     try:
-        is_running = bot_id in instagram_manager.running_bots or bot_id in instagram_manager.unofficial_bots
+        is_running = instagram_manager.is_running(bot_id)
         
-        with app.app_context():
-            bot = Bot.query.get(bot_id)
-            
-            return jsonify({
-                'bot_id': bot_id,
-                'is_running': is_running,
-                'is_active': bot.is_active if bot else False,
-                'platform': 'Instagram'
-            })
-    
+        bot = Bot.query.get(bot_id)
+        
+        return jsonify({
+            'bot_id': bot_id,
+            'is_running': is_running,
+            'is_active': bot.is_active if bot else False,
+            'state': instagram_manager.get_state(bot_id),
+            'platform': 'Instagram'
+        })
+
     except Exception as e:
-        logger.error(f"Instagram status error: {str(e)}")
+        logger.error("Instagram status error: %s", e)
         return jsonify({'error': str(e)}), 500
 
 def start_instagram_bot_automatically(bot_id: int, access_token: str) -> bool:
     """Instagram botni avtomatik ishga tushirish funksiyasi"""
     try:
-        with app.app_context():
-            bot = Bot.query.get(bot_id)
-            if not bot:
-                logger.error(f"Bot {bot_id} topilmadi")
-                return False
-            
-            # Instagram bot tokenini saqlash
-            bot.instagram_token = access_token
+        bot = Bot.query.get(bot_id)
+        if not bot:
+            logger.error("Bot %s topilmadi", bot_id)
+            return False
+        
+        # Instagram bot tokenini saqlash
+        bot.instagram_token = access_token
+        db.session.commit()
+        
+        # Instagram botni ishga tushirish
+        success = instagram_manager.start_bot(bot_id, access_token)
+        
+        if success:
+            bot.is_active = True
             db.session.commit()
+            logger.info("Instagram bot %s avtomatik ishga tushdi", bot_id)
+            return True
+        else:
+            logger.error("Instagram bot %s ishga tushirishda xato", bot_id)
+            return False
             
-            # Instagram botni ishga tushirish
-            success = instagram_manager.start_bot(bot_id, access_token)
-            
-            if success:
-                bot.is_active = True
-                db.session.commit()
-                logger.info(f"Instagram bot {bot_id} avtomatik ishga tushdi")
-                return True
-            else:
-                logger.error(f"Instagram bot {bot_id} ishga tushirishda xato")
-                return False
-                
     except Exception as e:
-        logger.error(f"Instagram bot avtomatik ishga tushirishda xato: {str(e)}")
+        logger.error("Instagram bot avtomatik ishga tushirishda xato: %s", e)
         return False
\ No newline at end of file
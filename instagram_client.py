@@ -1,7 +1,9 @@
+import json
 import logging
 import os
 import time
 from typing import Optional, Dict, Any, List
+from werkzeug.security import generate_password_hash, check_password_hash
 try:
     from instagrapi import Client
     INSTAGRAPI_AVAILABLE = True
@@ -10,11 +12,24 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# instagrapi sessiyalari: restartda login round-trip'lari (va challenge) o'tkazib yuboriladi.
+# Fayllarda cookie'lar bor - katalog 0700, fayllar 0600; joriy katalogga bog'liq emas.
+SESSION_DIR = os.environ.get('INSTAGRAM_SESSION_DIR') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'instance', 'instagram_sessions'
+)
+
+def session_path_for(bot_id: int) -> str:
+    return os.path.join(SESSION_DIR, f"{bot_id}.json")
+
+def _credential_key(username: str, password: str) -> str:
+    return f"{username.strip().lower()}\0{password}"
+
 class InstagramClient:
-    def __init__(self):
+    def __init__(self, session_path: Optional[str] = None):
         self.client: Optional[Client] = None
         self.username: Optional[str] = None
         self.is_authenticated = False
+        self.session_path = session_path
         
         if INSTAGRAPI_AVAILABLE:
             self.client = Client()
@@ -27,15 +42,19 @@ class InstagramClient:
             logger.error("instagrapi library not installed")
             return False, "Kutubxona o'rnatilmagan"
             
+        if self._resume_session(username, password):
+            return True, "Saqlangan sessiya bilan kirildi"
+            
         try:
-            logger.info(f"Attempting login for {username}...")
+            logger.info("Attempting login for %s...", username)
             self.client.login(username, password)
+            self._dump_session(username, password)
             self.username = username
             self.is_authenticated = True
-            logger.info(f"Successfully logged in as {username}")
+            logger.info("Successfully logged in as %s", username)
             return True, "Muvaffaqiyatli kirildi"
         except Exception as e:
-            logger.error(f"Instagram login failed for {username}: {str(e)}")
+            logger.error("Instagram login failed for %s: %s", username, e)
             self.is_authenticated = False
             error_msg = str(e)
             if "challenge_required" in error_msg:
@@ -46,6 +65,61 @@ class InstagramClient:
                 return False, "Parol noto'g'ri"
             return False, f"Xatolik: {error_msg}"
 
+    def _resume_session(self, username: str, password: str) -> bool:
+        """Reuse saved instagrapi settings for the same account and password; validated with one cheap feed request"""
+        if not self.session_path or not os.path.exists(self.session_path):
+            return False
+        try:
+            with open(self.session_path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+            credential = saved.get('credential') or ''
+            if (saved.get('username') or '').lower() != username.strip().lower() \
+                    or not check_password_hash(credential, _credential_key(username, password)):
+                # Akkaunt yoki parol o'zgargan - eski sessiya bilan boshqa akkaunt nomidan ishlamaslik
+                logger.info("Saved Instagram session does not match %s, logging in again", username)
+                self._drop_session()
+                return False
+            self.client.set_settings(saved['settings'])
+            self.client.get_timeline_feed()
+            if saved.get('user_id') and str(self.client.user_id) != str(saved['user_id']):
+                raise ValueError("session belongs to another account")
+            self.username = username
+            self.is_authenticated = True
+            logger.info("Resumed saved Instagram session for %s", username)
+            return True
+        except Exception as e:
+            logger.warning("Saved Instagram session for %s is invalid, logging in again: %s", username, e)
+            self._drop_session()
+            # Eski cookie'lar yangi login'ga aralashmasligi uchun toza client
+            self.client = Client()
+            self.client.request_timeout = 30
+            return False
+
+    def _dump_session(self, username: str, password: str) -> None:
+        if not self.session_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.session_path) or '.', mode=0o700, exist_ok=True)
+            saved = {
+                'username': username.strip().lower(),
+                'user_id': str(self.client.user_id or ''),
+                'credential': generate_password_hash(_credential_key(username, password)),
+                'settings': self.client.get_settings(),
+            }
+            tmp_path = f"{self.session_path}.tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(saved, f)
+            os.replace(tmp_path, self.session_path)
+        except Exception as e:
+            logger.warning("Could not save Instagram session: %s", e)
+
+    def _drop_session(self) -> None:
+        try:
+            os.remove(self.session_path)
+        except OSError:
+            pass
+
     def send_message(self, user_id: str, text: str):
         """Send direct message to a user"""
         if not self.is_authenticated or not self.client:
@@ -57,7 +131,7 @@ class InstagramClient:
             self.client.direct_send(text, [int(user_id)])
             return True
         except Exception as e:
-            logger.error(f"Failed to send DM: {e}")
+            logger.error("Failed to send DM: %s", e)
             return False
 
     def get_user_id_from_username(self, username: str):
@@ -67,7 +141,7 @@ class InstagramClient:
         try:
             return self.client.user_id_from_username(username)
         except Exception as e:
-            logger.error(f"Failed to get user ID: {e}")
+            logger.error("Failed to get user ID: %s", e)
             return None
 
     def get_unread_messages(self):
@@ -85,7 +159,7 @@ class InstagramClient:
                 pass
             return threads
         except Exception as e:
-            logger.error(f"Failed to check inbox: {e}")
+            logger.error("Failed to check inbox: %s", e)
             return []
             
 # Global instance management could handle multiple bots, 
@@ -1,167 +1,575 @@
 import os
+import re
+import time
+import hashlib
 import logging
-from typing import Optional
-from flask import Blueprint, render_template, request, jsonify
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from textwrap import dedent
+from typing import Dict, Iterator, Optional, Tuple
+from flask import Blueprint, Response, current_app, render_template, request, jsonify
 from flask_login import login_required
 from app import csrf
+from ai import get_cached_response, cache_response
+from semantic_cache import semantic_cache, SEMANTIC_CACHE_AVAILABLE
 
 # Configure logger
 logger = logging.getLogger(__name__)
 
-try:
-    import google.generativeai as genai
-    GOOGLE_GENAI_AVAILABLE = True
-except ImportError:
-    GOOGLE_GENAI_AVAILABLE = False
-    logger.warning("google-generativeai not installed. Marketing AI disabled.")
+# Gemini chaqiruvi uchun timeout (soniya) va timeoutdan keyin qayta urinishlar soni (1s, 2s, ... kutib)
+REQUEST_TIMEOUT = float(os.environ.get('MARKETING_AI_TIMEOUT', '15'))
+REQUEST_RETRIES = int(os.environ.get('MARKETING_AI_RETRIES', '1'))
+# Kvota (429 ResourceExhausted) uchun qayta urinishlar: 0.5s, 1s, 2s ... (maks. 4s)
+QUOTA_RETRIES = int(os.environ.get('MARKETING_AI_QUOTA_RETRIES', '2'))
+QUOTA_BACKOFF_MAX = 4.0
+# gRPC: bitta doimiy HTTP/2 kanal barcha so'rovlar uchun multiplekslanadi (har chaqiruvda TLS handshake yo'q)
+TRANSPORT = os.environ.get('MARKETING_AI_TRANSPORT', 'grpc')
+
+# Javob keshi: exact (jarayon LRU + Redis, 1 soat) va ixtiyoriy semantik kesh
+# (MARKETING_SEMANTIC_CACHE=1 - qayta ifodalangan mavzular uchun)
+MARKETING_SEMANTIC_CACHE = SEMANTIC_CACHE_AVAILABLE and os.environ.get('MARKETING_SEMANTIC_CACHE') == '1'
+
+# Bir xil so'rovlar bir vaqtda kelsa (ikki marta bosish, bir nechta tab) bitta Gemini chaqiruvini kutishadi;
+# parallel chaqiruvlar soni kvota ichida qolishi uchun cheklangan
+MAX_INFLIGHT = int(os.environ.get('MARKETING_AI_MAX_INFLIGHT', '16'))
+# Gemini chaqiruvlari shu umumiy pool'da bajariladi; Flask thread natijani CALL_TIMEOUT gacha kutadi
+# (retry va kvota kutishlari bilan birga) - sekin chaqiruv worker thread'ni cheksiz band qilmaydi
+_LLM_POOL = ThreadPoolExecutor(max_workers=int(os.environ.get('MARKETING_AI_POOL_SIZE', '64')), thread_name_prefix='marketing-llm')
+CALL_TIMEOUT = float(os.environ.get('MARKETING_AI_CALL_TIMEOUT', str(REQUEST_TIMEOUT * (REQUEST_RETRIES + 1) + 5)))
+_gemini_slots = threading.BoundedSemaphore(MAX_INFLIGHT)
+_inflight: Dict[str, Future] = {}
+_inflight_lock = threading.Lock()
+
+def _marketing_cache_key(kind: str, language: str, *inputs: str) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    for part in (kind, language) + inputs:
+        digest.update((part or '').strip().lower().encode('utf-8', errors='ignore'))
+        digest.update(b'\x1f')
+    return f"mkt:{digest.hexdigest()}"
+
+# Statik ko'rsatmalar so'rovning system_instruction maydonida yuboriladi (prompt matnida takrorlanmaydi);
+# promptga faqat foydalanuvchi kiritgan qiymatlar .format() qilinadi
+_SYSTEM_INSTRUCTIONS = {
+    'seo:uz': dedent("""
+        Siz professional SMM menejer va SEO mutaxassisisiz.
+        
+        Vazifa: Foydalanuvchi bergan mavzu bo'yicha Telegram kanal yoki Instagram uchun SEO optimallashtirilgan, o'quvchini jalb qiluvchi post yozing.
+        
+        Talablar:
+        1. Sarlavha: Diqqatni tortadigan (Clickbait emas, lekin qiziqarli)
+        2. Kirish: Muammoni ko'rsatish va qiziqtirish
+        3. Asosiy qism: Foydali ma'lumotlar ro'yxati (bullet points)
+        4. Call to Action (CTA): Obuna bo'lishga yoki sotib olishga undash
+        5. Xshteglar: # bilan yozilgan 5-10 ta relevant heshteg
+        6. Emojilar: Matnni jonlantirish uchun mos emojilar
+        
+        Matnni chiroyli formatda va professional ohangda yozing.
+        """).strip(),
+    
+    'seo:ru': dedent("""
+        Вы профессиональный SMM-менеджер и SEO-специалист.
+        
+        Задача: Написать SEO-оптимизированный, вовлекающий пост на тему пользователя для Telegram-канала или Instagram.
+        
+        Требования:
+        1. Заголовок: Цепляющий внимание
+        2. Введение: Обозначение проблемы и интрига
+        3. Основная часть: Полезная информация списком
+        4. Call to Action (CTA): Призыв к действию (подписка/покупка)
+        5. Хэштеги: 5-10 релевантных хэштегов
+        6. Эмодзи: Для оживления текста
+        """).strip(),
+    
+    'plan': dedent("""
+        Foydalanuvchi bergan mahsulot uchun 3 kunlik mini marketing rejasini tuzing:
+        1-kun: Qiziqtirish (Teaser)
+        2-kun: Foydali kontent + Muammo yechimi
+        3-kun: Sotuv posti (Chegirma yoki Taklif)
+        
+        Har bir kun uchun qisqacha post g'oyasi va sarlavhasini yozing.
+        """).strip(),
+    
+    'image': dedent("""
+        Vazifa: Foydalanuvchi bergan mavzu uchun "Imagen 3" yoki "Midjourney" AI lari uchun mukammal ingliz tilida rasm promptini yozing.
+        
+        Talablar:
+        1. Fotorealistik, 8k sifat, kinematik yoritish.
+        2. Tafsilotlarga boy (muhit, ranglar, uslub).
+        3. Prompt ingliz tilida bo'lishi SHART.
+        4. Javob faqat promptdan iborat bo'lsin.
+        """).strip(),
+}
+
+# Javob uzunligi chegarasi (token) - model keraksiz uzun matn yozib vaqt va pul sarflamasligi uchun
+_GENERATION_CONFIGS = {
+    'seo': {'max_output_tokens': 800, 'temperature': 0.8, 'top_p': 0.95},
+    'plan': {'max_output_tokens': 600, 'temperature': 0.8, 'top_p': 0.95},
+    'image': {'max_output_tokens': 200, 'temperature': 0.4},
+}
+
+_SEO_TEMPLATES = {
+    'uz': "Mavzu: {topic}\nKalit so'zlar: {keywords}",
+    'ru': "Тема: {topic}\nКлючевые слова: {keywords}",
+}
+
+_PLAN_TEMPLATE = "Mahsulot: {product_name}\nNishon auditoriya: {target_audience}"
+
+_IMAGE_PROMPT_TEMPLATE = "Mavzu: {topic}"
+
+def _seo_prompt(topic: str, keywords: str, language: str) -> str:
+    return _SEO_TEMPLATES.get(language, _SEO_TEMPLATES['uz']).format(topic=topic, keywords=keywords)
+
+# (log label, xatolik xabari, rad etilganda xabar) - har bir generator uchun
+_SEO_ERRORS = ("SEO post generation", "❌ Post yaratishda xatolik yuz berdi.",
+               "❌ So'rov qabul qilinmadi. Mavzu va kalit so'zlarni o'zgartirib ko'ring.")
+_PLAN_ERRORS = ("Marketing plan", "❌ Marketing reja tuzishda xatolik.",
+                "❌ So'rov qabul qilinmadi. Mahsulot ma'lumotlarini o'zgartirib ko'ring.")
+_IMAGE_ERRORS = ("Image prompt generation", "❌ Rasm prompti yaratishda xatolik.",
+                 "❌ So'rov qabul qilinmadi. Mavzuni o'zgartirib ko'ring.")
+
+def _response_text(response) -> str:
+    """
+    Text of a GenerateContentResponse
+    Raises ValueError when the prompt or the answer was blocked, like GenerativeModel's response.text.
+    """
+    if not response.candidates:
+        raise ValueError(f"Gemini returned no candidates (prompt feedback: {response.prompt_feedback})")
+    candidate = response.candidates[0]
+    if not candidate.content.parts:
+        raise ValueError(f"Gemini returned no text (finish reason: {candidate.finish_reason})")
+    return ''.join(part.text for part in candidate.content.parts)
+
+def _chunk_text(chunk) -> str:
+    """Text of one streamed chunk; the closing chunk may carry only the finish reason"""
+    if not chunk.candidates:
+        raise ValueError(f"Gemini returned no candidates (prompt feedback: {chunk.prompt_feedback})")
+    return ''.join(part.text for part in chunk.candidates[0].content.parts)
+
+def _instruction_key(kind: str, language: str) -> str:
+    """_SYSTEM_INSTRUCTIONS key for a generator (SEO falls back to Uzbek like _SEO_TEMPLATES)"""
+    if kind == 'seo':
+        return f"seo:{language if language in _SEO_TEMPLATES else 'uz'}"
+    return kind
+
+class MarketingAIError(Exception):
+    """Marketing generation failed; message is user-facing, status_code/retry_after drive the HTTP reply"""
+    status_code = 502
+
+    def __init__(self, message: str, retry_after: Optional[int] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class MarketingAIUnavailable(MarketingAIError):
+    """No key configured, quota exhausted or Gemini unavailable"""
+    status_code = 503
+
+class MarketingAITimeout(MarketingAIError):
+    """Gemini did not answer within MARKETING_AI_TIMEOUT (after retries)"""
+    status_code = 504
+
+class MarketingAIRejected(MarketingAIError):
+    """Gemini refused the input (invalid argument or safety block) - retrying won't help"""
+    status_code = 422
+
+MODEL_NAME = 'gemini-flash-lite-latest'
+# Kvotasi tugagan kalit shuncha soniya chetga suriladi, so'rovlar boshqa kalitlarga yo'naltiriladi
+QUOTA_COOLDOWN = float(os.environ.get('MARKETING_AI_QUOTA_COOLDOWN', '30'))
+
+def _marketing_api_keys():
+    """(env name, key) pairs: GOOGLE_API_KEY1, GOOGLE_API_KEY2..N, then GOOGLE_API_KEY; duplicates dropped"""
+    names = ['GOOGLE_API_KEY1']
+    n = 2
+    while os.environ.get(f'GOOGLE_API_KEY{n}'):
+        names.append(f'GOOGLE_API_KEY{n}')
+        n += 1
+    names.append('GOOGLE_API_KEY')
+    
+    seen = set()
+    for name in names:
+        key = os.environ.get(name)
+        if key and key not in seen:
+            seen.add(key)
+            yield name, key
+
+class _KeySlot:
+    """One API key's GenerativeServiceClient plus its load / quota state"""
+    __slots__ = ('name', 'client', 'in_flight', 'cold_until')
+
+    def __init__(self, name: str, client):
+        self.name = name
+        self.client = client
+        self.in_flight = 0
+        self.cold_until = 0.0
 
 class MarketingAI:
     def __init__(self):
-        self.api_key = os.environ.get("GOOGLE_API_KEY1")
         self.is_available = False
+        self._slots = []
+        self._slots_lock = threading.Lock()
+        self._retryable_errors = (TimeoutError,)
+        self._timeout_errors = (FutureTimeout, TimeoutError)
+        self._quota_errors = ()
+        self._rejected_errors = ()
+        self._api_errors = (TimeoutError,)
         
-        if not GOOGLE_GENAI_AVAILABLE:
+        # Gemini gRPC klienti (google-generativeai bilan o'rnatiladi) faqat marketing birinchi marta ishlatilganda yuklanadi
+        try:
+            from google.ai import generativelanguage as glm
+            from google.api_core import exceptions as google_exceptions
+            from google.api_core.client_options import ClientOptions
+        except ImportError:
+            logger.warning("google-generativeai not installed. Marketing AI disabled.")
             return
-            
-        if self.api_key:
+        self._glm = glm
+        self._retryable_errors = (google_exceptions.DeadlineExceeded, google_exceptions.ServiceUnavailable, TimeoutError)
+        self._timeout_errors = (google_exceptions.DeadlineExceeded, FutureTimeout, TimeoutError)
+        self._quota_errors = (google_exceptions.ResourceExhausted,)
+        # InvalidArgument - so'rov rad etildi; ValueError - javob xavfsizlik filtri tomonidan bloklandi (.text yo'q)
+        self._rejected_errors = (google_exceptions.InvalidArgument, ValueError)
+        self._api_errors = (google_exceptions.GoogleAPICallError, TimeoutError)
+        
+        # Ko'rsatma va sozlamalar proto sifatida bir marta quriladi, barcha kalitlar uchun umumiy
+        self._instructions = {
+            name: glm.Content(parts=[glm.Part(text=instruction)])
+            for name, instruction in _SYSTEM_INSTRUCTIONS.items()
+        }
+        self._generation_configs = {
+            kind: glm.GenerationConfig(**config) for kind, config in _GENERATION_CONFIGS.items()
+        }
+        
+        # Har bir kalit o'z klienti bilan (genai.configure global - ai.py dagi kalitni almashtirib yubormaslik uchun)
+        for env_name, key in _marketing_api_keys():
             try:
-                # Configure specific client for Marketing/SEO
-                genai.configure(api_key=self.api_key)
-                self.model = genai.GenerativeModel('gemini-flash-lite-latest')
-                self.is_available = True
-                logger.info("✅ Marketing AI initialized with GOOGLE_API_KEY1")
+                client = glm.GenerativeServiceClient(client_options=ClientOptions(api_key=key), transport=TRANSPORT)
+                self._slots.append(_KeySlot(env_name, client))
             except Exception as e:
-                logger.error(f"❌ Failed to initialize Marketing AI: {e}")
+                logger.error(f"❌ Failed to initialize Marketing AI with {env_name}: {e}")
+        
+        if self._slots:
+            self.is_available = True
+            logger.info(f"✅ Marketing AI initialized with {', '.join(slot.name for slot in self._slots)}")
         else:
-            logger.warning("⚠️ GOOGLE_API_KEY1 not found. Marketing features will use default key or be disabled.")
-            # Fallback to default key if KEY1 not present
-            default_key = os.environ.get("GOOGLE_API_KEY")
-            if default_key:
-                try:
-                    genai.configure(api_key=default_key)
-                    self.model = genai.GenerativeModel('gemini-flash-lite-latest')
-                    self.is_available = True
-                    logger.info("⚠️ Marketing AI using default GOOGLE_API_KEY as fallback")
-                except:
-                    pass
+            logger.warning("⚠️ GOOGLE_API_KEY1/GOOGLE_API_KEY not found. Marketing features disabled.")
 
-    def generate_seo_post(self, topic: str, keywords: str, language: str = 'uz') -> str:
+    def _request(self, instruction: str, prompt: str, generation_config=None):
+        """GenerateContentRequest with a precompiled system instruction and the generator's config"""
+        glm = self._glm
+        return glm.GenerateContentRequest(
+            model=f"models/{MODEL_NAME}",
+            system_instruction=self._instructions[instruction],
+            contents=[glm.Content(role='user', parts=[glm.Part(text=prompt)])],
+            generation_config=generation_config or self._generation_configs[instruction.split(':')[0]],
+        )
+
+    def _acquire_slot(self) -> '_KeySlot':
+        """Least-loaded key that is not cooling down after a quota error (or the one that warms up first)"""
+        now = time.monotonic()
+        with self._slots_lock:
+            warm = [slot for slot in self._slots if slot.cold_until <= now]
+            if warm:
+                slot = min(warm, key=lambda s: s.in_flight)
+            else:
+                slot = min(self._slots, key=lambda s: s.cold_until)
+            slot.in_flight += 1
+        return slot
+
+    def _release_slot(self, slot: '_KeySlot') -> None:
+        with self._slots_lock:
+            slot.in_flight -= 1
+
+    def _cool_down(self, slot: '_KeySlot') -> bool:
+        """Bench a key after ResourceExhausted; True if another key is still usable right now"""
+        now = time.monotonic()
+        with self._slots_lock:
+            slot.cold_until = now + QUOTA_COOLDOWN
+            return any(other.cold_until <= now for other in self._slots)
+
+    def warmup(self) -> None:
         """
-        Generate SEO optimized content for blog or channel
+        Open the Gemini channel with a 1-token request so the first real user doesn't pay for it
+        Called per gunicorn worker after fork (gRPC channels must not be shared across fork).
         """
-        if not self.is_available:
-            return "⚠️ AI xizmati mavjud emas. API kalitni tekshiring."
-
-        prompts = {
-            'uz': f"""
-            Siz professional SMM menejer va SEO mutaxassisisiz.
-            Mavzu: {topic}
-            Kalit so'zlar: {keywords}
-            
-            Vazifa: Telegram kanal yoki Instagram uchun SEO optimallashtirilgan, o'quvchini jalb qiluvchi post yozing.
-            
-            Talablar:
-            1. Sarlavha: Diqqatni tortadigan (Clickbait emas, lekin qiziqarli)
-            2. Kirish: Muammoni ko'rsatish va qiziqtirish
-            3. Asosiy qism: Foydali ma'lumotlar ro'yxati (bullet points)
-            4. Call to Action (CTA): Obuna bo'lishga yoki sotib olishga undash
-            5. Xshteglar: # bilan yozilgan 5-10 ta relevant heshteg
-            6. Emojilar: Matnni jonlantirish uchun mos emojilar
-            
-            Matnni chiroyli formatda va professional ohangda yozing.
-            """,
-            
-            'ru': f"""
-            Вы профессиональный SMM-менеджер и SEO-специалист.
-            Тема: {topic}
-            Ключевые слова: {keywords}
-            
-            Задача: Написать SEO-оптимизированный, вовлекающий пост для Telegram-канала или Instagram.
-            
-            Требования:
-            1. Заголовок: Цепляющий внимание
-            2. Введение: Обозначение проблемы и интрига
-            3. Основная часть: Полезная информация списком
-            4. Call to Action (CTA): Призыв к действию (подписка/покупка)
-            5. Хэштеги: 5-10 релевантных хэштегов
-            6. Эмодзи: Для оживления текста
-            """
-        }
+        if not self._slots:
+            return
+        request = self._request('image', 'ping', self._glm.GenerationConfig(max_output_tokens=1))
+        for slot in self._slots:
+            try:
+                slot.client.generate_content(request, timeout=REQUEST_TIMEOUT)
+                logger.info(f"Marketing AI warmed up ({slot.name})")
+            except Exception as e:
+                logger.warning(f"Marketing AI warmup failed ({slot.name}): {e}")
+
+    def _cache_lookup(self, kind: str, language: str, inputs: Tuple[str, ...]):
+        """
+        Return (cached_text or None, store_handle)
+        The handle is passed back to _cache_store() so the embedding is not recomputed.
+        """
+        key = _marketing_cache_key(kind, language, *inputs)
+        cached = get_cached_response(key)
+        if cached is not None:
+            return cached, None
+        
+        namespace = embedding = None
+        if MARKETING_SEMANTIC_CACHE:
+            try:
+                namespace = ('marketing', kind, language)
+                hit, embedding = semantic_cache.lookup(namespace, ' | '.join(inputs))
+                if hit is not None:
+                    cache_response(key, hit)
+                    return hit, None
+            except Exception as e:
+                logger.warning(f"Marketing semantic cache lookup failed: {e}")
+                namespace = None
+        return None, (key, namespace, embedding)
 
+    def _cache_store(self, handle, text: str) -> None:
+        key, namespace, embedding = handle
+        cache_response(key, text)
+        if namespace is not None and embedding is not None:
+            semantic_cache.store(namespace, embedding, text)
+
+    def _cached_generate(self, kind: str, language: str, inputs: Tuple[str, ...], prompt: str) -> str:
+        """
+        Gemini text for a prompt, served from the response caches when possible
+        API errors propagate to the caller, so failures are never cached.
+        """
+        cached, handle = self._cache_lookup(kind, language, inputs)
+        if cached is not None:
+            return cached
+        
+        key = handle[0]
+        with _inflight_lock:
+            pending = _inflight.get(key)
+            is_leader = pending is None
+            if is_leader:
+                pending = _inflight[key] = Future()
+        if not is_leader:
+            return pending.result()
+        
         try:
-            prompt = prompts.get(language, prompts['uz'])
-            response = self.model.generate_content(prompt)
-            return response.text
+            with _gemini_slots:
+                text = self._generate_with_retry(_instruction_key(kind, language), prompt)
+            if text:
+                self._cache_store(handle, text)
+            pending.set_result(text)
+            return text
         except Exception as e:
-            logger.error(f"SEO post generation error: {e}")
-            return "❌ Post yaratishda xatolik yuz berdi."
+            pending.set_exception(e)
+            raise
+        finally:
+            with _inflight_lock:
+                _inflight.pop(key, None)
 
-    def generate_marketing_plan(self, product_name: str, target_audience: str) -> str:
+    def _generate_with_retry(self, instruction: str, prompt: str) -> str:
+        """generate_content with a per-call deadline (see _call_with_retry for the retry policy)"""
+        request = self._request(instruction, prompt)
+        return self._call_with_retry(
+            lambda slot: _response_text(slot.client.generate_content(request, timeout=REQUEST_TIMEOUT))
+        )
+
+    def _call_with_retry(self, call):
         """
-        Generate a mini marketing strategy
+        Run call(slot) on the least-loaded key
+        Timeouts are retried REQUEST_RETRIES times (1s, 2s, ...). A quota error benches that key and
+        moves straight to another one; once all keys are benched it backs off QUOTA_RETRIES times
+        (0.5s, 1s, ... capped at 4s). Anything else propagates to the caller.
         """
+        timeouts = quota_hits = 0
+        while True:
+            slot = self._acquire_slot()
+            try:
+                return call(slot)
+            except self._quota_errors as e:
+                if self._cool_down(slot):
+                    logger.warning(f"Marketing AI quota exhausted on {slot.name}, switching key")
+                    continue
+                if quota_hits >= QUOTA_RETRIES:
+                    raise
+                delay = min(0.5 * 2 ** quota_hits, QUOTA_BACKOFF_MAX)
+                quota_hits += 1
+                logger.warning(f"Marketing AI quota exhausted ({e}), retrying in {delay}s")
+            except self._retryable_errors as e:
+                if timeouts >= REQUEST_RETRIES:
+                    raise
+                delay = 2 ** timeouts
+                timeouts += 1
+                logger.warning(f"Marketing AI call timed out ({e}), retrying in {delay}s")
+            finally:
+                self._release_slot(slot)
+            time.sleep(delay)
+
+    def _submit(self, kind: str, language: str, inputs: Tuple[str, ...], prompt: str) -> Future:
+        """Run _cached_generate on the shared _LLM_POOL; the caller waits via _result()"""
         if not self.is_available:
-            return "⚠️ AI xizmati mavjud emas."
+            raise MarketingAIUnavailable("⚠️ AI xizmati mavjud emas. API kalitni tekshiring.")
+        return _LLM_POOL.submit(self._cached_generate, kind, language, inputs, prompt)
+
+    def _result(self, future: Future, label: str, failure_message: str, rejected_message: str) -> str:
+        """
+        Wait at most CALL_TIMEOUT for a _submit() future
+        Gemini/transport errors are translated into MarketingAIError subclasses.
+        """
+        try:
+            return future.result(timeout=CALL_TIMEOUT)
+        except Exception as e:
+            error = self._translate_error(e, label, failure_message, rejected_message)
+            if error is None:
+                raise
+            raise error from e
 
-        prompt = f"""
-        Mahsulot: {product_name}
-        Nishon auditoriya: {target_audience}
+    def _translate_error(self, e: Exception, label: str, failure_message: str,
+                         rejected_message: str) -> Optional[MarketingAIError]:
+        """MarketingAIError subclass for a Gemini/transport error (None if it is not one of ours to map)"""
+        if isinstance(e, self._rejected_errors):
+            logger.warning(f"{label} rejected by Gemini: {e}")
+            return MarketingAIRejected(rejected_message)
+        if isinstance(e, self._quota_errors):
+            logger.error(f"{label} quota exhausted: {e}")
+            return MarketingAIUnavailable("⏳ AI xizmati band. Birozdan so'ng qayta urinib ko'ring.",
+                                          retry_after=int(QUOTA_COOLDOWN))
+        if isinstance(e, self._timeout_errors):
+            logger.error(f"{label} timed out: {e}")
+            return MarketingAITimeout("⏳ AI javobi kechikdi. Qayta urinib ko'ring.")
+        if isinstance(e, self._api_errors):
+            logger.error(f"{label} error: {e}")
+            return MarketingAIUnavailable(failure_message)
+        return None
+
+    def generate_seo_post(self, topic: str, keywords: str, language: str = 'uz') -> str:
+        """
+        Generate SEO optimized content for blog or channel
+        Raises MarketingAIError on failure.
+        """
+        future = self._submit('seo', language, (topic, keywords), _seo_prompt(topic, keywords, language))
+        return self._result(future, *_SEO_ERRORS)
+
+    def stream_seo_post(self, topic: str, keywords: str, language: str = 'uz') -> Iterator[str]:
+        """
+        Same as generate_seo_post, but yields text deltas as Gemini produces them
+        Shares the concurrency cap, key switching/retry, in-flight coalescing and error mapping of the
+        non-streaming path. Retries only happen before the first delta; a cached (or coalesced) post is
+        yielded in one piece, and the full text is cached once the stream completes.
+        """
+        if not self.is_available:
+            raise MarketingAIUnavailable("⚠️ AI xizmati mavjud emas. API kalitni tekshiring.")
         
-        Ushbu mahsulot uchun 3 kunlik mini marketing rejasini tuzing:
-        1-kun: Qiziqtirish (Teaser)
-        2-kun: Foydali kontent + Muammo yechimi
-        3-kun: Sotuv posti (Chegirma yoki Taklif)
+        inputs = (topic, keywords)
+        cached, handle = self._cache_lookup('seo', language, inputs)
+        if cached is not None:
+            yield cached
+            return
         
-        Har bir kun uchun qisqacha post g'oyasi va sarlavhasini yozing.
-        """
+        key = handle[0]
+        with _inflight_lock:
+            pending = _inflight.get(key)
+            is_leader = pending is None
+            if is_leader:
+                pending = _inflight[key] = Future()
+        if not is_leader:
+            yield self._result(pending, *_SEO_ERRORS)
+            return
+        
+        request = self._request(_instruction_key('seo', language), _seo_prompt(topic, keywords, language))
+        
+        def open_stream(slot):
+            # Xatolar (kvota, timeout) odatda birinchi bo'lakda chiqadi - shu yerda qayta uriniladi
+            stream = iter(slot.client.stream_generate_content(request, timeout=REQUEST_TIMEOUT))
+            first = next(stream, None)
+            return ([first] if first is not None else []), stream
         
+        parts = []
         try:
-            response = self.model.generate_content(prompt)
-            return response.text
+            with _gemini_slots:
+                head, stream = self._call_with_retry(open_stream)
+                for chunks in (head, stream):
+                    for chunk in chunks:
+                        text = _chunk_text(chunk)
+                        if text:
+                            parts.append(text)
+                            yield text
+            text = ''.join(parts)
+            if text:
+                self._cache_store(handle, text)
+            pending.set_result(text)
         except Exception as e:
-            logger.error(f"Marketing plan error: {e}")
-            return "❌ Marketing reja tuzishda xatolik."
+            error = self._translate_error(e, *_SEO_ERRORS)
+            pending.set_exception(error or e)
+            if error is None:
+                raise
+            raise error from e
+        finally:
+            if not pending.done():
+                # Mijoz oqimni yopdi (GeneratorExit) - kutayotganlar osilib qolmasin
+                pending.set_exception(MarketingAIUnavailable(_SEO_ERRORS[1]))
+            with _inflight_lock:
+                _inflight.pop(key, None)
+
+    def generate_marketing_plan(self, product_name: str, target_audience: str) -> str:
+        """
+        Generate a mini marketing strategy
+        Raises MarketingAIError on failure.
+        """
+        prompt = _PLAN_TEMPLATE.format(product_name=product_name, target_audience=target_audience)
+        return self._result(self._submit('plan', 'uz', (product_name, target_audience), prompt), *_PLAN_ERRORS)
 
-    
     def generate_image_prompt(self, topic: str) -> str:
         """ 
         Generate a detailed image prompt for Imagen 3 / Midjourney based on the topic
+        Raises MarketingAIError on failure.
         """
-        if not self.is_available:
-            return ""
-            
-        prompt = f"""
-        Mavzu: {topic}
-        
-        Vazifa: Ushbu mavzu uchun "Imagen 3" yoki "Midjourney" AI lari uchun mukammal ingliz tilida rasm promptini yozing.
-        
-        Talablar:
-        1. Fotorealistik, 8k sifat, kinematik yoritish.
-        2. Tafsilotlarga boy (muhit, ranglar, uslub).
-        3. Prompt ingliz tilida bo'lishi SHART.
-        4. Javob faqat promptdan iborat bo'lsin.
+        prompt = _IMAGE_PROMPT_TEMPLATE.format(topic=topic)
+        return self._result(self._submit('image', 'en', (topic,), prompt), *_IMAGE_ERRORS).strip()
+
+    def generate_seo_bundle(self, topic: str, keywords: str, language: str = 'uz') -> Tuple[str, str]:
         """
-        
+        SEO post and a matching image prompt in one go
+        Both Gemini calls are submitted to _LLM_POOL together instead of running back to back.
+        A failed post raises MarketingAIError; a failed image prompt just comes back empty.
+        """
+        post_future = self._submit('seo', language, (topic, keywords), _seo_prompt(topic, keywords, language))
+        image_future = self._submit('image', 'en', (topic,), _IMAGE_PROMPT_TEMPLATE.format(topic=topic))
+        post = self._result(post_future, *_SEO_ERRORS)
         try:
-            response = self.model.generate_content(prompt)
-            return response.text.strip()
-        except Exception as e:
-            logger.error(f"Image prompt generation error: {e}")
-            return ""
+            image_prompt = self._result(image_future, *_IMAGE_ERRORS).strip()
+        except MarketingAIError:
+            image_prompt = ''
+        return post, image_prompt
 
 # Create Blueprint
 marketing_bp = Blueprint('marketing', __name__)
 
+# Kiritish chegaralari: mavzu/mahsulot nomi va kalit so'zlar/auditoriya (belgilar) - Gemini'ga yuborishdan oldin
+MAX_TOPIC_LENGTH = 500
+MAX_KEYWORDS_LENGTH = 1000
+TOO_LONG_MSG = f"Matn juda uzun: mavzu {MAX_TOPIC_LENGTH}, kalit so'zlar {MAX_KEYWORDS_LENGTH} belgidan oshmasin"
+_CONTROL_CHARS = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')
+
+def _text_input(data: dict, name: str) -> str:
+    """Request field as a stripped string without control characters"""
+    return _CONTROL_CHARS.sub('', str(data.get(name) or '')).strip()
+
 # Global instance - lazy initialized
 _marketing_ai = None
+_marketing_ai_lock = threading.Lock()
 
 def get_marketing_ai():
     """Get or create the marketing AI instance (lazy initialization)"""
     global _marketing_ai
     if _marketing_ai is None:
-        _marketing_ai = MarketingAI()
+        with _marketing_ai_lock:
+            if _marketing_ai is None:
+                _marketing_ai = MarketingAI()
     return _marketing_ai
 
+@marketing_bp.errorhandler(MarketingAIError)
+def handle_marketing_ai_error(e: MarketingAIError):
+    """Real status codes (503/504/422/502) so clients can tell failures apart and retry"""
+    response = jsonify({'error': str(e)})
+    response.status_code = e.status_code
+    if e.retry_after:
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
 @marketing_bp.route('/')
 @login_required
 def marketing_index():
@@ -173,28 +581,68 @@ def marketing_index():
 @login_required  
 def generate_seo():
     """Generate SEO optimized post"""
-    data = request.get_json()
-    topic = data.get('topic', '')
-    keywords = data.get('keywords', '')
-    language = data.get('language', 'uz')
+    data = request.get_json(silent=True) or {}
+    topic = _text_input(data, 'topic')
+    keywords = _text_input(data, 'keywords')
+    language = data.get('language') if data.get('language') in _SEO_TEMPLATES else 'uz'
     
     if not topic:
         return jsonify({'error': 'Mavzuni kiriting'}), 400
+    if len(topic) > MAX_TOPIC_LENGTH or len(keywords) > MAX_KEYWORDS_LENGTH:
+        return jsonify({'error': TOO_LONG_MSG}), 400
+    
+    if data.get('include_image_prompt'):
+        result, image_prompt = get_marketing_ai().generate_seo_bundle(topic, keywords, language)
+        return jsonify({'content': result, 'prompt': image_prompt})
     
     result = get_marketing_ai().generate_seo_post(topic, keywords, language)
     return jsonify({'content': result})
 
+@marketing_bp.route('/generate-seo/stream', methods=['POST'])
+@csrf.exempt
+@login_required
+def generate_seo_stream():
+    """Stream an SEO post as server-sent events ({"delta": ...} chunks, then {"done": true})"""
+    data = request.get_json(silent=True) or {}
+    topic = _text_input(data, 'topic')
+    keywords = _text_input(data, 'keywords')
+    language = data.get('language') if data.get('language') in _SEO_TEMPLATES else 'uz'
+    
+    if not topic:
+        return jsonify({'error': 'Mavzuni kiriting'}), 400
+    if len(topic) > MAX_TOPIC_LENGTH or len(keywords) > MAX_KEYWORDS_LENGTH:
+        return jsonify({'error': TOO_LONG_MSG}), 400
+    
+    # Generator request kontekstidan tashqarida ishlaydi - app JSON provider (orjson) oldindan olinadi
+    dumps = current_app.json.dumps
+    
+    def events():
+        try:
+            for delta in get_marketing_ai().stream_seo_post(topic, keywords, language):
+                yield f"data: {dumps({'delta': delta})}\n\n"
+            yield f"data: {dumps({'done': True})}\n\n"
+        except MarketingAIError as e:
+            yield f"event: error\ndata: {dumps({'error': str(e), 'status': e.status_code})}\n\n"
+        except Exception as e:
+            logger.error(f"SEO post streaming error: {e}")
+            yield f"event: error\ndata: {dumps({'error': 'Post yaratishda xatolik yuz berdi.'})}\n\n"
+    
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @marketing_bp.route('/generate-plan', methods=['POST'])
 @csrf.exempt
 @login_required
 def generate_plan():
     """Generate marketing plan"""
-    data = request.get_json()
-    product_name = data.get('product_name', '')
-    target_audience = data.get('target_audience', '')
+    data = request.get_json(silent=True) or {}
+    product_name = _text_input(data, 'product_name')
+    target_audience = _text_input(data, 'target_audience')
     
     if not product_name:
         return jsonify({'error': 'Mahsulot nomini kiriting'}), 400
+    if len(product_name) > MAX_TOPIC_LENGTH or len(target_audience) > MAX_KEYWORDS_LENGTH:
+        return jsonify({'error': TOO_LONG_MSG}), 400
     
     result = get_marketing_ai().generate_marketing_plan(product_name, target_audience)
     return jsonify({'content': result})
@@ -204,11 +652,13 @@ def generate_plan():
 @login_required
 def generate_image_prompt():
     """Generate image prompt for AI image generators"""
-    data = request.get_json()
-    topic = data.get('topic', '')
+    data = request.get_json(silent=True) or {}
+    topic = _text_input(data, 'topic')
     
     if not topic:
         return jsonify({'error': 'Mavzuni kiriting'}), 400
+    if len(topic) > MAX_TOPIC_LENGTH:
+        return jsonify({'error': TOO_LONG_MSG}), 400
     
     result = get_marketing_ai().generate_image_prompt(topic)
     return jsonify({'prompt': result})
\ No newline at end of file
@@ -32,6 +32,10 @@ def add_performance_indices():
                 "CREATE INDEX IF NOT EXISTS idx_chat_bot_user ON chat_history(bot_id, user_telegram_id)",
                 "CREATE INDEX IF NOT EXISTS idx_chat_created_desc ON chat_history(created_at DESC)",
                 "CREATE INDEX IF NOT EXISTS idx_chat_bot_created ON chat_history(bot_id, created_at DESC)",
+                "CREATE INDEX IF NOT EXISTS idx_chat_bot_instagram ON chat_history(bot_id, user_instagram_id)",
+                
+                # Bot customer upsert target (ON CONFLICT) - eski jadvallarda constraint bo'lmasligi mumkin
+                "CREATE UNIQUE INDEX IF NOT EXISTS uq_botcustomer_target ON bot_customer(bot_id, platform, platform_user_id)",
                 
                 # Knowledge base indices
                 "CREATE INDEX IF NOT EXISTS idx_kb_bot_id ON knowledge_base(bot_id)",
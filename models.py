@@ -190,7 +190,7 @@ class BotCustomer(db.Model):
     first_interaction = db.Column(db.DateTime, default=datetime.utcnow)
     
     # Constraints to ensure unique customer per bot per platform
-    __table_args__ = (db.UniqueConstraint('bot_id', 'platform', 'platform_user_id'),)
+    __table_args__ = (db.UniqueConstraint('bot_id', 'platform', 'platform_user_id', name='uq_botcustomer_target'),)
     
     def __repr__(self):
         return f'<BotCustomer {self.first_name} {self.last_name} - {self.platform}>'
@@ -3,11 +3,10 @@ import json
 import hashlib
 import hmac
 import logging
-import requests
 from datetime import datetime, timedelta
 from flask import Blueprint, request, jsonify, flash, redirect, url_for
 from flask_login import login_required, current_user
-from app import db
+from app import db, app
 from models import User, Payment
 from utils import generate_transaction_id, format_currency
 
@@ -16,6 +15,7 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 payment_bp = Blueprint('payment', __name__)
+http = app.extensions['http']
 
 class PaymeAPI:
     """Payme to'lov tizimi integratsiyasi"""
@@ -155,7 +155,7 @@ class UzumAPI:
                 'callback_url': url_for('payment.uzum_callback', _external=True)
             }
             
-            response = requests.post(
+            response = http.post(
                 f"{self.base_url}/payments",
                 headers=headers,
                 json=payload,
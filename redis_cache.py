@@ -80,6 +80,29 @@ def cache_knowledge_base(bot_id: int, knowledge_base: str, ttl: int = 1800):
     except Exception as e:
         logger.error(f"Cache set error: {e}")
 
+def knowledge_base_generation(bot_id: int) -> int:
+    """
+    Cross-process edit counter for a bot's knowledge base (part of ai._knowledge_base_version)
+    """
+    if not redis_client:
+        return 0
+    try:
+        return int(redis_client.get(cache_key("kbgen", bot_id)) or 0)
+    except Exception as e:
+        logger.error(f"Cache get error: {e}")
+        return 0
+
+def bump_knowledge_base_generation(bot_id: int):
+    """
+    Mark a bot's knowledge base as edited for every process (bot manager, web workers)
+    """
+    if not redis_client:
+        return
+    try:
+        redis_client.incr(cache_key("kbgen", bot_id))
+    except Exception as e:
+        logger.error(f"Cache incr error: {e}")
+
 def invalidate_knowledge_base(bot_id: int):
     """
     Invalidate knowledge base cache when updated
@@ -1,12 +1,12 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, send_file
 from flask_login import login_required, current_user
-from app import db, csrf
+from app import db, csrf, app
 from bot_manager import bot_manager
+from ai import kb_cache_bump
 from models import User, Bot, KnowledgeBase, Payment, ChatHistory, BroadcastMessage, BotCustomer, BotMessage
 from werkzeug.utils import secure_filename
 import os
 import logging
-import requests
 from datetime import datetime, timedelta
 import docx
 import pandas as pd
@@ -14,6 +14,7 @@ from io import BytesIO
 from flask import send_file
 
 main_bp = Blueprint('main', __name__)
+http = app.extensions['http']
 
 @main_bp.route('/')
 def index():
@@ -46,6 +47,7 @@ def api_webchat():
 
         # If there is at least one bot, pass its knowledge base
         kb_text = ''
+        first_bot = None
         try:
             first_bot = Bot.query.first()
             if first_bot:
@@ -54,7 +56,7 @@ def api_webchat():
         except Exception:
             kb_text = ''
 
-        reply = get_ai_response(message=message, bot_name=bot_name, user_language=user_lang, knowledge_base=kb_text, chat_history='')
+        reply = get_ai_response(message=message, bot_name=bot_name, user_language=user_lang, knowledge_base=kb_text, chat_history='', bot_id=first_bot.id if first_bot else None)
         reply = reply or 'Salom! Hozircha javob tayyorlanmoqda. 🤖'
         return jsonify({"ok": True, "reply": reply})
     except Exception as e:
@@ -62,14 +64,24 @@ def api_webchat():
 
 @main_bp.route('/healthz')
 def healthz():
-    """Simple health check endpoint for deployment monitoring"""
+    """Liveness check for deployment monitoring - answers immediately, no DB or bot checks"""
+    return jsonify({"status": "ok"}), 200
+
+@main_bp.route('/readyz')
+def readyz():
+    """Readiness check: database reachable and (when this process runs it) bot manager started"""
+    from sqlalchemy import text
+    checks = {}
     try:
-        # Optional: lightweight DB check
-        from app import db
-        db.session.execute('SELECT 1')
-        return jsonify({"status": "ok", "db": "ok"}), 200
+        db.session.execute(text('SELECT 1'))
+        checks['db'] = 'ok'
     except Exception:
-        return jsonify({"status": "ok", "db": "degraded"}), 200
+        db.session.rollback()
+        checks['db'] = 'unavailable'
+    if os.environ.get('RUN_BOT_MANAGER', '1') == '1':
+        checks['bot_manager'] = 'ok' if bot_manager.startup_complete else 'starting'
+    ready = all(value == 'ok' for value in checks.values())
+    return jsonify({"status": "ready" if ready else "not_ready", **checks}), 200 if ready else 503
 
 @main_bp.route('/dashboard')
 @login_required
@@ -477,7 +489,7 @@ def instagram_diagnostics(bot_id):
         # Minimal token validation: call Graph /me
         if bot.instagram_token:
             try:
-                resp = requests.get('https://graph.facebook.com/v18.0/me', params={'access_token': bot.instagram_token}, timeout=15)
+                resp = http.get('https://graph.facebook.com/v18.0/me', params={'access_token': bot.instagram_token}, timeout=15)
                 j = {}
                 try:
                     j = resp.json()
@@ -742,6 +754,7 @@ def handle_bulk_product_upload(file, bot_id):
         
         # Saqlash
         db.session.commit()
+        kb_cache_bump(bot_id)
         
         if added_count > 0:
             flash(f'{added_count} ta mahsulot muvaffaqiyatli qo\'shildi!', 'success')
@@ -1308,6 +1321,7 @@ def upload_knowledge(bot_id):
             
             db.session.add(knowledge)
             db.session.commit()
+            kb_cache_bump(bot_id)
             
             flash('Bilim bazasi muvaffaqiyatli yuklandi!', 'success')
         except Exception as e:
@@ -1374,6 +1388,7 @@ def add_text_knowledge(bot_id):
         
         db.session.add(knowledge)
         db.session.commit()
+        kb_cache_bump(bot_id)
         
         flash('Matn muvaffaqiyatli qo\'shildi!', 'success')
     except Exception as e:
@@ -1437,6 +1452,7 @@ def add_image_knowledge(bot_id):
         
         db.session.add(knowledge)
         db.session.commit()
+        kb_cache_bump(bot_id)
         
         flash('Rasm havolasi muvaffaqiyatli qo\'shildi!', 'success')
     except Exception as e:
@@ -1564,6 +1580,7 @@ def add_product_knowledge(bot_id):
         
         db.session.add(knowledge)
         db.session.commit()
+        kb_cache_bump(bot_id)
         
         # Debug: log mahsulot qo'shilishini
         logging.info(f"DEBUG: New product added - Name: {product_name}, Bot ID: {bot_id}, Content: {content[:100]}...")
@@ -1675,6 +1692,7 @@ def upload_bulk_products(bot_id):
                 errors.append(f'Qator {row_num}: {str(e)}')
         
         db.session.commit()
+        kb_cache_bump(bot_id)
         
         if added_count > 0:
             flash(f'{added_count} ta mahsulot muvaffaqiyatli qo\'shildi!', 'success')
@@ -1818,7 +1836,7 @@ def set_telegram_webhook(bot_token, webhook_url):
             'allowed_updates': ['message', 'callback_query']
         }
         
-        response = requests.post(api_url, json=payload)
+        response = http.post(api_url, json=payload)
         result = response.json()
         
         if result.get('ok'):
@@ -1984,7 +2002,7 @@ def send_telegram_message_sync(bot_token, chat_id, message_text):
             'parse_mode': 'HTML'
         }
         
-        response = requests.post(url, json=data, timeout=30)
+        response = http.post(url, json=data, timeout=30)
         result = response.json()
         
         return result.get('ok', False)
@@ -10,7 +10,7 @@ if PROJECT_ROOT not in sys.path:
 
 from app import app, db
 from models import User
-from werkzeug.security import generate_password_hash
+from auth import hash_password
 
 
 def main():
@@ -24,7 +24,7 @@ def main():
     with app.app_context():
         user = User.query.filter_by(email=email).first()
         if user:
-            user.password_hash = generate_password_hash(password)
+            user.password_hash = hash_password(password)
             user.is_admin = True
             user.subscription_type = 'admin'
             db.session.commit()
@@ -34,7 +34,7 @@ def main():
             user = User(
                 username=username,
                 email=email,
-                password_hash=generate_password_hash(password),
+                password_hash=hash_password(password),
                 language='uz',
                 subscription_type='admin',
                 is_admin=True,
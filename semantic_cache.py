@@ -0,0 +1,129 @@
+"""
+Semantic response cache for AI answers
+Paraphrased repeats ("narx qancha?" / "qancha turadi?") reuse an earlier
+Gemini answer when their sentence embeddings are close enough.
+"""
+import os
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, Any
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+    SEMANTIC_CACHE_AVAILABLE = True
+except ImportError:
+    SEMANTIC_CACHE_AVAILABLE = False
+
+MODEL_NAME = os.environ.get('SEMANTIC_CACHE_MODEL', 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2')
+SIMILARITY_THRESHOLD = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', '0.92'))
+MAX_ENTRIES = 2048  # Har bir bot/til/bilim bazasi uchun
+INITIAL_ENTRIES = 64  # Matritsa kerak bo'lganda 2 barobar o'sadi (MAX_ENTRIES gacha)
+MAX_NAMESPACES = int(os.environ.get('SEMANTIC_CACHE_NAMESPACES', '64'))  # LRU: eng eski nomlar maydoni o'chiriladi
+
+def is_enabled_for_bot(bot_id: Optional[int]) -> bool:
+    """
+    Per-bot toggle via SEMANTIC_CACHE_BOTS env ("*" for all bots or "1,5,7")
+    """
+    if not SEMANTIC_CACHE_AVAILABLE or bot_id is None:
+        return False
+    setting = os.environ.get('SEMANTIC_CACHE_BOTS', '').strip()
+    if not setting:
+        return False
+    if setting == '*':
+        return True
+    return str(bot_id) in {part.strip() for part in setting.split(',')}
+
+class _Namespace:
+    """Embedding matrix E[N, d] with a parallel list of responses (grows on demand, then ring buffer)"""
+
+    def __init__(self, dim: int):
+        self.matrix = np.zeros((INITIAL_ENTRIES, dim), dtype=np.float32)
+        self.responses = []
+        self.size = 0
+        self.next_index = 0
+
+    def best_match(self, query) -> Tuple[Optional[str], float]:
+        if not self.size:
+            return None, 0.0
+        sims = self.matrix[:self.size] @ query  # Normallashtirilgan vektorlar: cosine = dot
+        i = int(sims.argmax())
+        return self.responses[i], float(sims[i])
+
+    def add(self, embedding, response: str) -> None:
+        if self.size == len(self.matrix) and self.size < MAX_ENTRIES:
+            grown = np.zeros((min(self.size * 2, MAX_ENTRIES), self.matrix.shape[1]), dtype=np.float32)
+            grown[:self.size] = self.matrix
+            self.matrix = grown
+        self.matrix[self.next_index] = embedding
+        if self.next_index < len(self.responses):
+            self.responses[self.next_index] = response
+        else:
+            self.responses.append(response)
+        self.next_index = (self.next_index + 1) % MAX_ENTRIES
+        self.size = min(self.size + 1, MAX_ENTRIES)
+
+class SemanticCache:
+    """In-process semantic cache keyed by (bot_id, language, knowledge base digest)"""
+
+    def __init__(self):
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._namespaces: "OrderedDict[Tuple[Any, ...], _Namespace]" = OrderedDict()
+
+    def _get_model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    logger.info(f"Loading semantic cache model: {MODEL_NAME}")
+                    self._model = SentenceTransformer(MODEL_NAME)
+        return self._model
+
+    def encode(self, message: str):
+        """Embed a message as a normalized float32 vector"""
+        vector = self._get_model().encode(message.strip().lower(), normalize_embeddings=True)
+        return np.asarray(vector, dtype=np.float32)
+
+    def lookup(self, namespace: Tuple[Any, ...], message: str):
+        """
+        Return (cached_response or None, query_embedding)
+        The embedding is returned so the caller can store() it without re-encoding.
+        """
+        embedding = self.encode(message)
+        with self._lock:
+            ns = self._namespaces.get(namespace)
+            if ns is None:
+                return None, embedding
+            self._namespaces.move_to_end(namespace)
+            response, similarity = ns.best_match(embedding)
+        if response is not None and similarity >= SIMILARITY_THRESHOLD:
+            logger.debug(f"Semantic cache HIT ({similarity:.3f}) for {namespace[:2]}")
+            return response, embedding
+        return None, embedding
+
+    def store(self, namespace: Tuple[Any, ...], embedding, response: str) -> None:
+        """Remember the response for this embedding"""
+        with self._lock:
+            ns = self._namespaces.get(namespace)
+            if ns is None:
+                ns = self._namespaces[namespace] = _Namespace(embedding.shape[0])
+                while len(self._namespaces) > MAX_NAMESPACES:
+                    self._namespaces.popitem(last=False)
+            else:
+                self._namespaces.move_to_end(namespace)
+            ns.add(embedding, response)
+
+    def clear(self, bot_id: Optional[int] = None) -> None:
+        """Drop cached entries for one bot (or all bots)"""
+        with self._lock:
+            if bot_id is None:
+                self._namespaces.clear()
+            else:
+                for key in [k for k in self._namespaces if k[0] == bot_id]:
+                    del self._namespaces[key]
+
+semantic_cache = SemanticCache()
@@ -1,12 +1,67 @@
 import os
+import json
 import logging
 import asyncio
+import importlib.util
+import time
 import requests
 import tempfile
-from typing import Optional
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Dict, Optional, Tuple
 from datetime import datetime, timedelta
 from audio_processor import download_and_process_audio, process_audio_message
 
+# uvloop (ixtiyoriy): faqat bot thread'larining loop'i (run_polling) - global policy o'zgartirilmaydi,
+# web ilovadagi boshqa asyncio kodi standart loop'da qoladi
+try:
+    import uvloop
+    UVLOOP_AVAILABLE = True
+except ImportError:
+    UVLOOP_AVAILABLE = False
+
+# orjson (ixtiyoriy): reply_markup kodlash va Bot API javoblarini (getUpdates partiyalari) parse qilish
+try:
+    import orjson
+
+    def _json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    def _json_loads(content):
+        return orjson.loads(content)
+except ImportError:
+    def _json_dumps(obj) -> str:
+        return json.dumps(obj)
+
+    def _json_loads(content):
+        return json.loads(content)
+
+# httpx (ixtiyoriy): polling loop'i getUpdates'ni event loop ichida, thread'siz kutadi
+try:
+    import httpx
+    HTTPX_AVAILABLE = True
+    HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+except ImportError:
+    HTTPX_AVAILABLE = HTTP2_AVAILABLE = False
+
+# Barcha botlar uchun bitta Session: api.telegram.org ga keep-alive ulanishlar qayta ishlatiladi
+# (har bir so'rovda yangi TCP+TLS handshake yo'q). POST qayta yuborilmaydi - faqat ulanish xatolari.
+TELEGRAM_TIMEOUT = 15  # seconds
+# getUpdates long polling: Telegram so'rovni yangilik kelguncha shuncha soniya ushlab turadi
+LONG_POLL_TIMEOUT = 25  # seconds (client timeout is a bit longer)
+ALLOWED_UPDATES = '["message", "callback_query"]'
+# Har bir bot event loop'ining default executori (audio, DB, httpx'siz fallback kabi bloklovchi ishlar uchun)
+TELEGRAM_THREAD_POOL_SIZE = int(os.environ.get('TELEGRAM_THREAD_POOL_SIZE', '16'))
+_telegram_http = requests.Session()
+_telegram_http.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=50,
+    max_retries=Retry(total=2, read=0, backoff_factor=0.3)
+))
+
 # Set telegram as available and use real bot implementation
 TELEGRAM_AVAILABLE = True
 
@@ -48,43 +103,174 @@ class InlineKeyboardMarkup:
             ]
         }
 
+# Til tanlash klaviaturalari va matnlar bir marta tayyorlanadi (har /language da qayta qurilmaydi)
+LANGUAGE_NAMES = {'uz': "O'zbek", 'ru': "Русский", 'en': "English"}
+_LANGUAGE_KEYBOARD_UNLOCKED_JSON = _json_dumps(InlineKeyboardMarkup([
+    [InlineKeyboardButton("🇺🇿 O'zbek", callback_data="lang_uz")],
+    [InlineKeyboardButton("🇷🇺 Русский", callback_data="lang_ru")],
+    [InlineKeyboardButton("🇺🇸 English", callback_data="lang_en")]
+]).to_dict())
+_LANGUAGE_KEYBOARD_LOCKED_JSON = _json_dumps(InlineKeyboardMarkup([
+    [InlineKeyboardButton("🇺🇿 O'zbek", callback_data="lang_uz")],
+    [InlineKeyboardButton("🔒 Русский (Starter/Basic/Premium)", callback_data="lang_locked")],
+    [InlineKeyboardButton("🔒 English (Starter/Basic/Premium)", callback_data="lang_locked")]
+]).to_dict())
+LANGUAGE_CHANGED_MESSAGES = {
+    'uz': f"✅ Til {LANGUAGE_NAMES['uz']} ga o'zgartirildi!",
+    'ru': f"✅ Язык изменен на {LANGUAGE_NAMES['ru']}!",
+    'en': f"✅ Language changed to {LANGUAGE_NAMES['en']}!"
+}
+WELCOME_TMPL = (
+    "🤖 Salom! Men {bot_name} chatbot!\n\n"
+    "📝 Menga savolingizni yozing va men sizga yordam beraman.\n"
+    "🌐 Tilni tanlash uchun /language buyrug'ini ishlating.\n"
+    "❓ Yordam uchun /help buyrug'ini ishlating."
+)
+
 # Real Telegram Bot implementation using HTTP API
 class ContextTypes:
     DEFAULT_TYPE = "DefaultContext"
 
+_EVENT_HANDLER_TYPES = frozenset(('message', 'voice', 'callback'))
+
+# Update wrappers (module level - process_update har safar klasslarni qayta yaratmasligi uchun)
+class SimpleUser:
+    def __init__(self, data):
+        self.data = data
+        self.id = data['id']
+        self.username = data.get('username', '')
+        self.first_name = data.get('first_name', '')
+
+class SimpleChat:
+    def __init__(self, data):
+        self.data = data
+        self.id = data['id']
+
+class SimpleMessage:
+    def __init__(self, data, bot):
+        self.data = data
+        self.bot = bot
+        self.text = data.get('text', '')
+        self.voice = data.get('voice')
+        self.audio = data.get('audio') 
+        self.document = data.get('document')
+        self.chat = SimpleChat(data['chat'])
+        
+    async def reply_text(self, text, reply_markup=None, parse_mode=None):
+        return await self.bot.send_message_async(self.chat.id, text, reply_markup, parse_mode)
+    
+    async def reply_photo(self, photo, caption=None):
+        """Reply with photo via sendPhoto API"""
+        try:
+            data = {
+                'chat_id': self.chat.id,
+                'photo': photo
+            }
+            if caption:
+                data['caption'] = caption
+            
+            return await self.bot.api_call('sendPhoto', data)
+        except Exception as e:
+            logger.error(f"Failed to send photo: {e}")
+            # Graceful fallback - send text message instead
+            fallback_text = f"🖼️ Rasm: {caption or 'Rasm yuborilmadi'}"
+            return await self.reply_text(fallback_text)
+
+class SimpleCallbackQuery:
+    def __init__(self, data, bot):
+        self.data = data.get('data', '')  # Extract callback_data properly
+        self.id = data.get('id', '')
+        self.bot = bot
+        self.from_user = SimpleUser(data['from'])
+        self.message = data.get('message', {})
+        
+    async def answer(self):
+        """Answer callback query via answerCallbackQuery API"""
+        try:
+            return await self.bot.api_call('answerCallbackQuery', {'callback_query_id': self.id})
+        except Exception as e:
+            logger.error(f"Failed to answer callback query: {e}")
+            return {'ok': False, 'error': str(e)}
+        
+    async def edit_message_text(self, text):
+        """Edit message text via editMessageText API"""
+        try:
+            data = {
+                'chat_id': self.message.get('chat', {}).get('id'),
+                'message_id': self.message.get('message_id'),
+                'text': text
+            }
+            return await self.bot.api_call('editMessageText', data)
+        except Exception as e:
+            logger.error(f"Failed to edit message text: {e}")
+            return {'ok': False, 'error': str(e)}
+
+class SimpleUpdate:
+    """Simplified Update object bound to the bot that received it"""
+    def __init__(self, data, bot):
+        self.data = data
+        self.message = None
+        self.callback_query = None
+        self.effective_user = None
+        self.effective_chat = None
+        
+        if 'message' in data:
+            self.message = SimpleMessage(data['message'], bot)
+            self.effective_user = SimpleUser(data['message']['from'])
+            self.effective_chat = SimpleChat(data['message']['chat'])
+        elif 'callback_query' in data:
+            self.callback_query = SimpleCallbackQuery(data['callback_query'], bot)
+            self.effective_user = SimpleUser(data['callback_query']['from'])
+            self.effective_chat = SimpleChat(data['callback_query']['message']['chat'])
+
+class SimpleContext:
+    def __init__(self, text=None, bot=None):
+        self.args = []
+        self.bot = bot  # Add bot reference
+        if text and text.startswith('/'):
+            # Split command and arguments
+            self.args = text.split()[1:]  # Remove command itself
+
 class TelegramHTTPBot:
     def __init__(self, token):
         self.token = token
-        self.handlers = {}
+        self.handlers = {}  # 'message' / 'voice' / 'callback' -> handlers
+        self.commands = {}  # command name -> handlers
         self.running = False
         self.base_url = f"https://api.telegram.org/bot{token}"
+        self.session = _telegram_http
+        self.async_http = None  # httpx.AsyncClient, polling event loop'i ichida yaratiladi
         
     def add_handler(self, handler):
         if isinstance(handler, tuple):
             cmd_type, func = handler
-            if cmd_type not in self.handlers:
-                self.handlers[cmd_type] = []
-            self.handlers[cmd_type].append(func)
+            registry = self.handlers if cmd_type in _EVENT_HANDLER_TYPES else self.commands
+            registry.setdefault(cmd_type, []).append(func)
         
-    def send_message(self, chat_id, text, reply_markup=None):
-        url = f"{self.base_url}/sendMessage"
+    @staticmethod
+    def _message_payload(chat_id, text, reply_markup=None, parse_mode=None):
         data = {
             'chat_id': chat_id,
             'text': text
         }
+        if parse_mode:
+            data['parse_mode'] = parse_mode
         if reply_markup:
-            import json
-            # Convert reply_markup to JSON if it's an object
+            # Convert reply_markup to JSON if it's an object (already serialized strings are sent as-is)
             if hasattr(reply_markup, 'to_dict'):
-                data['reply_markup'] = json.dumps(reply_markup.to_dict())
+                data['reply_markup'] = _json_dumps(reply_markup.to_dict())
             elif isinstance(reply_markup, dict):
-                data['reply_markup'] = json.dumps(reply_markup)
+                data['reply_markup'] = _json_dumps(reply_markup)
             else:
                 data['reply_markup'] = reply_markup
-        
+        return data
+    
+    def send_message(self, chat_id, text, reply_markup=None, parse_mode=None):
+        url = f"{self.base_url}/sendMessage"
+        data = self._message_payload(chat_id, text, reply_markup, parse_mode)
         try:
-            response = requests.post(url, json=data)
-            return response.json()
+            response = self.session.post(url, json=data, timeout=TELEGRAM_TIMEOUT)
+            return _json_loads(response.content)
         except Exception as e:
             # Ultra-safe logging
             try:
@@ -93,29 +279,72 @@ class TelegramHTTPBot:
                 pass
             return None
     
+    async def api_call(self, method, data):
+        """
+        POST a Bot API method from async code and return the decoded reply
+        Uses the loop's httpx client (no thread hop); outside the polling loop falls back to the shared Session in a thread.
+        """
+        url = f"{self.base_url}/{method}"
+        if self.async_http is not None:
+            response = await self.async_http.post(url, json=data, timeout=TELEGRAM_TIMEOUT)
+        else:
+            response = await asyncio.get_running_loop().run_in_executor(
+                None, lambda: self.session.post(url, json=data, timeout=TELEGRAM_TIMEOUT)
+            )
+        return _json_loads(response.content)
+    
+    async def send_message_async(self, chat_id, text, reply_markup=None, parse_mode=None):
+        try:
+            return await self.api_call('sendMessage', self._message_payload(chat_id, text, reply_markup, parse_mode))
+        except Exception:
+            logger.error("Error sending message occurred")
+            return None
+    
+    async def edit_message_text_async(self, chat_id, message_id, text):
+        """Async editMessageText (streaming AI replies)"""
+        try:
+            return await self.api_call('editMessageText', {'chat_id': chat_id, 'message_id': message_id, 'text': text})
+        except Exception:
+            logger.error("Error editing message occurred")
+            return None
+    
+    def edit_message_text(self, chat_id, message_id, text):
+        """Edit an already sent message (used for streaming AI replies)"""
+        url = f"{self.base_url}/editMessageText"
+        data = {
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'text': text
+        }
+        try:
+            response = self.session.post(url, json=data, timeout=TELEGRAM_TIMEOUT)
+            return _json_loads(response.content)
+        except Exception:
+            try:
+                logger.error("Error editing message occurred")
+            except:
+                pass
+            return None
+    
     def delete_webhook(self, drop_pending_updates: bool = False):
         """Delete webhook to enable long polling. Safe to call multiple times."""
         try:
             url = f"{self.base_url}/deleteWebhook"
             payload = {"drop_pending_updates": drop_pending_updates}
-            resp = requests.post(url, json=payload, timeout=10)
-            data = resp.json()
+            resp = self.session.post(url, json=payload, timeout=10)
+            data = _json_loads(resp.content)
             return data.get('ok', False)
         except Exception:
             return False
     
     async def send_chat_action(self, chat_id, action):
         """Send typing or other chat actions to user"""
-        url = f"{self.base_url}/sendChatAction"
         data = {
             'chat_id': chat_id,
             'action': action
         }
         try:
-            import asyncio
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(None, lambda: requests.post(url, json=data))
-            return response.json()
+            return await self.api_call('sendChatAction', data)
         except Exception as e:
             try:
                 logger.error("Error sending chat action occurred")
@@ -125,13 +354,13 @@ class TelegramHTTPBot:
     
     def get_updates(self, offset=None):
         url = f"{self.base_url}/getUpdates"
-        params = {'timeout': 10}
+        params = {'timeout': LONG_POLL_TIMEOUT, 'allowed_updates': ALLOWED_UPDATES}
         if offset:
             params['offset'] = offset
             
         try:
-            response = requests.get(url, params=params)
-            return response.json()
+            response = self.session.get(url, params=params, timeout=LONG_POLL_TIMEOUT + 5)
+            return _json_loads(response.content)
         except Exception as e:
             # Ultra-safe logging
             try:
@@ -140,213 +369,144 @@ class TelegramHTTPBot:
                 pass
             return {'ok': False, 'result': []}
             
-    async def process_update(self, update_data):
-        # Create simplified Update object
-        class SimpleUpdate:
-            def __init__(self, data):
-                self.data = data
-                self.message = None
-                self.callback_query = None
-                self.effective_user = None
-                self.effective_chat = None
-                
-                if 'message' in data:
-                    self.message = SimpleMessage(data['message'])
-                    self.effective_user = SimpleUser(data['message']['from'])
-                    self.effective_chat = SimpleChat(data['message']['chat'])
-                elif 'callback_query' in data:
-                    self.callback_query = SimpleCallbackQuery(data['callback_query'])
-                    self.effective_user = SimpleUser(data['callback_query']['from'])
-                    self.effective_chat = SimpleChat(data['callback_query']['message']['chat'])
+    async def get_updates_async(self, offset=None):
+        """getUpdates on the polling event loop (falls back to the sync call in a thread without httpx)"""
+        if self.async_http is None:
+            return await asyncio.get_running_loop().run_in_executor(None, self.get_updates, offset)
         
-        class SimpleMessage:
-            def __init__(self, data):
-                self.data = data
-                self.text = data.get('text', '')
-                self.voice = data.get('voice')
-                self.audio = data.get('audio') 
-                self.document = data.get('document')
-                self.chat = SimpleChat(data['chat'])
-                
-            async def reply_text(self, text, reply_markup=None):
-                loop = asyncio.get_event_loop()
-                result = await loop.run_in_executor(
-                    None, lambda: bot_instance.send_message(self.chat.id, text, reply_markup)
-                )
-                return result
+        params = {'timeout': LONG_POLL_TIMEOUT, 'allowed_updates': ALLOWED_UPDATES}
+        if offset:
+            params['offset'] = offset
+        try:
+            response = await self.async_http.get(f"{self.base_url}/getUpdates", params=params)
+            return _json_loads(response.content)
+        except Exception:
+            logger.error("Error getting updates occurred")
+            return {'ok': False, 'result': []}
             
-            async def reply_photo(self, photo, caption=None):
-                """Reply with photo via sendPhoto API"""
-                url = f"{bot_instance.base_url}/sendPhoto"
-                try:
-                    data = {
-                        'chat_id': self.chat.id,
-                        'photo': photo
-                    }
-                    if caption:
-                        data['caption'] = caption
-                    
-                    response = await asyncio.get_event_loop().run_in_executor(
-                        None, lambda: requests.post(url, json=data)
-                    )
-                    return response.json()
-                except Exception as e:
-                    logger.error(f"Failed to send photo: {e}")
-                    # Graceful fallback - send text message instead
-                    fallback_text = f"🖼️ Rasm: {caption or 'Rasm yuborilmadi'}"
-                    return await self.reply_text(fallback_text)
-        
-        class SimpleUser:
-            def __init__(self, data):
-                self.data = data
-                self.id = data['id']
-                self.username = data.get('username', '')
-                self.first_name = data.get('first_name', '')
-                
-        class SimpleChat:
-            def __init__(self, data):
-                self.data = data
-                self.id = data['id']
-                
-        class SimpleCallbackQuery:
-            def __init__(self, data):
-                self.data = data.get('data', '')  # Extract callback_data properly
-                self.id = data.get('id', '')
-                self.from_user = SimpleUser(data['from'])
-                self.message = data.get('message', {})
-                
-            async def answer(self):
-                """Answer callback query via answerCallbackQuery API"""
-                url = f"{bot_instance.base_url}/answerCallbackQuery"
-                try:
-                    loop = asyncio.get_event_loop()
-                    response = await loop.run_in_executor(
-                        None, lambda: requests.post(url, json={'callback_query_id': self.id})
-                    )
-                    return response.json()
-                except Exception as e:
-                    logger.error(f"Failed to answer callback query: {e}")
-                    return {'ok': False, 'error': str(e)}
-                
-            async def edit_message_text(self, text):
-                """Edit message text via editMessageText API"""
-                url = f"{bot_instance.base_url}/editMessageText"
-                try:
-                    data = {
-                        'chat_id': self.message.get('chat', {}).get('id'),
-                        'message_id': self.message.get('message_id'),
-                        'text': text
-                    }
-                    loop = asyncio.get_event_loop()
-                    response = await loop.run_in_executor(
-                        None, lambda: requests.post(url, json=data)
-                    )
-                    return response.json()
-                except Exception as e:
-                    logger.error(f"Failed to edit message text: {e}")
-                    return {'ok': False, 'error': str(e)}
-        
-        # Process update
-        update = SimpleUpdate(update_data)
-        
-        # Create context object
-        class SimpleContext:
-            def __init__(self, text=None, bot=None):
-                self.args = []
-                self.bot = bot  # Add bot reference
-                if text and text.startswith('/'):
-                    # Split command and arguments
-                    parts = text.split()[1:]  # Remove command itself
-                    self.args = parts
+    async def process_update(self, update_data):
+        update = SimpleUpdate(update_data, self)
         
         # Handle voice messages first
         if update.message and (update.message.voice or update.message.audio):
             context = SimpleContext(None, self)
-            if 'voice' in self.handlers:
-                for handler in self.handlers['voice']:
-                    await handler(update, context)
+            for handler in self.handlers.get('voice', ()):
+                await handler(update, context)
         # Handle text commands and messages
         elif update.message and update.message.text:
             text = update.message.text
             context = SimpleContext(text, self)
             
             if text.startswith('/'):
-                cmd = text.split()[0][1:]  # Remove '/'
-                if 'start' in self.handlers and cmd == 'start':
-                    for handler in self.handlers['start']:
-                        await handler(update, context)
-                elif 'help' in self.handlers and cmd == 'help':
-                    for handler in self.handlers['help']:
-                        await handler(update, context)
-                elif 'language' in self.handlers and cmd == 'language':
-                    for handler in self.handlers['language']:
-                        await handler(update, context)
+                parts = text[1:].split(None, 1)
+                cmd = parts[0].split('@', 1)[0] if parts else ''  # /start@BotName (guruhlarda)
+                for handler in self.commands.get(cmd, ()):
+                    await handler(update, context)
             else:
                 # Regular message
-                if 'message' in self.handlers:
-                    for handler in self.handlers['message']:
-                        await handler(update, context)
+                for handler in self.handlers.get('message', ()):
+                    await handler(update, context)
         
         # Handle callback queries
-        if update.callback_query and 'callback' in self.handlers:
+        if update.callback_query:
             context = SimpleContext()  # Empty context for callbacks
-            for handler in self.handlers['callback']:
+            for handler in self.handlers.get('callback', ()):
                 await handler(update, context)
 
 class TelegramApplication:
     def __init__(self, token):
         self.bot = TelegramHTTPBot(token)
+        self._tasks = set()
+        self._chat_locks = {}  # chat_id -> [asyncio.Lock, pending count]
         
     def add_handler(self, handler):
         self.bot.add_handler(handler)
         
     def run_polling(self):
-        # Simple polling implementation
+        """Blocking entry point - one event loop (uvloop when installed) for the whole lifetime of the bot"""
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop if UVLOOP_AVAILABLE else None) as runner:
+            runner.run(self.run_polling_async())
+    
+    async def run_polling_async(self):
+        """Long-poll getUpdates and handle each update as its own task (chats run concurrently)"""
         offset = None
-        global bot_instance
-        bot_instance = self.bot
+        self.bot.running = True
+        loop = asyncio.get_running_loop()
+        # asyncio.run() loop yopilganda shu executorni ham to'xtatadi
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=TELEGRAM_THREAD_POOL_SIZE, thread_name_prefix='tg-io'))
         # Ensure webhook is removed so getUpdates will work
         try:
-            self.bot.delete_webhook(drop_pending_updates=False)
+            await loop.run_in_executor(None, lambda: self.bot.delete_webhook(drop_pending_updates=False))
         except Exception:
             pass
         
+        if HTTPX_AVAILABLE:
+            # HTTP/2: javoblar, typing va tahrirlar bitta ulanishda multiplekslanadi
+            self.bot.async_http = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                timeout=LONG_POLL_TIMEOUT + 5,
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=20)
+            )
+        
         logger.info("Starting bot polling...")
-        while True:
-            try:
-                updates = self.bot.get_updates(offset)
-                if updates.get('ok') and updates.get('result'):
-                    for update in updates['result']:
-                        # Deduplicate by update_id across the process to avoid double replies
-                        try:
-                            uid = update.get('update_id')
-                        except Exception:
-                            uid = None
-                        
-                        # DEBUG: Log every update
-                        logger.info(f"DEBUG: Received update_id={uid}")
-                        
-                        if uid is not None and not _mark_processed(uid):
-                            logger.info(f"DEBUG: Skipping duplicate update_id={uid}")
-                            continue
-                        
-                        logger.info(f"DEBUG: Processing update_id={uid}")
-                        asyncio.run(self.bot.process_update(update))
-                        offset = update['update_id'] + 1
-                        
-                # Small delay to prevent API spam
-                import time
-                time.sleep(1)
-                
-            except Exception as e:
-                # Ultra-safe logging
+        try:
+            while self.bot.running:
                 try:
-                    error_safe = str(e).encode('ascii', errors='ignore').decode('ascii')
-                    logger.error(f"Polling error: {error_safe}")
-                except:
-                    logger.error("Polling error: encoding issue")
-                import time
-                time.sleep(5)
+                    updates = await self.bot.get_updates_async(offset)
+                    if updates.get('ok') and updates.get('result'):
+                        for update in updates['result']:
+                            uid = update.get('update_id')
+                            if uid is None:
+                                continue
+                            offset = uid + 1
+                            
+                            # Deduplicate by update_id across the process to avoid double replies
+                            if not _mark_processed(self.bot.token, uid):
+                                logger.info(f"DEBUG: Skipping duplicate update_id={uid}")
+                                continue
+                            self._dispatch(update)
+                    elif not updates.get('ok'):
+                        # Xatolikda (409 conflict, 429, tarmoq) API'ni bosib qo'ymaslik uchun kutish
+                        await asyncio.sleep(1)
+                    
+                except Exception as e:
+                    # Ultra-safe logging
+                    try:
+                        error_safe = str(e).encode('ascii', errors='ignore').decode('ascii')
+                        logger.error(f"Polling error: {error_safe}")
+                    except:
+                        logger.error("Polling error: encoding issue")
+                    await asyncio.sleep(5)
+        finally:
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+            if self.bot.async_http is not None:
+                await self.bot.async_http.aclose()
+                self.bot.async_http = None
+    
+    def _dispatch(self, update):
+        """Schedule one update without waiting for it"""
+        source = update.get('message') or (update.get('callback_query') or {}).get('message') or {}
+        chat_id = (source.get('chat') or {}).get('id')
+        task = asyncio.create_task(self._process_in_chat_order(chat_id, update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+    
+    async def _process_in_chat_order(self, chat_id, update):
+        """Updates of one chat run one at a time in arrival order; different chats don't wait for each other"""
+        entry = self._chat_locks.get(chat_id)
+        if entry is None:
+            entry = self._chat_locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self.bot.process_update(update)
+        except Exception as e:
+            logger.error(f"Update processing error: {e}")
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._chat_locks.pop(chat_id, None)
 
 class Application:
     @staticmethod
@@ -400,28 +560,60 @@ def get_dependencies():
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Streaming AI replies: edit the message at most once per interval / per N new chars
+STREAM_EDIT_INTERVAL = 1.0  # seconds
+STREAM_EDIT_MIN_CHARS = 80
+
 # Global deduplication for processed Telegram update IDs to avoid double handling
-# even if multiple polling loops accidentally run in parallel. Keep it bounded.
-PROCESSED_UPDATE_IDS = set()
-from collections import deque
-_processed_queue = deque(maxlen=500)
+# even if multiple polling loops accidentally run in parallel. Bounded LRU (oldest evicted first);
+# keyed by (token, update_id) because update_id sequences are per bot.
+_PROCESSED_MAX = 1024
+_processed_updates: "OrderedDict[tuple, None]" = OrderedDict()
+_processed_lock = threading.Lock()
 
-def _mark_processed(update_id):
-    if update_id in PROCESSED_UPDATE_IDS:
-        return False
-    PROCESSED_UPDATE_IDS.add(update_id)
-    _processed_queue.append(update_id)
-    # When queue drops old IDs, also remove from the set
-    if len(_processed_queue) == _processed_queue.maxlen:
-        # Clean up extras beyond deque window
-        while len(PROCESSED_UPDATE_IDS) > _processed_queue.maxlen:
-            # This is a safety; usually set and deque stay in sync by size
-            try:
-                PROCESSED_UPDATE_IDS.pop()
-            except KeyError:
-                break
+def _mark_processed(token, update_id):
+    key = (token, update_id)
+    with _processed_lock:
+        if key in _processed_updates:
+            return False
+        _processed_updates[key] = None
+        if len(_processed_updates) > _PROCESSED_MAX:
+            _processed_updates.popitem(last=False)
     return True
 
+# Har bir xabarda Bot + owner uchun SQL so'rov bo'lmasligi uchun qisqa muddatli kesh.
+# ORM obyektlari emas, oddiy qiymatlar saqlanadi (sessiyadan ajralgan obyekt lazy-load qila olmaydi).
+BOT_INFO_TTL = 60  # seconds
+_bot_info_cache: Dict[int, Tuple[float, Optional[Tuple[str, str, Optional[str]]]]] = {}
+_bot_info_lock = threading.Lock()
+
+def _get_bot_info(Bot, bot_id):
+    """Return (name, owner_subscription, owner_notification_channel) or None; call inside app context"""
+    now = time.monotonic()
+    with _bot_info_lock:
+        cached = _bot_info_cache.get(bot_id)
+    if cached and now - cached[0] < BOT_INFO_TTL:
+        return cached[1]
+    bot = Bot.query.get(bot_id)
+    info = None
+    if bot:
+        owner = bot.owner
+        info = (
+            bot.name,
+            (owner.subscription_type if owner else None) or 'free',
+            getattr(owner, 'notification_channel', None) if owner else None
+        )
+    with _bot_info_lock:
+        _bot_info_cache[bot_id] = (now, info)
+    return info
+
+def _release_db_connection(db):
+    """End the current transaction so its pooled connection is not held across an await"""
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+
 class TelegramBot:
     def __init__(self, bot_token, bot_id):
         if not TELEGRAM_AVAILABLE:
@@ -468,8 +660,8 @@ class TelegramBot:
                 db.session.commit()
             
             # Get bot info
-            bot = Bot.query.get(self.bot_id)
-            bot_name = bot.name if bot else "BotFactory AI"
+            bot_info = _get_bot_info(Bot, self.bot_id)
+            bot_name = bot_info[0] if bot_info else "BotFactory AI"
             
             # Track customer interaction
             try:
@@ -512,17 +704,14 @@ class TelegramBot:
                 except:
                     pass
             
-            welcome_message = f"🤖 Salom! Men {bot_name} chatbot!\n\n"
-            welcome_message += "📝 Menga savolingizni yozing va men sizga yordam beraman.\n"
-            welcome_message += "🌐 Tilni tanlash uchun /language buyrug'ini ishlating.\n"
-            welcome_message += "❓ Yordam uchun /help buyrug'ini ishlating."
+            welcome_message = WELCOME_TMPL.format(bot_name=bot_name)
             
             if update.message:
                 await update.message.reply_text(welcome_message)
 
             # Send contact options inline keyboard
             try:
-                contact_markup = self._build_contact_keyboard(bot)
+                contact_markup = self._build_contact_keyboard(bot_info[2] if bot_info else None)
                 if update.message and contact_markup:
                     await update.message.reply_text("📞 Biz bilan bog'lanish usullari:", reply_markup=contact_markup)
             except Exception as e:
@@ -592,25 +781,22 @@ Quyidagi buyruqlar mavjud:
         await update.message.reply_text(f"⏳ **{topic}** mavzusida SEO post tayyorlanmoqda...\nIltimos kuting...", parse_mode='Markdown')
         
         try:
-            from marketing import marketing_ai
+            from marketing import get_marketing_ai, MarketingAIError
             
-            # Generate post using the secondary API Key
-            post_content = marketing_ai.generate_seo_post(
-                topic=topic,
-                keywords=topic,
-                language='uz'
+            # Gemini chaqiruvlari bloklaydi - bot event loop'ini (boshqa chatlarni) to'xtatmaslik uchun executor'da
+            loop = asyncio.get_running_loop()
+            post_content, image_prompt = await loop.run_in_executor(
+                None, lambda: get_marketing_ai().generate_seo_bundle(topic=topic, keywords=topic, language='uz')
             )
             
             await update.message.reply_text(post_content)
             
-            # Generate image prompt
-            await update.message.reply_text("🖼 **Rasm uchun g'oya (Imagen 3 Prompt):**\nGenerate qilinmoqda...", parse_mode='Markdown')
-            
-            image_prompt = marketing_ai.generate_image_prompt(topic)
             if image_prompt:
                 msg = f"🎨 **Ushbu post uchun rasm prompti:**\n\n`{image_prompt}`\n\n_Bu promptni nusxalab, rasm generatorga (Imagen, Midjourney) tashlang._"
                 await update.message.reply_text(msg, parse_mode='Markdown')
             
+        except MarketingAIError as e:
+            await update.message.reply_text(str(e))
         except Exception as e:
             logger.error(f"Marketing command error: {e}")
             await update.message.reply_text("❌ Xatolik yuz berdi.")
@@ -631,29 +817,16 @@ Quyidagi buyruqlar mavjud:
                 return
             
             # Determine availability by BOT OWNER's subscription, not end-user
-            bot = Bot.query.get(self.bot_id)
-            owner_subscription = bot.owner.subscription_type if (bot and bot.owner) else 'free'
+            bot_info = _get_bot_info(Bot, self.bot_id)
+            owner_subscription = bot_info[1] if bot_info else 'free'
             owner_subscription_norm = (owner_subscription or '').strip().lower()
             owner_allows_extra = owner_subscription_norm in ['starter', 'basic', 'premium', 'admin']
             
-            # Create language selection keyboard
-            keyboard = []
-            keyboard.append([InlineKeyboardButton("🇺🇿 O'zbek", callback_data="lang_uz")])
-            if owner_allows_extra:
-                keyboard.append([InlineKeyboardButton("🇷🇺 Русский", callback_data="lang_ru")])
-                keyboard.append([InlineKeyboardButton("🇺🇸 English", callback_data="lang_en")])
-            else:
-                keyboard.append([InlineKeyboardButton("🔒 Русский (Starter/Basic/Premium)", callback_data="lang_locked")])
-                keyboard.append([InlineKeyboardButton("🔒 English (Starter/Basic/Premium)", callback_data="lang_locked")])
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
+            # Language selection keyboard (pre-serialized JSON)
+            reply_markup = _LANGUAGE_KEYBOARD_UNLOCKED_JSON if owner_allows_extra else _LANGUAGE_KEYBOARD_LOCKED_JSON
             
-            current_lang = db_user.language
-            lang_names = {'uz': "O'zbek", 'ru': "Русский", 'en': "English"}
-            # Use a variable for default to avoid nested quotes in f-string
-            default_lang = "O'zbek"
-            message = f"🌐 Joriy til: {lang_names.get(current_lang, default_lang)}\n"
-            message += "Tilni tanlang:"
+            current_lang = LANGUAGE_NAMES.get(db_user.language, LANGUAGE_NAMES['uz'])
+            message = f"🌐 Joriy til: {current_lang}\nTilni tanlang:"
             
             if update.message:
                 await update.message.reply_text(message, reply_markup=reply_markup)
@@ -700,8 +873,8 @@ Quyidagi buyruqlar mavjud:
         get_ai_response, process_knowledge_base, User, Bot, ChatHistory, db, app = get_dependencies()
         with app.app_context():
             db_user = User.query.filter_by(telegram_id=user_id).first()
-            bot = Bot.query.get(self.bot_id)
-            owner_subscription = bot.owner.subscription_type if (bot and bot.owner) else 'free'
+            bot_info = _get_bot_info(Bot, self.bot_id)
+            owner_subscription = bot_info[1] if bot_info else 'free'
             owner_allows_extra = owner_subscription in ['starter', 'basic', 'premium', 'admin']
             
             if not db_user:
@@ -711,14 +884,8 @@ Quyidagi buyruqlar mavjud:
             if language == 'uz' or owner_allows_extra:
                 db_user.language = language
                 db.session.commit()
-                lang_names = {'uz': "O'zbek", 'ru': "Русский", 'en': "English"}
-                success_messages = {
-                    'uz': f"✅ Til {lang_names[language]} ga o'zgartirildi!",
-                    'ru': f"✅ Язык изменен на {lang_names[language]}!",
-                    'en': f"✅ Language changed to {lang_names[language]}!"
-                }
                 if query:
-                    await query.edit_message_text(success_messages.get(language, success_messages['uz']))
+                    await query.edit_message_text(LANGUAGE_CHANGED_MESSAGES.get(language, LANGUAGE_CHANGED_MESSAGES['uz']))
             else:
                 if query:
                     await query.edit_message_text("❌ Bu tilni tanlash uchun obunangizni yangilang!")
@@ -761,15 +928,15 @@ Quyidagi buyruqlar mavjud:
         except Exception as e:
             logger.error(f"Failed to notify admin: {str(e)[:100]}")
 
-    def _build_contact_keyboard(self, bot_obj=None):
+    def _build_contact_keyboard(self, notification_channel=None):
         """Create inline keyboard with Telegram DM, Phone call, and Operator callback."""
         try:
             tg_link = os.environ.get('SUPPORT_TELEGRAM') or "https://t.me/akramjon0011"
             phone_number = os.environ.get('SUPPORT_PHONE') or "+998900000000"
             # If bot owner has a notification channel or username, prefer that for Telegram link
-            if bot_obj and bot_obj.owner and getattr(bot_obj.owner, 'notification_channel', None):
+            if notification_channel:
                 # notification_channel may be like @channel; if it's a user, it still works
-                ch = bot_obj.owner.notification_channel
+                ch = notification_channel
                 if ch.startswith('@'):
                     tg_link = f"https://t.me/{ch[1:]}"
             keyboard = [
@@ -820,7 +987,11 @@ Quyidagi buyruqlar mavjud:
                 return
             
             # Check subscription
-            if not db_user.subscription_active():
+            subscription_ok = db_user.subscription_active()
+            bot_name = bot.name
+            user_language = db_user.language
+            _release_db_connection(db)  # Quyidagi await'lar (yuklab olish, Gemini) ulanishni ushlab turmasin
+            if not subscription_ok:
                 if update.message:
                     await update.message.reply_text("❌ Obunangiz tugagan! Iltimos, obunani yangilang.")
                 return
@@ -841,15 +1012,14 @@ Quyidagi buyruqlar mavjud:
                     return
                 
                 # Get file info from Telegram API
-                file_info_url = f"{context.bot.base_url}/getFile"
-                file_info_response = requests.get(file_info_url, params={'file_id': file_id})
+                file_info = await context.bot.api_call('getFile', {'file_id': file_id})
                 
-                if not file_info_response.json().get('ok'):
+                if not file_info.get('ok'):
                     if update.message:
                         await update.message.reply_text("❌ Ovoz faylini olishda xatolik yuz berdi!")
                     return
                 
-                file_path = file_info_response.json()['result']['file_path']
+                file_path = file_info['result']['file_path']
                 file_url = f"https://api.telegram.org/file/bot{context.bot.token}/{file_path}"
                 
                 # Process the voice message using existing audio processor
@@ -857,7 +1027,7 @@ Quyidagi buyruqlar mavjud:
                     # Run the synchronous audio processing in executor to avoid blocking
                     loop = asyncio.get_event_loop()
                     transcribed_text = await loop.run_in_executor(
-                        None, lambda: download_and_process_audio(file_url, db_user.language)
+                        None, lambda: download_and_process_audio(file_url, user_language)
                     )
                     
                     if not transcribed_text or transcribed_text.strip() == "":
@@ -887,14 +1057,17 @@ Quyidagi buyruqlar mavjud:
                                 history_parts.append(f"Foydalanuvchi: {entry.message}")
                                 history_parts.append(f"Bot: {entry.response}")
                             recent_history = "\n".join(history_parts)
+                        _release_db_connection(db)
                         
                         # Generate AI response for transcribed text
-                        ai_response = get_ai_response(
+                        from ai import get_ai_response_async
+                        ai_response = await get_ai_response_async(
                             message=transcribed_text,
-                            bot_name=bot.name,
-                            user_language=db_user.language,
+                            bot_name=bot_name,
+                            user_language=user_language,
                             knowledge_base=knowledge_base,
-                            chat_history=recent_history
+                            chat_history=recent_history,
+                            bot_id=self.bot_id
                         )
                         
                         if ai_response:
@@ -915,7 +1088,7 @@ Quyidagi buyruqlar mavjud:
                                 chat_history.user_telegram_id = str(user_id)
                                 chat_history.message = transcribed_text[:1000]
                                 chat_history.response = cleaned_response[:2000]
-                                chat_history.language = db_user.language or 'uz'
+                                chat_history.language = user_language or 'uz'
                                 
                                 db.session.add(chat_history)
                                 db.session.commit()
@@ -1043,6 +1216,19 @@ Quyidagi buyruqlar mavjud:
                 trial_active = False
 
             subscription_ok = db_user.subscription_active() or trial_active
+            
+            # Keyingi bosqichlar await qiladi (Telegram, Gemini) - kerakli qiymatlar oldindan olinadi,
+            # ORM obyektlariga qaytib murojaat qilinmaydi (commit'dan keyin ular qayta SELECT qiladi)
+            bot_name = bot.name
+            bot_token = bot.telegram_token
+            user_language = db_user.language
+            bot_owner = bot.owner
+            notify_targets = None
+            if (bot_owner and bot_owner.notifications_enabled and
+                    (bot_owner.admin_chat_id or bot_owner.notification_channel)):
+                notify_targets = (bot_owner.admin_chat_id, bot_owner.notification_channel)
+            _release_db_connection(db)
+            
             if not subscription_ok:
                 logger.info("DEBUG: Subscription not active and free trial expired")
                 if update.message:
@@ -1099,6 +1285,8 @@ Quyidagi buyruqlar mavjud:
                 logger.error(f"Chat history/knowledge retrieval error: {str(hist_error)[:100]}")
                 recent_history = ""
                 knowledge_base = ""
+            # Gemini oqimi davomida pool ulanishini ushlab turmaslik
+            _release_db_connection(db)
 
             # Send typing indicator again before AI call
             try:
@@ -1111,12 +1299,18 @@ Quyidagi buyruqlar mavjud:
             try:
                 logger.info("DEBUG: Starting AI response generation")
                 
-                ai_response = get_ai_response(
-                    message=message_text,
-                    bot_name=bot.name,
-                    user_language=db_user.language,
-                    knowledge_base=knowledge_base,
-                    chat_history=recent_history
+                # Javobni Gemini generatsiya qilgan sari bo'laklab yuborish
+                from ai import stream_ai_response_async
+                ai_response, streamed_message_id, streamed_text = await self._stream_ai_reply(
+                    update, context,
+                    stream_ai_response_async(
+                        message=message_text,
+                        bot_name=bot_name,
+                        user_language=user_language,
+                        knowledge_base=knowledge_base,
+                        chat_history=recent_history,
+                        bot_id=self.bot_id
+                    )
                 )
                 
                 logger.info("DEBUG: AI response received")
@@ -1178,7 +1372,7 @@ Quyidagi buyruqlar mavjud:
                             chat_history.user_telegram_id = str(user_id)  # Ensure string
                             chat_history.message = safe_message[:1000]  # Limit length
                             chat_history.response = safe_response[:2000]  # Limit length
-                            chat_history.language = db_user.language or 'uz'
+                            chat_history.language = user_language or 'uz'
                             
                             db.session.add(chat_history)
                             db.session.commit()
@@ -1194,13 +1388,10 @@ Quyidagi buyruqlar mavjud:
                         
                         # Send notification to admin using bot's own token
                         try:
-                            bot_owner = bot.owner
-                            if (bot_owner and bot_owner.notifications_enabled and 
-                                (bot_owner.admin_chat_id or bot_owner.notification_channel)):
-                                
+                            if notify_targets:
                                 from notification_service import TelegramNotificationService
                                 # Use current bot's token for notifications
-                                bot_notification_service = TelegramNotificationService(bot.telegram_token)
+                                bot_notification_service = TelegramNotificationService(bot_token)
                                 
                                 # Get username from update
                                 username = ""
@@ -1211,9 +1402,9 @@ Quyidagi buyruqlar mavjud:
                                     username = ""
                                 
                                 bot_notification_service.send_chat_notification(
-                                    admin_chat_id=bot_owner.admin_chat_id,
-                                    channel_id=bot_owner.notification_channel,
-                                    bot_name=bot.name,
+                                    admin_chat_id=notify_targets[0],
+                                    channel_id=notify_targets[1],
+                                    bot_name=bot_name,
                                     user_id=user_id,
                                     user_message=safe_message,
                                     bot_response=safe_response,
@@ -1232,13 +1423,21 @@ Quyidagi buyruqlar mavjud:
                     # Send the response
                     try:
                         if update.message:
-                            await update.message.reply_text(cleaned_response)
+                            if streamed_message_id:
+                                # Oqim yakunida yakuniy (tozalangan) matnni qo'yish
+                                if cleaned_response != streamed_text:
+                                    await context.bot.edit_message_text_async(
+                                        update.message.chat.id, streamed_message_id, cleaned_response
+                                    )
+                            else:
+                                await update.message.reply_text(cleaned_response)
                             logger.info("DEBUG: Response sent successfully")
                             
                             # Check for relevant product images to send
                             try:
                                 from ai import find_relevant_product_images
                                 relevant_images = find_relevant_product_images(self.bot_id, message_text)
+                                _release_db_connection(db)  # Mahsulot indeksi DB'dan o'qigan bo'lishi mumkin
                                 
                                 for image_info in relevant_images:
                                     try:
@@ -1277,12 +1476,44 @@ Quyidagi buyruqlar mavjud:
                     print("[ERROR] Cannot send error message to user")
     
     
+    async def _stream_ai_reply(self, update, context, chunks):
+        """
+        Stream AI chunks into one Telegram message: send on the first chunk, then edit
+        Returns (full_text, message_id, last_shown_text)
+        """
+        from ai import validate_ai_response
+        
+        parts = []
+        message_id = None
+        shown_text = ""
+        last_edit = 0.0
+        chat_id = update.message.chat.id
+        
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            parts.append(chunk)
+            text = "".join(parts)
+            now = time.monotonic()
+            if message_id is not None and (
+                len(text) - len(shown_text) < STREAM_EDIT_MIN_CHARS or now - last_edit < STREAM_EDIT_INTERVAL
+            ):
+                continue
+            display = validate_ai_response(text) or text
+            if message_id is None:
+                result = await update.message.reply_text(display)
+                message_id = ((result or {}).get('result') or {}).get('message_id')
+            else:
+                await context.bot.edit_message_text_async(chat_id, message_id, display)
+            shown_text = display
+            last_edit = now
+        
+        return "".join(parts), message_id, shown_text
+    
     async def _get_telegram_file_url(self, file_id):
         """Get file URL from Telegram API"""
         try:
-            url = f"https://api.telegram.org/bot{self.bot_token}/getFile"
-            response = requests.get(url, params={'file_id': file_id})
-            data = response.json()
+            data = await self.application.bot.api_call('getFile', {'file_id': file_id})
             
             if data.get('ok') and 'result' in data:
                 file_path = data['result']['file_path']
@@ -1328,7 +1559,6 @@ class BotManager:
             
         if bot_id not in self.running_bots:
             try:
-                import threading
                 bot = TelegramBot(bot_token, bot_id)
                 # Make sure webhook is disabled before polling
                 try:
@@ -1373,13 +1603,12 @@ bot_manager = BotManager()
 
 def validate_telegram_token(token):
     """Telegram bot tokenini tekshirish"""
-    import requests
     try:
         # Basic token format check
         if not token or len(token) < 20:
             return False
             
-        response = requests.get(f"https://api.telegram.org/bot{token}/getMe", timeout=10)
+        response = _telegram_http.get(f"https://api.telegram.org/bot{token}/getMe", timeout=10)
         if response.status_code == 200:
             data = response.json()
             return data.get('ok', False)
@@ -1534,7 +1763,8 @@ def process_webhook_update(bot_id, bot_token, update_data):
                         bot_name=bot.name,
                         user_language=telegram_user.language,
                         knowledge_base=knowledge_base,
-                        chat_history=chat_history
+                        chat_history=chat_history,
+                        bot_id=bot_id
                     )
                     
                     if not ai_response:
@@ -1588,7 +1818,7 @@ def send_webhook_message(bot_token, chat_id, text):
             'parse_mode': 'HTML'
         }
         
-        response = requests.post(url, json=payload)
+        response = _telegram_http.post(url, json=payload, timeout=TELEGRAM_TIMEOUT)
         return response.json().get('ok', False)
         
     except Exception as e:
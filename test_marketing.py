@@ -5,7 +5,9 @@ from dotenv import load_dotenv
 # Load env vars
 load_dotenv()
 
-from marketing import marketing_ai
+from marketing import get_marketing_ai
+
+marketing_ai = get_marketing_ai()
 
 # Setup logging to console
 logging.basicConfig(level=logging.INFO)
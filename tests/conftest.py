@@ -0,0 +1,22 @@
+"""
+Test environment: SQLite, no admin seeding, no bot polling, no Redis or Gemini keys
+Set before any test module imports app.
+"""
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault('SESSION_SECRET', 'test-secret')
+os.environ['AUTO_INIT_DB'] = '0'
+os.environ['RUN_BOT_MANAGER'] = '0'
+for name in ('DATABASE_URL', 'RENDER', 'REDIS_URL', 'PASSWORD_HASH_METHOD'):
+    os.environ.pop(name, None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def client():
+    from app import app
+    app.config.update(TESTING=True, LOGIN_DISABLED=True)
+    return app.test_client()
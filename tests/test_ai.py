@@ -0,0 +1,110 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import ai
+
+@pytest.fixture
+def cache_hit(monkeypatch):
+    """Serve every request from the response cache and record the calling thread"""
+    threads = []
+    
+    def lookup(*args):
+        threads.append(threading.get_ident())
+        return 'cached', 'key', None, None
+    
+    monkeypatch.setattr(ai, 'GENAI_ASYNC_AVAILABLE', True)
+    monkeypatch.setattr(ai, '_lookup_cached_response', lookup)
+    return threads
+
+def test_async_cache_lookup_runs_off_the_event_loop(cache_hit):
+    async def main():
+        return await ai.get_ai_response_async('salom', bot_id=1), threading.get_ident()
+    
+    response, loop_thread = asyncio.run(main())
+    assert response == 'cached'
+    assert cache_hit and loop_thread not in cache_hit
+
+def test_streamed_cache_lookup_runs_off_the_event_loop(cache_hit):
+    async def main():
+        chunks = [chunk async for chunk in ai.stream_ai_response_async('salom', bot_id=1)]
+        return chunks, threading.get_ident()
+    
+    chunks, loop_thread = asyncio.run(main())
+    assert chunks == ['cached']
+    assert cache_hit and loop_thread not in cache_hit
+
+@pytest.fixture
+def knowledge(monkeypatch):
+    """One bot with a single text entry in a throwaway SQLite schema, plus a controllable clock"""
+    from app import app, db
+    from models import Bot, KnowledgeBase, User
+    
+    clock = {'wall': 1_000_000.0, 'mono': 0.0}
+    monkeypatch.setattr(ai, 'time', SimpleNamespace(
+        time=lambda: clock['wall'], monotonic=lambda: clock['mono'], monotonic_ns=lambda: int(clock['mono'] * 1e9)
+    ))
+    monkeypatch.setattr(ai, 'KB_CACHE_TTL', 120)
+    with app.app_context():
+        db.create_all()
+        user = User(username='kb-test', email='kb-test@example.com', password_hash='x')
+        db.session.add(user)
+        db.session.flush()
+        bot = Bot(user_id=user.id, name='KB test')
+        db.session.add(bot)
+        db.session.flush()
+        entry = KnowledgeBase(bot_id=bot.id, content='Narx: 100', content_type='text')
+        db.session.add(entry)
+        db.session.commit()
+        yield SimpleNamespace(bot_id=bot.id, entry=entry, clock=clock, db=db)
+        ai._KB_CACHE.pop(bot.id, None)
+        db.session.delete(bot)
+        db.session.delete(user)
+        db.session.commit()
+
+def _edit_elsewhere(knowledge, content):
+    """In-place edit as another process would make it: no kb_cache_bump() here"""
+    knowledge.entry.content = content
+    knowledge.db.session.commit()
+
+def test_kb_edit_changing_length_is_seen_after_ttl(knowledge):
+    assert ai.process_knowledge_base(knowledge.bot_id) == 'Narx: 100'
+    _edit_elsewhere(knowledge, 'Narx: 1500')
+    knowledge.clock['mono'] += ai.KB_CACHE_TTL + 1
+    assert ai.process_knowledge_base(knowledge.bot_id) == 'Narx: 1500'
+
+def test_kb_edit_keeping_length_is_seen_without_redis(knowledge):
+    assert ai.process_knowledge_base(knowledge.bot_id) == 'Narx: 100'
+    _edit_elsewhere(knowledge, 'Narx: 200')
+    knowledge.clock['mono'] += ai.KB_CACHE_TTL + 1
+    knowledge.clock['wall'] += ai.KB_CACHE_TTL
+    assert ai.process_knowledge_base(knowledge.bot_id) == 'Narx: 200'
+
+def _knowledge_base(chunks: int) -> str:
+    return "\n\n".join(f"Mahsulot{i:03d}: " + "x" * 100 for i in range(chunks))
+
+def _prompt_knowledge(prompt: str) -> str:
+    """Knowledge base section of a prompt built by _build_full_prompt"""
+    head, tail = ai._knowledge_block("\0").split("\0")
+    return prompt.split(head, 1)[1].split(tail, 1)[0]
+
+def test_prompt_keeps_knowledge_base_up_to_kb_char_limit():
+    knowledge_base = _knowledge_base(60)  # ~6700 chars: over SYSTEM_PROMPT_LIMIT, under the default KB_CHAR_LIMIT
+    prompt = ai._build_full_prompt('Mahsulot059 narxi?', 'Bot', 'uz', knowledge_base, 'User: salom\nBot: salom')
+    assert _prompt_knowledge(prompt) == knowledge_base
+    assert 'User: salom' in prompt
+
+def test_prompt_knowledge_base_follows_configured_limit():
+    from app import app
+    
+    with app.app_context():
+        app.config['KB_CHAR_LIMIT'] = 2000
+        try:
+            prompt = ai._build_full_prompt('Mahsulot059 narxi?', 'Bot', 'uz', _knowledge_base(60), '')
+        finally:
+            app.config.pop('KB_CHAR_LIMIT')
+    knowledge = _prompt_knowledge(prompt)
+    assert len(knowledge) <= 2000
+    assert 'Mahsulot059' in knowledge
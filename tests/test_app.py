@@ -0,0 +1,34 @@
+import datetime
+import decimal
+import json
+import uuid
+
+import pytest
+from flask.json.provider import DefaultJSONProvider
+
+from app import app
+
+PAYLOAD = {
+    'count': 3,
+    7: 'int key',
+    'when': datetime.datetime(2026, 1, 2, 3, 4, 5),
+    'day': datetime.date(2026, 1, 2),
+    'price': decimal.Decimal('12.50'),
+    'id': uuid.UUID('12345678-1234-5678-1234-567812345678'),
+    'name': "Qo'qon",
+}
+
+def test_orjson_provider_is_installed():
+    pytest.importorskip('orjson')
+    assert type(app.json).__name__ == 'OrjsonProvider'
+
+def test_json_provider_matches_flask_default_output():
+    expected = json.loads(DefaultJSONProvider(app).dumps(PAYLOAD))
+    assert json.loads(app.json.dumps(PAYLOAD)) == expected
+    assert app.json.loads(app.json.dumps(PAYLOAD)) == expected
+
+def test_jsonify_and_get_json_round_trip():
+    with app.test_request_context('/', method='POST', json={'topic': 'Kofe', 'n': [1, 2]}):
+        from flask import jsonify, request
+        assert request.get_json() == {'topic': 'Kofe', 'n': [1, 2]}
+        assert jsonify(PAYLOAD).get_json()['when'] == 'Fri, 02 Jan 2026 03:04:05 GMT'
@@ -0,0 +1,26 @@
+import pytest
+from werkzeug.security import generate_password_hash
+
+import auth
+
+@pytest.fixture
+def hash_method(monkeypatch):
+    def configure(method):
+        monkeypatch.setattr(auth, 'PASSWORD_HASH_METHOD', method)
+        auth._configured_hash_prefix.cache_clear()
+    yield configure
+    auth._configured_hash_prefix.cache_clear()
+
+@pytest.mark.parametrize('method', ['scrypt', 'pbkdf2:sha256', 'pbkdf2:sha256:260000'])
+def test_hash_made_with_configured_method_is_kept(hash_method, method):
+    hash_method(method)
+    assert not auth.password_needs_rehash(auth.hash_password('secret'))
+    assert not auth.password_needs_rehash(generate_password_hash('secret', method=method))
+
+def test_hash_made_with_other_method_is_rehashed(hash_method):
+    hash_method('scrypt')
+    assert auth.password_needs_rehash(generate_password_hash('secret', method='pbkdf2:sha256'))
+
+def test_no_rehash_without_configured_method(hash_method):
+    hash_method(None)
+    assert not auth.password_needs_rehash(generate_password_hash('secret', method='pbkdf2:sha256'))
@@ -0,0 +1,58 @@
+import pytest
+
+import instagram_bot
+
+class FakeGraphBot:
+    def __init__(self, access_token, bot_id):
+        self.closed = False
+    
+    def close(self):
+        self.closed = True
+
+class FakeClient:
+    login_ok = True
+    
+    def __init__(self, session_path=None):
+        pass
+    
+    def login(self, username, password):
+        return (True, 'ok') if self.login_ok else (False, 'bad password')
+
+@pytest.fixture
+def manager(monkeypatch):
+    monkeypatch.setattr(instagram_bot, 'InstagramBot', FakeGraphBot)
+    monkeypatch.setattr(instagram_bot, 'InstagramClient', FakeClient)
+    monkeypatch.setattr(instagram_bot, 'session_path_for', lambda bot_id: None)
+    manager = instagram_bot.InstagramBotManager()
+    manager.scheduled = []
+    monkeypatch.setattr(manager, '_schedule_poll', lambda *args: manager.scheduled.append(args))
+    return manager
+
+def test_official_bot_lifecycle(manager):
+    assert manager.start_bot(1, 'EAAB' + 'x' * 120)
+    official = manager.running_bots[1]
+    assert manager.get_state(1) == 'running' and manager.is_running(1)
+    assert manager.unofficial_bots == {}
+    
+    assert manager.stop_bot(1)
+    assert official.closed
+    assert manager.get_state(1) == 'stopped' and not manager.is_running(1)
+    assert manager.running_bots == {}
+
+def test_unofficial_restart_stops_previous_poller(manager):
+    assert manager.start_bot(2, 'shop:secret')
+    first_stop = manager.scheduled[-1][2]
+    assert manager.start_bot(2, 'shop:secret')
+    assert first_stop.is_set()
+    assert not manager.scheduled[-1][2].is_set()
+    assert list(manager.unofficial_bots) == [2]
+    
+    assert manager.stop_bot(2)
+    assert manager.scheduled[-1][2].is_set()
+    assert manager.unofficial_bots == {}
+
+def test_failed_login_is_recorded(manager, monkeypatch):
+    monkeypatch.setattr(FakeClient, 'login_ok', False)
+    assert not manager.start_bot(3, 'shop:wrong')
+    assert manager.get_state(3) == 'failed'
+    assert not manager.is_running(3)
@@ -0,0 +1,119 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+import marketing
+from marketing import MarketingAIRejected, MarketingAITimeout, MarketingAIUnavailable
+
+google_exceptions = pytest.importorskip('google.api_core.exceptions')
+
+def _marketing_ai(monkeypatch, client):
+    """MarketingAI with real error tables and one fake key slot"""
+    for name in ('GOOGLE_API_KEY', 'GOOGLE_API_KEY1', 'GOOGLE_API_KEY2'):
+        monkeypatch.delenv(name, raising=False)
+    ai = marketing.MarketingAI()
+    ai._slots = [marketing._KeySlot('TEST_KEY', client)]
+    ai.is_available = True
+    return ai
+
+def _response(text):
+    """Minimal GenerateContentResponse stand-in with one text part"""
+    part = SimpleNamespace(text=text)
+    return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+@pytest.fixture
+def no_response_cache(monkeypatch):
+    monkeypatch.setattr(marketing, 'get_cached_response', lambda key: None)
+    monkeypatch.setattr(marketing, 'cache_response', lambda key, value: None)
+
+def test_identical_requests_share_one_gemini_call(monkeypatch, no_response_cache):
+    entered, release, calls = threading.Event(), threading.Event(), []
+    
+    class Client:
+        def generate_content(self, request, **kwargs):
+            calls.append(request)
+            entered.set()
+            release.wait(5)
+            return _response('post')
+    
+    ai = _marketing_ai(monkeypatch, Client())
+    request = ('seo', 'uz', ('kofe', 'arabica'), 'prompt')
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        leader = pool.submit(ai._cached_generate, *request)
+        assert entered.wait(5)
+        follower = pool.submit(ai._cached_generate, *request)
+        time.sleep(0.1)  # follower joins the leader's in-flight future
+        release.set()
+        assert leader.result(5) == follower.result(5) == 'post'
+    assert len(calls) == 1
+    assert not marketing._inflight
+
+def test_request_carries_system_instruction_outside_prompt(monkeypatch):
+    pytest.importorskip('google.ai.generativelanguage')
+    ai = _marketing_ai(monkeypatch, None)
+    request = ai._request('seo:uz', 'Mavzu: Kofe')
+    assert request.model == f"models/{marketing.MODEL_NAME}"
+    assert request.system_instruction.parts[0].text == marketing._SYSTEM_INSTRUCTIONS['seo:uz']
+    assert [part.text for part in request.contents[0].parts] == ['Mavzu: Kofe']
+    assert request.generation_config.max_output_tokens == marketing._GENERATION_CONFIGS['seo']['max_output_tokens']
+
+def test_blocked_response_is_rejected():
+    with pytest.raises(ValueError):
+        marketing._response_text(SimpleNamespace(candidates=[], prompt_feedback='block_reason: SAFETY'))
+
+@pytest.mark.parametrize('raised, expected, status', [
+    (google_exceptions.ResourceExhausted('quota'), MarketingAIUnavailable, 503),
+    (google_exceptions.ServiceUnavailable('down'), MarketingAIUnavailable, 503),
+    (google_exceptions.DeadlineExceeded('slow'), MarketingAITimeout, 504),
+    (google_exceptions.InvalidArgument('bad'), MarketingAIRejected, 422),
+    (ValueError('blocked by safety filter'), MarketingAIRejected, 422),
+])
+def test_gemini_errors_map_to_typed_errors(monkeypatch, raised, expected, status):
+    ai = _marketing_ai(monkeypatch, None)
+    future = Future()
+    future.set_exception(raised)
+    with pytest.raises(expected) as info:
+        ai._result(future, *marketing._SEO_ERRORS)
+    assert info.value.status_code == status
+
+@pytest.mark.parametrize('error, status', [
+    (MarketingAIUnavailable('busy', retry_after=30), 503),
+    (MarketingAITimeout('slow'), 504),
+    (MarketingAIRejected('rejected'), 422),
+])
+def test_generate_seo_error_status(client, monkeypatch, error, status):
+    class AI:
+        def generate_seo_post(self, *args):
+            raise error
+    
+    monkeypatch.setattr(marketing, 'get_marketing_ai', lambda: AI())
+    response = client.post('/marketing/generate-seo', json={'topic': 'Kofe'})
+    assert response.status_code == status
+    assert response.get_json() == {'error': str(error)}
+    assert response.headers.get('Retry-After') == (str(error.retry_after) if error.retry_after else None)
+
+@pytest.mark.parametrize('path, payload', [
+    ('/marketing/generate-seo', {}),
+    ('/marketing/generate-seo', {'topic': '   '}),
+    ('/marketing/generate-seo', {'topic': 'x' * (marketing.MAX_TOPIC_LENGTH + 1)}),
+    ('/marketing/generate-seo', {'topic': 'Kofe', 'keywords': 'k' * (marketing.MAX_KEYWORDS_LENGTH + 1)}),
+    ('/marketing/generate-seo/stream', {'topic': 'x' * (marketing.MAX_TOPIC_LENGTH + 1)}),
+    ('/marketing/generate-plan', {'target_audience': 'talabalar'}),
+    ('/marketing/generate-plan', {'product_name': 'x' * (marketing.MAX_TOPIC_LENGTH + 1)}),
+    ('/marketing/generate-image-prompt', {}),
+])
+def test_invalid_input_is_rejected_before_gemini(client, monkeypatch, path, payload):
+    def unexpected():
+        raise AssertionError("Gemini must not be called for invalid input")
+    
+    monkeypatch.setattr(marketing, 'get_marketing_ai', unexpected)
+    response = client.post(path, json=payload)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+def test_non_json_body_is_rejected(client):
+    response = client.post('/marketing/generate-seo', data='topic=Kofe', content_type='text/plain')
+    assert response.status_code == 400
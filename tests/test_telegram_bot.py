@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+import telegram_bot
+
+@pytest.fixture
+def processed(monkeypatch):
+    monkeypatch.setattr(telegram_bot, '_PROCESSED_MAX', 3)
+    telegram_bot._processed_updates.clear()
+    yield
+    telegram_bot._processed_updates.clear()
+
+def test_mark_processed_rejects_duplicates(processed):
+    assert telegram_bot._mark_processed('token-a', 1)
+    assert not telegram_bot._mark_processed('token-a', 1)
+
+def test_mark_processed_is_keyed_per_bot(processed):
+    assert telegram_bot._mark_processed('token-a', 1)
+    assert telegram_bot._mark_processed('token-b', 1)
+
+def test_mark_processed_evicts_oldest_first(processed):
+    for update_id in (1, 2, 3, 4):
+        assert telegram_bot._mark_processed('token-a', update_id)
+    # Capacity 3: update 1 was evicted, 2..4 are still remembered
+    assert list(telegram_bot._processed_updates) == [('token-a', 2), ('token-a', 3), ('token-a', 4)]
+    assert not telegram_bot._mark_processed('token-a', 4)
+    assert telegram_bot._mark_processed('token-a', 1)
+
+@pytest.fixture
+def dispatched():
+    """TelegramHTTPBot with recording handlers for /start and plain messages"""
+    bot = telegram_bot.TelegramHTTPBot('token-a')
+    calls = []
+    
+    def recorder(name):
+        async def handler(update, context):
+            calls.append((name, update.message.text, context.args))
+        return handler
+    
+    bot.add_handler(('start', recorder('start')))
+    bot.add_handler(('message', recorder('message')))
+    
+    def send(text):
+        asyncio.run(bot.process_update({'update_id': 1, 'message': {
+            'message_id': 1, 'chat': {'id': 5}, 'from': {'id': 5, 'first_name': 'Ali'}, 'text': text
+        }}))
+        return calls
+    return send
+
+def test_command_dispatch_by_name(dispatched):
+    assert dispatched('/start ref42') == [('start', '/start ref42', ['ref42'])]
+
+def test_command_dispatch_strips_bot_username(dispatched):
+    assert dispatched('/start@FactoryBot') == [('start', '/start@FactoryBot', [])]
+
+def test_unknown_command_reaches_no_handler(dispatched):
+    assert dispatched('/stop') == []
+
+def test_plain_text_goes_to_message_handlers(dispatched):
+    assert dispatched('salom') == [('message', 'salom', [])]
@@ -1,7 +1,6 @@
 import os
 import json
 import logging
-import requests
 from typing import Dict, List, Optional, Any, Union, Tuple
 from datetime import datetime
 from flask import Blueprint, request, jsonify, url_for
@@ -15,6 +14,7 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 whatsapp_bp = Blueprint('whatsapp', __name__)
+http = app.extensions['http']
 
 class WhatsAppBot:
     """WhatsApp Business API integratsiyasi"""
@@ -43,7 +43,7 @@ class WhatsAppBot:
                 'text': {'body': message_text}
             }
             
-            response = requests.post(url, headers=headers, json=payload, timeout=30)
+            response = http.post(url, headers=headers, json=payload, timeout=30)
             
             if response.status_code == 200:
                 logger.info(f"WhatsApp message sent to {to_number}")
@@ -77,7 +77,7 @@ class WhatsAppBot:
                 }
             }
             
-            response = requests.post(url, headers=headers, json=payload, timeout=30)
+            response = http.post(url, headers=headers, json=payload, timeout=30)
             
             if response.status_code == 200:
                 logger.info(f"WhatsApp template sent to {to_number}")
@@ -123,7 +123,7 @@ class WhatsAppBot:
                 }
             }
             
-            response = requests.post(url, headers=headers, json=payload, timeout=30)
+            response = http.post(url, headers=headers, json=payload, timeout=30)
             
             if response.status_code == 200:
                 logger.info(f"WhatsApp interactive message sent to {to_number}")
@@ -158,7 +158,7 @@ class WhatsAppBot:
             if caption and media_type in ['image', 'video', 'document']:
                 payload[media_type]['caption'] = caption
             
-            response = requests.post(url, headers=headers, json=payload, timeout=30)
+            response = http.post(url, headers=headers, json=payload, timeout=30)
             
             if response.status_code == 200:
                 logger.info(f"WhatsApp media sent to {to_number}")
@@ -193,7 +193,7 @@ class WhatsAppBot:
                 }
             }
             
-            response = requests.post(url, headers=headers, json=payload, timeout=30)
+            response = http.post(url, headers=headers, json=payload, timeout=30)
             
             if response.status_code == 200:
                 logger.info(f"WhatsApp location sent to {to_number}")
@@ -291,7 +291,8 @@ Yangi obunani BotFactory.uz saytidan sotib oling.
                     message=message_text,
                     bot_name=bot.name,
                     user_language=user.language,
-                    knowledge_base=knowledge_base
+                    knowledge_base=knowledge_base,
+                    bot_id=self.bot_id
                 )
                 
                 # Chat tarixini saqlash
@@ -436,7 +437,7 @@ Yangi obunani BotFactory.uz saytidan sotib oling.
                 'Authorization': f'Bearer {self.access_token}'
             }
             
-            response = requests.get(url, headers=headers, timeout=30)
+            response = http.get(url, headers=headers, timeout=30)
             
             if response.status_code == 200:
                 data = response.json()
@@ -645,7 +646,7 @@ def _mark_message_as_read(bot, message_id):
             'message_id': message_id
         }
         
-        requests.post(url, headers=headers, json=payload, timeout=10)
+        http.post(url, headers=headers, json=payload, timeout=10)
         
     except Exception as e:
         logger.error(f"Mark as read error: {str(e)}")